@@ -14,26 +14,49 @@
 
 from time import time
 import sys
+import math
 import subprocess
+import urllib
 from optparse import OptionParser
 import sys
 
 #Add the conf path to our path so we can call the blanketconfig 
 sys.path.append('conf')
-from config import AggregateMicroPathConfig
+sys.path.append('scripts')
+from config import AggregateMicroPathConfig, FROZEN_SUFFIX
+import cell_keys
+import cell_sketches
+import extract_path_segments
+from run_summary import RunSummary, watchHiveOutput
+from stage_dag import Stage, runStages, cachedStages, fingerprint, fileDigest, FINGERPRINT_PROPERTY
 
 #Differences are the sort order and the table schema for creation
 #
-# Subprocess wrapper to exit on errors.
+# Subprocess wrapper to exit on errors.  stderr is passed through
+# watchHiveOutput so the run summary learns which jobs were started.
 #
 def subprocessCall(argsList,quitOnError=True,stdout=None):
-  returnCode = subprocess.call(argsList,stdout=stdout)
+  process = subprocess.Popen(argsList,stdout=stdout,stderr=subprocess.PIPE)
+  watchHiveOutput(process.stderr)
+  returnCode = process.wait()
   if (quitOnError and 0 != returnCode):
     print "Error executing subprocess:\n"
     print " ".join(argsList)
     exit(1)
   return returnCode
 
+#
+# run a hive query and return the non empty lines it printed
+#
+def hiveQuery(hql_script,quitOnError=True):
+  process = subprocess.Popen(["hive","-S","-e",hql_script],stdout=subprocess.PIPE)
+  (out,err) = process.communicate()
+  if (quitOnError and 0 != process.returncode):
+    print "Error executing hive query:\n"
+    print hql_script
+    exit(1)
+  return [line.strip() for line in out.splitlines() if line.strip()]
+
 #
 # print usage to command line and exit
 #
@@ -43,34 +66,114 @@ def printUsageAndExit(parser):
 
 
 #
-# create a new hive table
+# the config files every TRANSFORM script is shipped with: config.py, the
+# .ini and the frozen copy of it main writes (see config.loadConfig)
 #
-def create_new_hive_table(database_name,table_name,table_schema):
-  hql_script = """
-    DROP TABLE """+database_name+"""."""+table_name+""";
+def config_files(configuration):
+  return "conf/config.py conf/" + configuration.config_file + " conf/" + configuration.config_file + FROZEN_SUFFIX
+
+#
+# HQL (re)creating a hive table
+#
+def new_hive_table_hql(database_name,table_name,table_schema):
+  return """
+    DROP TABLE IF EXISTS """+database_name+"""."""+table_name+""";
     CREATE TABLE """+database_name+"""."""+table_name+""" ( """+table_schema+""" )
     ;"""
-  subprocessCall(["hive","-e",hql_script]) 
 
+#
+# create a new hive table
+#
+def create_new_hive_table(database_name,table_name,table_schema):
+  subprocessCall(["hive","-e",new_hive_table_hql(database_name,table_name,table_schema)])
 
 #
-# Extract paths from  conf/osm.ini initial data and store into a new table
+# {table: properties} of the given tables in one hive session: the
+# parameters hive keeps (numFiles, numRows, totalSize, transient_lastDdlTime,
+# micro_path.fingerprint ...) as SHOW TBLPROPERTIES prints them and, for
+# partitioned tables, the list of partitions.  Tables that don't exist come
+# back empty.
 #
-def extract_paths(conf):
-  table_schema = "id string, alat string, blat string, alon string, blon string, adt string, bdt string, time string, distance string, velocity string"
-  create_new_hive_table(conf.database_name,"micro_path_track_extract_" + conf.table_name,table_schema)
+def table_properties(tables):
+  statements = ["set hive.cli.errors.ignore=true;"]
+  for table in tables:
+    statements.append("!echo micro_path_table " + table + ";")
+    statements.append("SHOW TBLPROPERTIES " + table + ";")
+    statements.append("SHOW PARTITIONS " + table + ";")
+  properties = {}
+  current = None
+  for line in hiveQuery("\n".join(statements), False):
+    if line.startswith("micro_path_table "):
+      current = properties.setdefault(line.split(" ", 1)[1], {})
+    elif current is not None and "\t" in line:
+      (key, value) = line.split("\t", 1)
+      current[key.strip()] = value.strip()
+    elif current is not None:
+      current.setdefault("partitions", []).append(line)
+  for table in tables:
+    properties.setdefault(table, {})
+  return properties
 
+#
+# reducer settings of a stage reading input_bytes: one reducer per
+# reducer_bytes, at most max_reducers.  Without a size (tables created
+# earlier in the same run, partitioned sources) hive estimates the count
+# from the input files with the same limits.
+#
+def reducer_settings(configuration,input_bytes=None):
+  if input_bytes:
+    reducers = max(1, min(configuration.max_reducers, int(math.ceil(float(input_bytes) / configuration.reducer_bytes))))
+    return "set mapred.reduce.tasks=" + str(reducers) + ";"
+  return """set mapred.reduce.tasks=-1;
+    set hive.exec.reducers.bytes.per.reducer=""" + str(configuration.reducer_bytes) + """;
+    set hive.exec.reducers.max=""" + str(configuration.max_reducers) + ";"
 
 
+#
+# WHERE terms dropping source rows in front of the sort by track: rows
+# without a dt or a numeric lat/lon, rows outside date_from/date_to and, with
+# prune_to_blankets, fixes too far from every blanket to take part in a
+# crossing (see AggregateMicroPathConfig.pruneBoxes).  Quotes are stripped
+# like parseLines does.  Epoch second dt values are left to the script.
+#
+def source_predicates(conf):
+  lat = "CAST(translate(CAST(" + conf.table_schema_lat + " AS STRING), '\"', '') AS DOUBLE)"
+  lon = "CAST(translate(CAST(" + conf.table_schema_lon + " AS STRING), '\"', '') AS DOUBLE)"
+  dt = "translate(trim(CAST(" + conf.table_schema_dt + " AS STRING)), 'T\"', ' ')"
+  epoch = "trim(CAST(" + conf.table_schema_dt + " AS STRING)) RLIKE '^-?[0-9]+$'"
+  terms = [conf.table_schema_dt + " IS NOT NULL", lat + " IS NOT NULL", lon + " IS NOT NULL"]
+  if conf.date_from is not None:
+    terms.append("(" + dt + " >= '" + conf.date_from + "' OR " + epoch + ")")
+  if conf.date_to is not None:
+    terms.append("(" + dt + " < '" + conf.date_to + "' OR " + epoch + ")")
+  boxes = conf.pruneBoxes()
+  if boxes:
+    clauses = []
+    for (latMin, latMax, lonMin, lonMax) in boxes:
+      clause = lat + " BETWEEN %.9f AND %.9f" % (latMin, latMax)
+      if lonMin is not None:
+        # fixes on the other side of the dateline
+        clause += " AND (" + " OR ".join("(" + lon + shift + (" BETWEEN %.9f AND %.9f)" % (lonMin, lonMax)) for shift in ("", " - 360", " + 360")) + ")"
+      clauses.append("(" + clause + ")")
+    terms.append("(" + "\n          OR ".join(clauses) + ")")
+  return "\n          AND ".join(terms)
+
+#
+# Extract paths from  conf/osm.ini initial data and store into a new table
+#
+def extract_paths_hql(conf, reducers):
+  # adt and bdt are epoch seconds, see scripts/timestamps.py
+  table_schema = "id string, alat string, blat string, alon string, blon string, adt bigint, bdt bigint, time string, distance string, velocity string"
+
   #hadoop streaming to extract paths
-  hql_script = """
-    set mapred.reduce.tasks=96;
-    set mapred.map.tasks=96;
-   
-    ADD FILES conf/config.py conf/"""+conf.config_file+""" scripts/extract_path_segments.py;
+  return new_hive_table_hql(conf.database_name,"micro_path_track_extract_" + conf.table_name,table_schema) + """
+    """ + reducers + """
+
+    ADD FILES """ + config_files(conf) + """ scripts/extract_path_segments.py scripts/tripline_vector.py scripts/timestamps.py scripts/counters.py;
     FROM(
         SELECT """+conf.table_schema_id+""","""+conf.table_schema_dt+""","""+conf.table_schema_lat+""","""+conf.table_schema_lon+""" 
         FROM """ + conf.database_name + """.""" + conf.table_name + """
+        WHERE """ + source_predicates(conf) + """
         DISTRIBUTE BY """+conf.table_schema_id+"""
         SORT BY """+conf.table_schema_id+""","""+conf.table_schema_dt+""" asc
     ) map_out
@@ -81,153 +184,745 @@ def extract_paths(conf):
     AS id,alat,blat,alon,blon,adt,bdt,time,distance,velocity
     ;   
   """
-  subprocessCall(["hive","-e",hql_script]) 
   
 
+#
+# HQL string literal of value
+#
+def hql_string(value):
+  return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+#
+# {id: chunk boundaries} of the tracks to split (skew_chunk_fixes, see
+# skewPlan in scripts/extract_path_segments.py).  The table statistics have
+# no counts per id, so the fixes are sampled at skew_sample: the dts of the
+# sampled fixes of the skew_max_tracks ids with most samples above the
+# threshold come back in one query.
+#
+def hot_tracks(conf):
+  threshold = conf.skew_chunk_fixes * conf.skew_sample
+  lines = hiveQuery("""
+    SELECT id, count(1) AS fixes, concat_ws('|', collect_list(dt))
+    FROM(
+      SELECT CAST("""+conf.table_schema_id+""" AS STRING) AS id, CAST("""+conf.table_schema_dt+""" AS STRING) AS dt
+      FROM """ + conf.database_name + """.""" + conf.table_name + """
+      WHERE rand() < """ + repr(conf.skew_sample) + """
+      AND """ + source_predicates(conf) + """
+    ) sampled
+    GROUP BY id
+    HAVING count(1) > """ + repr(threshold) + """
+    ORDER BY fixes DESC
+    LIMIT """ + str(conf.skew_max_tracks) + """;
+    """)
+  sampled = {}
+  for line in lines:
+    (user_id, fixes, dts) = line.split("\t", 2)
+    sampled[user_id] = dts.split("|")
+  return extract_path_segments.skewPlan(conf, sampled)
+
+#
+# Extract paths with the tracks in plan split into chunks (see
+# scripts/extract_path_segments.py): the chunks are distributed as tracks of
+# their own, each one after the first also gets the last fix of the chunk
+# before it.  The segments of the chunks, the fixes of the split tracks and
+# the boundaries of the chunks go to micro_path_track_split.  The segments
+# of the tracks whose chunks all ended exactly are added to the extracted
+# paths, the other split tracks (listed in micro_path_track_inexact) are
+# extracted again from their fixes in one piece.
+#
+def extract_split_paths_hql(conf, reducers, plan):
+  table_schema = "id string, alat string, blat string, alon string, blon string, adt bigint, bdt bigint, time string, distance string, velocity string"
+  columns = "id,alat,blat,alon,blon,adt,bdt,time,distance,velocity"
+  extract = conf.database_name + ".micro_path_track_extract_" + conf.table_name
+  split = conf.database_name + ".micro_path_track_split_" + conf.table_name
+  inexact = conf.database_name + ".micro_path_track_inexact_" + conf.table_name
+
+  chunk = "CASE id" + "".join("\n            WHEN " + hql_string(user_id) + " THEN CASE" +
+                             "".join(" WHEN dt >= " + hql_string(boundaries[k - 1]) + " THEN " + str(k) for k in range(len(boundaries), 0, -1)) +
+                             " ELSE 0 END" for (user_id, boundaries) in sorted(plan.items())) + " END"
+  last = "CASE id" + "".join(" WHEN " + hql_string(user_id) + " THEN " + str(len(boundaries))
+                             for (user_id, boundaries) in sorted(plan.items())) + " END"
+  fixes = """
+          SELECT id, dt, lat, lon, """ + chunk + """ AS chunk
+          FROM(
+            SELECT CAST("""+conf.table_schema_id+""" AS STRING) AS id, CAST("""+conf.table_schema_dt+""" AS STRING) AS dt,
+              CAST("""+conf.table_schema_lat+""" AS STRING) AS lat, CAST("""+conf.table_schema_lon+""" AS STRING) AS lon
+            FROM """ + conf.database_name + """.""" + conf.table_name + """
+            WHERE """ + source_predicates(conf) + """
+          ) source"""
+
+  return new_hive_table_hql(conf.database_name,"micro_path_track_extract_" + conf.table_name,table_schema) + \
+    new_hive_table_hql(conf.database_name,"micro_path_track_split_" + conf.table_name,"kind string, " + table_schema) + \
+    new_hive_table_hql(conf.database_name,"micro_path_track_inexact_" + conf.table_name,"id string") + """
+    """ + reducers + """
+
+    ADD FILES """ + config_files(conf) + """ scripts/extract_path_segments.py scripts/tripline_vector.py scripts/timestamps.py scripts/counters.py;
+    FROM(
+      SELECT TRANSFORM(map_out.id, map_out.dt, map_out.lat, map_out.lon, map_out.chunk, map_out.start)
+      USING \"python extract_path_segments.py --chunks """ + conf.config_file + """\"
+      AS kind,""" + columns + """
+      FROM(
+        SELECT id, dt, lat, lon, chunk, start
+        FROM(
+          SELECT id, dt, lat, lon, chunk, CAST(NULL AS STRING) AS start
+          FROM(""" + fixes + """
+          ) fixes
+          UNION ALL
+          SELECT id, fix.dt AS dt, fix.lat AS lat, fix.lon AS lon, chunk + 1 AS chunk, 'start' AS start
+          FROM(
+            SELECT id, chunk, max(named_struct('dt', dt, 'lat', lat, 'lon', lon)) AS fix
+            FROM(""" + fixes + """
+            ) fixes
+            WHERE chunk IS NOT NULL
+            GROUP BY id, chunk
+          ) ends
+          WHERE chunk < """ + last + """
+        ) chunked
+        DISTRIBUTE BY id, chunk
+        SORT BY id, chunk, dt, lat, lon asc
+      ) map_out
+    ) extracted
+
+    INSERT OVERWRITE TABLE """ + extract + """
+    SELECT """ + columns + """ WHERE kind = 'segment'
+    INSERT OVERWRITE TABLE """ + split + """
+    SELECT kind,""" + columns + """ WHERE kind != 'segment'
+    ;
+
+    INSERT OVERWRITE TABLE """ + inexact + """
+    SELECT id FROM """ + split + """
+    WHERE kind = 'boundary'
+    GROUP BY id
+    HAVING min(IF(distance = '0', CAST(time AS INT), CAST(NULL AS INT))) < max(CAST(time AS INT))
+    OR count(1) != max(CAST(time AS INT)) + 1
+    ;
+
+    INSERT INTO TABLE """ + extract + """
+    SELECT """ + ",".join("s." + column for column in columns.split(",")) + """
+    FROM """ + split + """ s LEFT OUTER JOIN """ + inexact + """ i ON (s.id = i.id)
+    WHERE s.kind = 'chunked' AND i.id IS NULL
+    ;
+
+    FROM(
+      SELECT s.id AS id, s.time AS dt, s.alat AS lat, s.alon AS lon
+      FROM """ + split + """ s LEFT SEMI JOIN """ + inexact + """ i ON (s.id = i.id)
+      WHERE s.kind = 'fix'
+      DISTRIBUTE BY id
+      SORT BY id, dt, lat, lon asc
+    ) map_out
+    INSERT INTO TABLE """ + extract + """
+    SELECT TRANSFORM(map_out.id, map_out.dt, map_out.lat, map_out.lon)
+    USING \"python extract_path_segments.py """ + conf.config_file + """\"
+    AS """ + columns + """
+    ;
+  """
+
 #
 # Extract trip line intersects from paths
 #
-def extract_trip_line_intersects(configuration):
-  table_schema = "intersectX string, intersectY string, dt string, velocity float, direction float, track_id string"
-  create_new_hive_table(configuration.database_name,"micro_path_tripline_bins_" + configuration.table_name,table_schema)
-  
+def extract_trip_line_intersects_hql(configuration):
+  # crossings, direction_sin and direction_cos are only filled by rows of the
+  # in-mapper combiner (tripline_combine_size), where velocity and direction
+  # hold sums; plain rows leave them NULL and count as one crossing.  level and
+  # rollup_dts are only filled when there is more than one output level.  A
+  # crossing is keyed by the index of its blanket and its integer cell key
+  # (see scripts/cell_keys.py), the cell centre is only formatted on output
+  table_schema = "blanket int, cell bigint, dt string, velocity double, direction double, track_id string, crossings int, direction_sin double, direction_cos double, level int, rollup_dts string"
   
   #hadoop streaming to extract paths
-  hql_script = """
-
+  return new_hive_table_hql(configuration.database_name,"micro_path_tripline_bins_" + configuration.table_name,table_schema) + """
   
-    ADD FILES conf/config.py scripts/tripline_bins.py conf/"""+configuration.config_file+""";
+    ADD FILES """ + config_files(configuration) + """ scripts/tripline_bins.py scripts/tripline_vector.py scripts/geometry.py scripts/timestamps.py scripts/blanket_index.py scripts/cell_keys.py scripts/counters.py;
 
     FROM """ + configuration.database_name + """.micro_path_track_extract_""" + configuration.table_name + """
     INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
     
     SELECT TRANSFORM(alat, alon, blat, blon, adt, bdt, velocity, id)
     USING \"python tripline_bins.py """ + configuration.config_file + """ \"
-    AS intersectX,intersectY,dt,velocity,direction,track_id
+    AS blanket,cell,dt,velocity,direction,track_id,crossings,direction_sin,direction_cos,level,rollup_dts
     ;   
     """
-  print("***hql_script***")
-  print(str(hql_script))
-  subprocessCall(["hive","-e",hql_script]) 
   
 #
-# take values form micro_path_tripline_bins and aggregate the counts
+# Distinct tracks and velocity quantiles per cell (see scripts/cell_sketches.py):
+# the map side sketches the tripline bins rows of every cell and time bucket,
+# the partial sketches of a cell meet in one reducer and are merged there.
+# Every output level gets a micro_path_intersect_sketch table.
 #
-def aggregate_intersection_list(configuration):
-  table_schema ="x string, y string, ids string, dt string"
-  create_new_hive_table(configuration.database_name,"micro_path_intersect_list_" + configuration.table_name,table_schema)
+def aggregate_sketches_hql(configuration, reducers):
+  table_schema = "x string, y string, crossings bigint, tracks bigint, " + \
+    ", ".join("velocity_p%s double" % sketch_label(q) for q in cell_sketches.QUANTILES) + \
+    ", tracks_sketch string, velocity_sketch string, blanket int, cell bigint, dt string"
+  tables = []
+  outputs = []
+  for (level, split, suffix) in configuration.outputLevels():
+    tables.append(new_hive_table_hql(configuration.database_name, "micro_path_intersect_sketch_" + configuration.table_name + suffix, table_schema))
+    outputs.append("""
+    INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_intersect_sketch_""" + configuration.table_name + suffix + """
+    SELECT x,y,crossings,tracks,""" + ",".join("velocity_p%s" % sketch_label(q) for q in cell_sketches.QUANTILES) + """,tracks_sketch,velocity_sketch,blanket,cell,dt
+    WHERE level = '""" + str(level) + """' AND split = '""" + split + """'""")
+  return "".join(tables) + """
+    """ + reducers + """
 
-  #hadoop streaming to extract paths
-  hql_script = """
-    set mapred.map.tasks=96;
-    set mapred.reduce.tasks=96;
-    
-    INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_intersect_list_""" + configuration.table_name + """
-    
-    SELECT 
-      intersectX,intersectY,dt
-      STUFF((
-        SELECT ', ' + [Name] + ':' + CAST([Value] AS VARCHAR(MAX)) 
-        FROM #YourTable 
-        WHERE (ID = Results.ID) 
-        FOR XML PATH(''),TYPE).value('(./text())[1]','VARCHAR(MAX)')
-      ,1,2,'') AS ids
-    FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
-    GROUP BY intersectX,intersectY,dt
-    
-    SELECT intersectX,intersectY,ids,dt
-    FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
-    GROUP BY intersectX,intersectY,dt
-    ;   
+    ADD FILES """ + config_files(configuration) + """ scripts/cell_sketches.py scripts/cell_keys.py scripts/counters.py;
+    FROM (
+      FROM (
+        FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
+        SELECT TRANSFORM(blanket, cell, dt, velocity, track_id, crossings""" + (", level, rollup_dts" if len(configuration.outputLevels()) > 1 else "") + """)
+        USING \"python cell_sketches.py map """ + configuration.config_file + """\"
+        AS (level int, split string, blanket int, cell bigint, dt string, tracks_sketch string, velocity_sketch string)
+        DISTRIBUTE BY level, split, blanket, cell, dt
+        SORT BY level, split, blanket, cell, dt
+      ) map_out
+      SELECT TRANSFORM(map_out.level, map_out.split, map_out.blanket, map_out.cell, map_out.dt, map_out.tracks_sketch, map_out.velocity_sketch)
+      USING \"python cell_sketches.py reduce """ + configuration.config_file + """\"
+      AS level, split, x, y, crossings, tracks, """ + ", ".join("velocity_p%s" % sketch_label(q) for q in cell_sketches.QUANTILES) + """, tracks_sketch, velocity_sketch, blanket, cell, dt
+    ) sketches
+    """ + "".join(outputs) + """
+    ;
     """
-  subprocessCall(["hive","-e",hql_script])
 
 #
-# take values form micro_path_tripline_bins and aggregate the counts
+# column label of a quantile, 50 for 0.5 and 99 for 0.99
 #
-def aggregate_intersection_points(configuration):
-  table_schema ="x string, y string, value int, dt string"
-  create_new_hive_table(configuration.database_name,"micro_path_intersect_counts_" + configuration.table_name,table_schema)
+def sketch_label(q):
+  return ("%g" % (q * 100)).replace(".", "_")
 
-  #hadoop streaming to extract paths
-  hql_script = """
-    set mapred.map.tasks=96;
-    set mapred.reduce.tasks=96;
-    
-    INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_intersect_counts_""" + configuration.table_name + """
-    SELECT intersectX,intersectY,count(1),dt
-    FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
-    GROUP BY intersectX,intersectY,dt
-    ;   
+def sketch_tables(configuration):
+  if not configuration.cell_sketches:
+    return []
+  return [incremental_table(configuration, "micro_path_intersect_sketch") + suffix for (level, split, suffix) in configuration.outputLevels()]
+
+#
+# HQL expressions (x, y) of the lat/lon centre of the cell in the blanket
+# and cell columns, for the blankets of a pyramid level.  Formatted like
+# cell_keys.cellCentre, so hive and local runs write the same strings.
+#
+def cell_centre_hql(configuration, level=0):
+  def row_col(blanket):
+    (rows, cols) = cell_keys.gridShape(blanket)
+    if configuration.cell_key == "rowmajor":
+      return ("floor(cell / %d)" % cols, "pmod(cell, %d)" % cols)
+    bits = max(1, (max(rows, cols) - 1).bit_length())
+    def decode(offset):
+      return "(" + " + ".join("pmod(floor(cell / %d), 2) * %d" % (2 ** (2 * bit + offset), 2 ** bit) for bit in range(bits)) + ")"
+    return (decode(1), decode(0))
+  (x, y) = ([], [])
+  for (k, blanket) in enumerate(configuration.levelBlankets(level)):
+    (row, col) = row_col(blanket)
+    x.append("WHEN %d THEN printf('%%.%df', (%d + %s + 0.5) * %r)" % (k, cell_keys.centreDecimals(blanket[5]), blanket[7], row, blanket[5]))
+    y.append("WHEN %d THEN printf('%%.%df', (%d + %s + 0.5) * %r)" % (k, cell_keys.centreDecimals(blanket[6]), blanket[9], col, blanket[6]))
+  return ("CASE blanket " + " ".join(x) + " END", "CASE blanket " + " ".join(y) + " END")
+
+#
+# HQL (re)creating the aggregate tables selected by aggregation_output and
+# the INSERT clauses filling them from a source with the columns
+# blanket,cell,dt,value,velocity_sum,velocity,direction,direction_sin_sum,direction_cos_sum
+# (and level, direction_sum for the levels of a pyramid or rollup run).
+# suffix is appended to the table names, level picks the rows of one pyramid
+# level and dt, when given, is the coarser time bucket the rows are summed
+# up into.  The tables get the cell centre as x, y in front and keep the
+# blanket and cell key next to dt.
+#
+def intersection_outputs(configuration, suffix="", level=None, dt=None):
+  columns = dict((name, name) for name in ["value", "velocity_sum", "velocity", "direction", "direction_sin_sum", "direction_cos_sum", "dt"])
+  (x, y) = cell_centre_hql(configuration, level or 0)
+  clauses = ""
+  if level is not None:
+    clauses += """
+    WHERE level = """ + str(level)
+  if dt is not None:
+    columns = {"value": "sum(value)", "velocity_sum": "sum(velocity_sum)", "velocity": "sum(velocity_sum) / sum(value)",
+               "direction": "sum(direction_sum) / sum(value)", "direction_sin_sum": "sum(direction_sin_sum)",
+               "direction_cos_sum": "sum(direction_cos_sum)", "dt": dt}
+    clauses += """
+    GROUP BY blanket,cell,""" + dt
+  def table(name):
+    return configuration.database_name + """.micro_path_intersect_""" + name + "_" + configuration.table_name + suffix
+  def select(names):
+    return """
+    SELECT """ + x + """ AS x,""" + y + """ AS y,""" + ",".join(columns[name] for name in names[:-1]) + """,blanket,cell,""" + columns[names[-1]] + clauses
+
+  tables = []
+  outputs = []
+  if configuration.aggregation_output in ("split", "both"):
+    tables.append(new_hive_table_hql(configuration.database_name,"micro_path_intersect_counts_" + configuration.table_name + suffix,"x string, y string, value int, blanket int, cell bigint, dt string"))
+    tables.append(new_hive_table_hql(configuration.database_name,"micro_path_intersect_velocity_" + configuration.table_name + suffix,"x string, y string, velocity float, blanket int, cell bigint, dt string"))
+    tables.append(new_hive_table_hql(configuration.database_name,"micro_path_intersect_direction_" + configuration.table_name + suffix,"x string, y string, direction int, blanket int, cell bigint, dt string"))
+    outputs.append("""
+    INSERT OVERWRITE TABLE """ + table("counts") + select(["value", "dt"]) + """
+    INSERT OVERWRITE TABLE """ + table("velocity") + select(["velocity", "dt"]) + """
+    INSERT OVERWRITE TABLE """ + table("direction") + select(["direction", "dt"]))
+  if configuration.aggregation_output in ("wide", "both"):
+    table_schema = "x string, y string, value int, velocity_sum double, velocity float, direction int, direction_sin_sum double, direction_cos_sum double, blanket int, cell bigint, dt string"
+    tables.append(new_hive_table_hql(configuration.database_name,"micro_path_intersect_stats_" + configuration.table_name + suffix,table_schema))
+    outputs.append("""
+    INSERT OVERWRITE TABLE """ + table("stats") + select(["value", "velocity_sum", "velocity", "direction", "direction_sin_sum", "direction_cos_sum", "dt"]))
+  return ("".join(tables), "".join(outputs))
+
+#
+# take values form micro_path_tripline_bins and aggregate counts, velocity and
+# direction in a single scan.  Depending on aggregation_output the results go
+# to the three micro_path_intersect_{counts,velocity,direction} tables (split),
+# to one micro_path_intersect_stats table (wide) or to both.
+#
+def aggregate_intersections_hql(configuration, reducers):
+  if len(configuration.outputLevels()) > 1:
+    return aggregate_levels_hql(configuration, reducers)
+  (tables, outputs) = intersection_outputs(configuration)
+  return tables + """
+    """ + reducers + """
+
+    FROM (
+      SELECT blanket,cell,dt,
+        sum(coalesce(crossings, 1)) AS value,
+        sum(velocity) AS velocity_sum,
+        sum(velocity) / sum(coalesce(crossings, 1)) AS velocity,
+        sum(direction) / sum(coalesce(crossings, 1)) AS direction,
+        sum(coalesce(direction_sin, sin(radians(direction)))) AS direction_sin_sum,
+        sum(coalesce(direction_cos, cos(radians(direction)))) AS direction_cos_sum
+      FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
+      GROUP BY blanket,cell,dt
+    ) agg
+    """ + outputs + """
+    ;
     """
-  subprocessCall(["hive","-e",hql_script])
-  
-def aggregate_intersection_velocity(configuration):
-  table_schema ="x string, y string, velocity float, dt string"
-  create_new_hive_table(configuration.database_name,"micro_path_intersect_velocity_" + configuration.table_name,table_schema)
 
-  #hadoop streaming to extract paths
-  hql_script = """
-    set mapred.map.tasks=96;
-    set mapred.reduce.tasks=96;
-    
-    INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_intersect_velocity_""" + configuration.table_name + """
-    SELECT intersectX,intersectY,avg(velocity),dt
-    FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
-    GROUP BY intersectX,intersectY,dt
-    ;   
+#
+# Aggregation of a pyramid or rollup run.  The crossings are summed per
+# level, cell and temporal_split bucket once; every level is written to its
+# own tables (see AggregateMicroPathConfig.outputLevels) and the coarser
+# rollup_splits buckets are summed up from those fine aggregates, using the
+# bucket labels tripline_bins.py put in rollup_dts.
+#
+def aggregate_levels_hql(configuration, reducers):
+  tables = []
+  outputs = []
+  for (level, split, suffix) in configuration.outputLevels():
+    dt = None
+    if split != configuration.temporal_split:
+      dt = "split(rollup_dts, ',')[" + str(configuration.rollup_splits.index(split)) + "]"
+    (level_tables, level_outputs) = intersection_outputs(configuration, suffix, level, dt)
+    tables.append(level_tables)
+    outputs.append(level_outputs)
+  return "".join(tables) + """
+    """ + reducers + """
+
+    FROM (
+      SELECT coalesce(level, 0) AS level,blanket,cell,dt,rollup_dts,
+        sum(coalesce(crossings, 1)) AS value,
+        sum(velocity) AS velocity_sum,
+        sum(velocity) / sum(coalesce(crossings, 1)) AS velocity,
+        sum(direction) AS direction_sum,
+        sum(direction) / sum(coalesce(crossings, 1)) AS direction,
+        sum(coalesce(direction_sin, sin(radians(direction)))) AS direction_sin_sum,
+        sum(coalesce(direction_cos, cos(radians(direction)))) AS direction_cos_sum
+      FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
+      GROUP BY coalesce(level, 0),blanket,cell,dt,rollup_dts
+    ) agg
+    """ + "".join(outputs) + """
+    ;
     """
-  subprocessCall(["hive","-e",hql_script]) 
-                    
-def aggregate_intersection_direction(configuration):
-  table_schema ="x string, y string, direction int, dt string"
-  create_new_hive_table(configuration.database_name,"micro_path_intersect_direction_" + configuration.table_name,table_schema)
 
-  #hadoop streaming to extract paths
-  hql_script = """
-    set mapred.map.tasks=96;
-    set mapred.reduce.tasks=96;
-    
-    INSERT OVERWRITE TABLE """ + configuration.database_name + """.micro_path_intersect_direction_""" + configuration.table_name + """
-    SELECT intersectX,intersectY,avg(direction),dt
-    FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
-    GROUP BY intersectX,intersectY,dt
-    ;   
+#
+# Run the stages (stage_dag.Stage) in hive, chains of dependent stages as one
+# hive session and independent ones side by side.  Every session is timed in
+# the summary with the counters of the jobs it started.  Exits on errors.
+#
+def run_stages(configuration, stages, summary):
+  def execute(name, hql_script):
+    print("running " + name)
+    jobs = []
+    started = time()
+    process = subprocess.Popen(["hive","-e",hql_script],stderr=subprocess.PIPE)
+    watchHiveOutput(process.stderr, jobs)
+    returnCode = process.wait()
+    summary.record(name, started, time() - started, jobs)
+    if 0 != returnCode:
+      print "Error executing hive session " + name + ":\n"
+      print hql_script
+    return 0 == returnCode
+
+  completed = runStages(stages, execute, configuration.max_parallel_stages, configuration.batch_stages)
+  if len(completed) != len(stages):
+    exit(1)
+
+#
+# Stages of a full hive run.  Every stage is fingerprinted with its
+# generated hql, the scripts it ships, the config values those scripts read
+# (the hql doesn't show them) and the fingerprint of its input: the state of
+# the source table for extract_paths, the upstream stage for the others.
+# Changing the blankets or temporal_split thus keeps the extracted paths,
+# changing the source table or time_filter reruns all.
+#
+EXTRACT_KEYS = ["time_filter", "distance_filter", "velocity_filter", "date_from", "date_to", "simplify_tolerance"]
+# what the track compression of extract_paths depends on besides EXTRACT_KEYS
+COMPRESSION_KEYS = ["triplineBlankets", "temporal_split", "pyramid_levels"]
+TRIPLINE_KEYS = ["triplineBlankets", "temporal_split", "tripline_combine_size", "pyramid_levels", "rollup_splits", "geometry_kernel", "cell_key"]
+SKETCH_KEYS = ["hll_precision", "tdigest_compression"]
+SOURCE_STATE = ["numFiles", "numRows", "totalSize", "rawDataSize", "transient_lastDdlTime", "partitions"]
+
+def config_values(configuration, keys):
+  return dict((key, getattr(configuration, key)) for key in keys)
+
+#
+# digest of the files the ADD FILES lines of an hql ship, but the config
+# files, whose values are fingerprinted by key
+#
+def shipped_digest(configuration, hql):
+  config = config_files(configuration).split()
+  paths = []
+  for line in hql.splitlines():
+    line = line.strip()
+    if line.startswith("ADD FILES "):
+      paths += [path for path in line[len("ADD FILES "):].rstrip(";").split() if path not in config[1:]]
+  return fileDigest(paths)
+
+def stage_fingerprint(configuration, name, upstream, hql, *parts):
+  return fingerprint(name, upstream, hql, shipped_digest(configuration, hql), *parts)
+
+def aggregate_tables(configuration):
+  tables = []
+  if configuration.aggregation_output in ("split", "both"):
+    tables += ["micro_path_intersect_counts", "micro_path_intersect_velocity", "micro_path_intersect_direction"]
+  if configuration.aggregation_output in ("wide", "both"):
+    tables.append("micro_path_intersect_stats")
+  return [incremental_table(configuration, table) + suffix for (level, split, suffix) in configuration.outputLevels() for table in tables]
+
+def hive_output_tables(configuration):
+  return [incremental_table(configuration, "micro_path_track_extract"),
+          incremental_table(configuration, "micro_path_tripline_bins")] + aggregate_tables(configuration) + sketch_tables(configuration)
+
+def hive_stages(configuration, source, plan=None):
+  input_bytes = long(source["totalSize"]) if source.get("totalSize", "").isdigit() else None
+  compression = config_values(configuration, COMPRESSION_KEYS) if configuration.simplify_tolerance > 0 else None
+  # the split tracks don't change the extracted paths, the fingerprint is
+  # that of the plain extraction
+  plain_extract_hql = extract_paths_hql(configuration, reducer_settings(configuration, input_bytes))
+  tripline_hql = extract_trip_line_intersects_hql(configuration)
+  aggregate_hql = aggregate_intersections_hql(configuration, reducer_settings(configuration))
+  sketches_hql = aggregate_sketches_hql(configuration, reducer_settings(configuration))
+  extract = stage_fingerprint(configuration, "extract_paths", dict((key, source.get(key)) for key in SOURCE_STATE), plain_extract_hql,
+                              config_values(configuration, EXTRACT_KEYS), compression)
+  tripline = stage_fingerprint(configuration, "tripline_intersects", extract, tripline_hql, config_values(configuration, TRIPLINE_KEYS))
+  aggregate = stage_fingerprint(configuration, "aggregate_intersections", tripline, aggregate_hql)
+  sketches = stage_fingerprint(configuration, "aggregate_sketches", tripline, sketches_hql, config_values(configuration, SKETCH_KEYS))
+  # the extract reducers are sized from the statistics of the source table,
+  # the later stages read tables made in the same run
+  if plan:
+    extract_hql = extract_split_paths_hql(configuration, reducer_settings(configuration, input_bytes), plan)
+  else:
+    extract_hql = plain_extract_hql
+  stages = [Stage("extract_paths", extract_hql,
+                  outputs=[incremental_table(configuration, "micro_path_track_extract")], fingerprint=extract),
+            # emit points where segemnts intersect with trip line blankets
+            Stage("tripline_intersects", tripline_hql, ["extract_paths"],
+                  outputs=[incremental_table(configuration, "micro_path_tripline_bins")], fingerprint=tripline),
+            # aggregate intersection points, velocity and direction in one pass
+            Stage("aggregate_intersections", aggregate_hql, ["tripline_intersects"],
+                  outputs=aggregate_tables(configuration), fingerprint=aggregate)]
+  if configuration.cell_sketches:
+    # distinct tracks and velocity quantiles, side by side with the aggregation
+    stages.append(Stage("aggregate_sketches", sketches_hql, ["tripline_intersects"],
+                        outputs=sketch_tables(configuration), fingerprint=sketches))
+  return stages
+
+#
+# Incremental runs.
+#
+# Only the partitions of the source table that are not yet listed in
+# micro_path_partitions_<table> are read.  The last fix every track ended on
+# (see extractSegments) is kept in micro_path_track_checkpoint_<table> and fed
+# back in front of the new rows, so the segment spanning two batches is still
+# produced.  Running sums per cell live in micro_path_intersect_sums_<table>,
+# the new crossings are merged into them and the aggregate tables are
+# rewritten from the sums.  The first run finds no processed partitions and
+# covers the whole table.
+#
+def incremental_table(configuration, name):
+  return configuration.database_name + "." + name + "_" + configuration.table_name
+
+#
+# partitions of the source table that haven't been processed yet, as
+# SHOW PARTITIONS prints them (e.g. ds=2016-01-01 or year=2016/month=01).
+# The bookkeeping tables are created on the first run, all in one session.
+# Sums kept by x, y from before the integer cell keys can't be merged with
+# the new crossings, the incremental state has to be rebuilt then.
+#
+def new_partitions(configuration):
+  sums = incremental_table(configuration, "micro_path_intersect_sums")
+  lines = hiveQuery("""
+    CREATE TABLE IF NOT EXISTS """ + incremental_table(configuration, "micro_path_partitions") + """ ( name string );
+    CREATE TABLE IF NOT EXISTS """ + incremental_table(configuration, "micro_path_track_checkpoint") + """ ( id string, dt string, lat string, lon string );
+    CREATE TABLE IF NOT EXISTS """ + sums + """ ( blanket int, cell bigint, dt string, value bigint, velocity_sum double, direction_sum double, direction_sin_sum double, direction_cos_sum double );
+    DESCRIBE """ + sums + """;
+    SHOW PARTITIONS """ + configuration.database_name + "." + configuration.table_name + """;
+    SELECT concat('done:', name) FROM """ + incremental_table(configuration, "micro_path_partitions") + """;
+    """)
+  # DESCRIBE prints a column and its type per line, partition names have no blanks
+  columns = set(line.split()[0] for line in lines if len(line.split()) > 1)
+  lines = [line for line in lines if len(line.split()) == 1]
+  if "cell" not in columns:
+    raise ValueError(sums + " keeps the cells by x, y, drop it and the " + incremental_table(configuration, "micro_path_partitions") +
+                     " and " + incremental_table(configuration, "micro_path_track_checkpoint") + " tables to start over")
+  done = set(line[len("done:"):] for line in lines if line.startswith("done:"))
+  return [line for line in lines if not line.startswith("done:") and line not in done]
+
+#
+# WHERE clause matching the given partitions
+#
+def partition_predicate(partitions):
+  clauses = []
+  for partition in partitions:
+    terms = []
+    for spec in partition.split("/"):
+      (column, value) = spec.split("=", 1)
+      terms.append(column + "=" + hql_string(urllib.unquote(value)))
+    clauses.append("(" + " AND ".join(terms) + ")")
+  return "\n        OR ".join(clauses)
+
+#
+# extract the segments of the new partitions, continuing every track from its
+# checkpoint, and write the new checkpoints to micro_path_track_checkpoint_next.
+# Checkpoints of tracks without new rows pass through the script unchanged,
+# unless they are more than time_filter older than the newest new fix of
+# the reducer (see CheckpointPruner in extract_path_segments.py).
+#
+def extract_paths_incremental_hql(conf, partitions, reducers):
+  table_schema = "id string, alat string, blat string, alon string, blon string, adt bigint, bdt bigint, time string, distance string, velocity string"
+
+  # checkpoints sort in front of the new rows of their track (batch 0)
+  return new_hive_table_hql(conf.database_name,"micro_path_track_extract_" + conf.table_name,table_schema) + \
+    new_hive_table_hql(conf.database_name,"micro_path_track_checkpoint_next_" + conf.table_name,"id string, dt string, lat string, lon string") + """
+    """ + reducers + """
+
+    ADD FILES """ + config_files(conf) + """ scripts/extract_path_segments.py scripts/tripline_vector.py scripts/timestamps.py scripts/counters.py;
+    FROM(
+      SELECT TRANSFORM(map_out.id, map_out.dt, map_out.lat, map_out.lon, map_out.batch)
+      USING \"python extract_path_segments.py --checkpoints """ + conf.config_file + """\"
+      AS kind,id,alat,blat,alon,blon,adt,bdt,time,distance,velocity
+      FROM(
+        SELECT id, dt, lat, lon, batch
+        FROM(
+          SELECT id, dt, lat, lon, 0 AS batch
+          FROM """ + incremental_table(conf, "micro_path_track_checkpoint") + """
+          UNION ALL
+          SELECT CAST("""+conf.table_schema_id+""" AS STRING) AS id, CAST("""+conf.table_schema_dt+""" AS STRING) AS dt,
+            CAST("""+conf.table_schema_lat+""" AS STRING) AS lat, CAST("""+conf.table_schema_lon+""" AS STRING) AS lon, 1 AS batch
+          FROM """ + conf.database_name + """.""" + conf.table_name + """
+          WHERE (""" + partition_predicate(partitions) + """)
+          AND """ + source_predicates(conf) + """
+        ) fixes
+        DISTRIBUTE BY id
+        SORT BY id, batch, dt asc
+      ) map_out
+    ) extracted
+
+    INSERT OVERWRITE TABLE """ + conf.database_name + """.micro_path_track_extract_""" + conf.table_name + """
+    SELECT id,alat,blat,alon,blon,adt,bdt,time,distance,velocity WHERE kind = 'segment'
+    INSERT OVERWRITE TABLE """ + conf.database_name + """.micro_path_track_checkpoint_next_""" + conf.table_name + """
+    SELECT id,time,alat,alon WHERE kind = 'checkpoint'
+    ;
+  """
+
+#
+# merge the crossings of the batch with the running sums into
+# micro_path_intersect_sums_next and rewrite the aggregate tables from it.
+# micro_path_partitions_next, the done list with the partitions of the
+# batch, is made last: once it exists the batch is complete and can be
+# committed.
+#
+def merge_intersections_hql(configuration, partitions, reducers):
+  (tables, outputs) = intersection_outputs(configuration)
+  done = incremental_table(configuration, "micro_path_partitions")
+  return """
+    DROP TABLE IF EXISTS """ + incremental_table(configuration, "micro_path_partitions_next") + """;""" + new_hive_table_hql(configuration.database_name,"micro_path_intersect_sums_next_" + configuration.table_name,
+                            "blanket int, cell bigint, dt string, value bigint, velocity_sum double, direction_sum double, direction_sin_sum double, direction_cos_sum double") + """
+    """ + reducers + """
+
+    INSERT OVERWRITE TABLE """ + incremental_table(configuration, "micro_path_intersect_sums_next") + """
+    SELECT blanket,cell,dt,sum(value),sum(velocity_sum),sum(direction_sum),sum(direction_sin_sum),sum(direction_cos_sum)
+    FROM (
+      SELECT blanket,cell,dt,value,velocity_sum,direction_sum,direction_sin_sum,direction_cos_sum
+      FROM """ + incremental_table(configuration, "micro_path_intersect_sums") + """
+      UNION ALL
+      SELECT blanket,cell,dt,
+        coalesce(crossings, 1) AS value,
+        velocity AS velocity_sum,
+        direction AS direction_sum,
+        coalesce(direction_sin, sin(radians(direction))) AS direction_sin_sum,
+        coalesce(direction_cos, cos(radians(direction))) AS direction_cos_sum
+      FROM """ + configuration.database_name + """.micro_path_tripline_bins_""" + configuration.table_name + """
+    ) merged
+    GROUP BY blanket,cell,dt
+    ;
+    """ + tables + """
+
+    FROM (
+      SELECT blanket,cell,dt,value,velocity_sum,
+        velocity_sum / value AS velocity,
+        direction_sum / value AS direction,
+        direction_sin_sum,direction_cos_sum
+      FROM """ + incremental_table(configuration, "micro_path_intersect_sums_next") + """
+    ) agg
+    """ + outputs + """
+    ;
+
+    CREATE TABLE """ + incremental_table(configuration, "micro_path_partitions_next") + """ AS
+    SELECT name FROM (
+      SELECT name FROM """ + done + """
+      UNION ALL
+      SELECT explode(array(""" + ", ".join(hql_string(partition) for partition in partitions) + """)) AS name
+    ) names
+    ;
     """
-  subprocessCall(["hive","-e",hql_script]) 
+
+# the tables a commit swaps for their _next version, the done list last
+COMMITTED_TABLES = ["micro_path_intersect_sums", "micro_path_track_checkpoint", "micro_path_partitions"]
+
+#
+# make the new sums, checkpoints and done list current.  When the session
+# dies half way finish_commit swaps the rest at the start of the next run.
+#
+def commit_incremental_hql(configuration, names=COMMITTED_TABLES):
+  statements = []
+  for name in names:
+    statements.append("DROP TABLE IF EXISTS " + incremental_table(configuration, name) + ";")
+    statements.append("ALTER TABLE " + incremental_table(configuration, name + "_next") + " RENAME TO " + incremental_table(configuration, name) + ";")
+  return "\n".join(statements)
+
+#
+# finish the commit of an earlier run that stopped after its merge: while
+# micro_path_partitions_next exists the tables whose _next is still there
+# are swapped in.  Returns their names.
+#
+def finish_commit(configuration):
+  tables = set(line.lower() for line in hiveQuery("SHOW TABLES IN " + configuration.database_name + ";"))
+  pending = [name for name in COMMITTED_TABLES if (name + "_next_" + configuration.table_name).lower() in tables]
+  if "micro_path_partitions" not in pending:
+    return []
+  hiveQuery(commit_incremental_hql(configuration, pending))
+  return pending
+
+def run_incremental(configuration, summary):
+  if len(configuration.outputLevels()) > 1:
+    raise ValueError("pyramid_levels and rollup_splits are not supported by incremental runs")
+  if configuration.cell_sketches:
+    print("cell_sketches are not supported by incremental runs, the sketch tables are left as they are")
+  if configuration.skew_chunk_fixes > 0:
+    print("skew_chunk_fixes is not supported by incremental runs, the tracks are extracted in one piece")
+  recovered = summary.stage("finish_commit", finish_commit, configuration)
+  if recovered:
+    print("finished the commit of the previous run: " + ", ".join(recovered))
+  partitions = summary.stage("new_partitions", new_partitions, configuration)
+  if not partitions:
+    print("no new partitions in " + configuration.database_name + "." + configuration.table_name)
+    return
+  print("processing " + str(len(partitions)) + " new partitions: " + ", ".join(partitions))
+  summary.document["partitions"] = partitions
+
+  # the new partitions have no table statistics of their own, hive sizes the
+  # reducers from the files it reads
+  stages = [Stage("extract_paths", extract_paths_incremental_hql(configuration, partitions, reducer_settings(configuration))),
+            Stage("tripline_intersects", extract_trip_line_intersects_hql(configuration), ["extract_paths"]),
+            Stage("merge_intersections", merge_intersections_hql(configuration, partitions, reducer_settings(configuration)), ["tripline_intersects"]),
+            Stage("commit", commit_incremental_hql(configuration), ["merge_intersections"])]
+  run_stages(configuration, stages, summary)
+
+#
+# write the aggregate tables as binary grids (see raster_export.py), read
+# from the local run output in source or from hive
+#
+def export_grids(configuration, export_dir, summary, source=None):
+  import raster_export
+  print("exporting grids to " + export_dir)
+  manifest = summary.stage("export", raster_export.export, configuration, export_dir, source)
+  summary.addCounters("micro_path_export", {"grids": len(manifest), "cells": sum(entry["nnz"] for entry in manifest)})
+
+#
+# rebuild the query store (see cell_store.py) from the new tables, a
+# running cell_store.py serve picks the new generation up on its next query
+#
+def build_store(configuration, store_dir, summary, source=None):
+  import cell_store
+  print("indexing cells into " + store_dir)
+  manifest = summary.stage("store", cell_store.buildStore, configuration, store_dir, source)
+  summary.addCounters("micro_path_store", {"tables": len(manifest["tables"]),
+                                           "records": sum(table["records"] for table in manifest["tables"].values())})
 
 #
 # 
 #
-def main(config_file):
+def main(config_file, local=False, input_paths=None, output_dir="output", processes=None, incremental=False, stream=None, force=False, export_dir=None, store_dir=None):
  
-  start_time = time()
-  print('Start time: ' + str(start_time))
+  print('Start time: ' + str(time()))
   print("Loading config from conf/[{0}]").format(config_file)
   configuration = AggregateMicroPathConfig(config_file, "conf/")
  
+  if stream:
+    import stream_engine
+    summary = RunSummary(configuration, "stream")
+    counts = summary.stage("stream", stream_engine.run, configuration, stream, output_dir)
+    summary.addCounters("micro_path_stream", counts)
+    print(summary.finish(output_dir))
+    return
+
+  if local:
+    import local_engine
+    summary = RunSummary(configuration, "local")
+    tables = local_engine.run(configuration, input_paths, output_dir, processes, summary=summary)
+    for table in sorted(tables):
+      print("wrote " + tables[table])
+    if export_dir:
+      export_grids(configuration, export_dir, summary, output_dir)
+    if store_dir:
+      build_store(configuration, store_dir, summary, output_dir)
+    print(summary.finish(output_dir))
+    return
  
-  print("extracting path data")
-  # create a new table and extract path data
-  extract_paths(configuration)
-  
-  # emit points where segemnts intersect with trip line blankets
-  print("emit trip line blanket intersects")
-  extract_trip_line_intersects(configuration)
+  if incremental:
+    configuration.freeze("conf/")
+    summary = RunSummary(configuration, "incremental")
+    run_incremental(configuration, summary)
+    if export_dir:
+      export_grids(configuration, export_dir, summary)
+    if store_dir:
+      build_store(configuration, store_dir, summary)
+    print(summary.finish(output_dir))
+    return
 
-  # aggregate intersection points
-  print ("aggregate intersection points")
-  aggregate_intersection_points(configuration)
-  
-  # aggregate intersection velocity
-  print ("aggregate intersection velocity")
-  aggregate_intersection_velocity(configuration)
-  
-  # aggregate intersection vdirection
-  print ("aggregate intersection direction")
-  aggregate_intersection_direction(configuration)
+  # the scripts of every stage load this instead of parsing the .ini
+  configuration.freeze("conf/")
+  summary = RunSummary(configuration, "hive")
+  source_table = configuration.database_name + "." + configuration.table_name
+  tables = [source_table] + hive_output_tables(configuration)
+  # the state of the source table and the fingerprints left by earlier runs
+  properties = summary.stage("table_properties", table_properties, tables)
+  summary.document["source_stats"] = properties[source_table]
+  stages = hive_stages(configuration, properties[source_table])
+  if not force:
+    recorded = dict((table, properties[table].get(FINGERPRINT_PROPERTY)) for table in tables)
+    (stages, skipped) = cachedStages(stages, recorded)
+    summary.document["skipped"] = skipped
+    for name in skipped:
+      print("skipping " + name + ", its config and input are unchanged")
+  if configuration.skew_chunk_fixes > 0 and "extract_paths" in [stage.name for stage in stages]:
+    # the split tracks don't change the extracted paths, nor the fingerprints
+    plan = summary.stage("skew_sample", hot_tracks, configuration)
+    summary.document["split_tracks"] = dict((track, len(boundaries) + 1) for (track, boundaries) in plan.items())
+    if plan:
+      print("splitting " + str(len(plan)) + " tracks into chunks")
+      split = dict((stage.name, stage) for stage in hive_stages(configuration, properties[source_table], plan))
+      for stage in stages:
+        stage.hql = split[stage.name].hql
+  run_stages(configuration, stages, summary)
+  if export_dir:
+    export_grids(configuration, export_dir, summary)
+  if store_dir:
+    build_store(configuration, store_dir, summary)
 
-  print('End time: ' + str(time() - start_time))
+  # per stage timing and counters, also written to the output directory
+  print(summary.finish(output_dir))
 
 
 #
@@ -238,12 +933,51 @@ if __name__ == "__main__":
   parser.add_option("-c","--config",
                        dest="configFile",
                        help="REQUIRED: name of configuration file")
+  parser.add_option("--local",
+                       dest="local",
+                       action="store_true",
+                       default=False,
+                       help="run every stage in-process on local files instead of in hive")
+  parser.add_option("-i","--input",
+                       dest="inputFiles",
+                       action="append",
+                       help="local TSV/CSV input file, may be repeated (with --local)")
+  parser.add_option("-o","--output",
+                       dest="outputDir",
+                       default="output",
+                       help="directory for the local output tables (with --local or --stream) and the run summary")
+  parser.add_option("-p","--processes",
+                       dest="processes",
+                       type="int",
+                       help="number of worker processes (with --local), defaults to the number of cores")
+  parser.add_option("--incremental",
+                       dest="incremental",
+                       action="store_true",
+                       default=False,
+                       help="only process source partitions not seen by earlier incremental runs and merge them into the existing tables")
 
   
 
+  parser.add_option("--force",
+                       dest="force",
+                       action="store_true",
+                       default=False,
+                       help="rerun every hive stage, even those whose config and input fingerprint is unchanged")
+  parser.add_option("--export",
+                       dest="exportDir",
+                       help="also write the aggregate tables as memory mapped raster / sparse coo grids to this directory (see raster_export.py)")
+  parser.add_option("--store",
+                       dest="storeDir",
+                       help="also index the aggregate tables into the local query store in this directory (see cell_store.py)")
+  parser.add_option("--stream",
+                       dest="stream",
+                       help="aggregate a live feed of id, dt, lat, lon reports into sliding window snapshots: - for stdin, tcp://host:port or a file to follow")
+
   (options,args) = parser.parse_args()
 
   if not options.configFile:
     printUsageAndExit(parser)
+  if options.local and not options.inputFiles:
+    printUsageAndExit(parser)
 
-  main(options.configFile)
+  main(options.configFile, options.local, options.inputFiles, options.outputDir, options.processes, options.incremental, options.stream, options.force, options.exportDir, options.storeDir)
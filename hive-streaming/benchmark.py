@@ -0,0 +1,327 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Throughput benchmark of the pipeline stages on synthetic tracks.
+#
+# The tracks of synthetic_ais.py are pushed through the extract
+# (extract_path_segments), tripline (tripline_bins) and aggregate (local
+# engine per cell sums) stages for every combination of blanket resolution,
+# temporal_split and tripline engine.  Each stage runs in a forked process so
+# its peak memory can be read from getrusage.  Results are written as JSON
+# (or TSV when the output name ends in .tsv); --baseline compares the rates
+# with an earlier result file and fails on slowdowns beyond --tolerance.
+# rows are input rows of a stage (segments for tripline, crossings for
+# aggregate), crossings are its output rows (segments for extract).
+#
+# --startup N times the start of the hive TRANSFORM scripts instead: each
+# one is started N times on empty input in a directory laid out like a hive
+# task's, with only the .ini and with the frozen config next to it.
+#
+# --check compares the crossings of the reference and vector tripline
+# engines instead, row for row, for every resolution and temporal_split and
+# with the blankets at the first and last resolution side by side, and fails
+# on any difference.  The tracks come from a fixed seed, so a run is the
+# same check every time.
+#
+#   python benchmark.py -c ais.ini --ids 500 --points 400 -r 0.1,0.01 -s hour,day -o bench.json
+#   python benchmark.py -c ais.ini --startup 50 -o startup.json
+#   python benchmark.py -c ais.ini --check -r 0.1,0.01,0.001
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import platform
+import resource
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from config import AggregateMicroPathConfig, tripLineBlanket
+import synthetic_ais
+
+RESULT_COLUMNS = ["stage", "engine", "resolution", "temporal_split", "rows", "crossings", "seconds",
+                  "rows_per_second", "crossings_per_second", "peak_rss_kb", "stage_rss_kb"]
+
+# inputs of the stage that is being measured, set before forking
+_inputs = {}
+# the hive TRANSFORM scripts and their arguments in front of the config
+STARTUP_SCRIPTS = [("extract_path_segments.py", []), ("tripline_bins.py", []), ("cell_sketches.py", ["map"])]
+
+
+def peakRSS():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+#
+# the configuration with every blanket at the given resolution
+#
+def withResolution(configuration, temporal_split, resolution, engine):
+  configuration.temporal_split = temporal_split
+  configuration.tripline_engine = engine
+  if resolution is not None:
+    configuration.triplineBlankets = [tripLineBlanket(b[0], b[1], b[2], b[3], b[4], resolution, resolution) for b in configuration.triplineBlankets]
+  return configuration
+
+
+def extractStage(configuration):
+  import extract_path_segments
+  segments = 0
+  for segment in extract_path_segments.extractSegments(configuration, iter(_inputs["rows"])):
+    segments += 1
+  return (len(_inputs["rows"]), segments)
+
+
+def triplineStage(configuration):
+  import tripline_bins
+  crossings = 0
+  for out in tripline_bins.triplineCrossings(configuration, iter(_inputs["segments"])):
+    crossings += 1
+  return (len(_inputs["segments"]), crossings)
+
+
+def aggregateStage(configuration):
+  import local_engine
+  aggregates = {}
+  for crossing in _inputs["crossings"]:
+    local_engine.addCrossing(aggregates, (int(crossing[0]), int(crossing[1]), crossing[2]) + tuple(crossing[6:]), float(crossing[3]), float(crossing[4]))
+  return (len(_inputs["crossings"]), len(_inputs["crossings"]))
+
+
+#
+# run stage(configuration) in a forked process, returns
+# (rows, crossings, seconds, peak rss, rss added by the stage)
+#
+def measure(stage, configuration):
+  def child(queue):
+    baseline = peakRSS()
+    start = time.time()
+    (rows, crossings) = stage(configuration)
+    seconds = time.time() - start
+    queue.put((rows, crossings, seconds, peakRSS(), peakRSS() - baseline))
+
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=child, args=(queue,))
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+
+def result(stage, engine, resolution, temporal_split, measured):
+  (rows, crossings, seconds, peak, added) = measured
+  return {"stage": stage, "engine": engine, "resolution": resolution, "temporal_split": temporal_split,
+          "rows": rows, "crossings": crossings, "seconds": seconds,
+          "rows_per_second": rows / seconds if seconds > 0 else None,
+          "crossings_per_second": crossings / seconds if seconds > 0 else None,
+          "peak_rss_kb": peak, "stage_rss_kb": added}
+
+
+def runBenchmarks(configuration, generator, resolutions, splits, engines, repeat=1):
+  import extract_path_segments
+  import tripline_bins
+
+  rows = list(generator.rows())
+  segments = [[s[1], s[3], s[2], s[4], s[5], s[6], s[9], s[0]] for s in extract_path_segments.extractSegments(configuration, iter(rows))]
+  results = []
+
+  _inputs["rows"] = rows
+  for i in range(repeat):
+    results.append(result("extract", None, None, None, measure(extractStage, configuration)))
+
+  _inputs["segments"] = segments
+  for resolution in resolutions:
+    for temporal_split in splits:
+      staged = withResolution(AggregateMicroPathConfig(configuration.config_file, "conf/"), temporal_split, resolution, configuration.tripline_engine)
+      for engine in engines:
+        staged.tripline_engine = engine
+        for i in range(repeat):
+          results.append(result("tripline", engine, resolution, temporal_split, measure(triplineStage, staged)))
+      _inputs["crossings"] = list(tripline_bins.triplineCrossings(staged, iter(segments)))
+      for i in range(repeat):
+        results.append(result("aggregate", None, resolution, temporal_split, measure(aggregateStage, staged)))
+  return results
+
+
+#
+# (resolutions, temporal_split, reference crossings, vector crossings, index
+# of the first differing crossing) of every case where the tripline engines
+# disagree, see --check
+#
+def engineMismatches(configuration, generator, resolutions, splits):
+  import extract_path_segments
+  import tripline_bins
+
+  segments = [[s[1], s[3], s[2], s[4], s[5], s[6], s[9], s[0]] for s in extract_path_segments.extractSegments(configuration, generator.rows())]
+  cases = [[resolution] for resolution in resolutions]
+  if len(set(resolutions)) > 1:
+    cases.append([resolutions[0], resolutions[-1]])
+  mismatches = []
+  for case in cases:
+    for temporal_split in splits:
+      crossings = []
+      for engine in ("reference", "vector"):
+        staged = withResolution(AggregateMicroPathConfig(configuration.config_file, "conf/"), temporal_split, None, engine)
+        if case != [None]:
+          staged.triplineBlankets = [tripLineBlanket(b[0], b[1], b[2], b[3], b[4], r, r) for r in case for b in staged.triplineBlankets]
+        crossings.append(list(tripline_bins.triplineCrossings(staged, iter(segments))))
+      (reference, vector) = crossings
+      print("%-18s %-6s %9d crossings %s" % (",".join(str(r) for r in case), temporal_split, len(reference),
+                                            "same" if reference == vector else "DIFFERENT"))
+      if reference != vector:
+        first = next((i for (i, pair) in enumerate(zip(reference, vector)) if pair[0] != pair[1]), min(len(reference), len(vector)))
+        mismatches.append((case, temporal_split, len(reference), len(vector), first))
+  return mismatches
+
+
+#
+# Start time of the STARTUP_SCRIPTS with the .ini and the frozen config
+# (engine ini or frozen, stage the script).  rows and crossings are the
+# launches, peak_rss_kb the largest of any of them.
+#
+def startupBenchmarks(configuration, launches):
+  base = os.path.dirname(os.path.abspath(__file__))
+  task = tempfile.mkdtemp(prefix="startup_")
+  try:
+    # ADD FILES puts everything into the working directory of the task
+    for path in glob.glob(os.path.join(base, "scripts", "*.py")) + [os.path.join(base, "conf", "config.py"),
+                                                                    os.path.join(base, "conf", configuration.config_file)]:
+      shutil.copy(path, task)
+    results = []
+    with open(os.devnull, "r+") as devnull:
+      for config in ["ini", "frozen"]:
+        if config == "frozen":
+          configuration.freeze(task + "/")
+        for (script, args) in STARTUP_SCRIPTS:
+          command = [sys.executable, script] + args + [configuration.config_file]
+          start = time.time()
+          for i in range(launches):
+            subprocess.check_call(command, cwd=task, stdin=devnull, stdout=devnull, stderr=devnull)
+          seconds = time.time() - start
+          peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+          results.append(result(script[:-len(".py")], config, None, None, (launches, launches, seconds, peak, peak)))
+    return results
+  finally:
+    shutil.rmtree(task)
+
+
+def gitRevision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def writeResults(path, document):
+  with open(path, "w") as outfile:
+    if path.endswith(".tsv"):
+      outfile.write("\t".join(RESULT_COLUMNS) + "\n")
+      for row in document["results"]:
+        outfile.write("\t".join("" if row[column] is None else str(row[column]) for column in RESULT_COLUMNS) + "\n")
+    else:
+      json.dump(document, outfile, indent=2, sort_keys=True)
+      outfile.write("\n")
+
+
+def resultKey(row):
+  return (row["stage"], row["engine"], row["resolution"], row["temporal_split"])
+
+
+#
+# rates that dropped by more than tolerance against a baseline result file,
+# as (key, baseline rate, current rate)
+#
+def regressions(baseline, results, tolerance):
+  best = {}
+  for row in baseline["results"]:
+    if row["rows_per_second"]:
+      best[resultKey(row)] = max(best.get(resultKey(row), 0), row["rows_per_second"])
+  current = {}
+  for row in results:
+    if row["rows_per_second"]:
+      current[resultKey(row)] = max(current.get(resultKey(row), 0), row["rows_per_second"])
+  slower = []
+  for key in sorted(current):
+    if key in best and current[key] < best[key] * (1 - tolerance):
+      slower.append((key, best[key], current[key]))
+  return slower
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-c", "--config", dest="configFile", help="REQUIRED: name of configuration file in conf/")
+  parser.add_option("-r", "--resolutions", dest="resolutions", default="0.1,0.01",
+                    help="comma separated blanket resolutions, the config's own when empty")
+  parser.add_option("-s", "--splits", dest="splits", default="hour,day", help="comma separated temporal_split values")
+  parser.add_option("-e", "--engines", dest="engines", help="comma separated tripline engines, the config's own by default")
+  parser.add_option("--repeat", dest="repeat", type="int", default=1, help="runs of every measurement")
+  parser.add_option("-o", "--output", dest="output", default="benchmark.json", help="result file, .json or .tsv")
+  parser.add_option("--baseline", dest="baseline", help="earlier JSON result file to compare the rates with")
+  parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2,
+                    help="allowed slowdown against the baseline as a fraction")
+  parser.add_option("--startup", dest="startup", type="int", default=0,
+                    help="time this many starts of every hive script instead of the stage throughput")
+  parser.add_option("--check", dest="check", action="store_true", default=False,
+                    help="compare the crossings of the reference and vector tripline engines instead of timing them")
+  synthetic_ais.addGeneratorOptions(parser)
+  (options, args) = parser.parse_args()
+  if not options.configFile:
+    parser.print_help()
+    exit(1)
+
+  configuration = AggregateMicroPathConfig(options.configFile, "conf/")
+  generator = synthetic_ais.generatorFromOptions(options)
+  resolutions = [float(r) for r in options.resolutions.split(",") if r] or [None]
+  splits = [s for s in options.splits.split(",") if s]
+  engines = [e for e in options.engines.split(",") if e] if options.engines else [configuration.tripline_engine]
+
+  if options.check:
+    mismatches = engineMismatches(configuration, generator, resolutions, splits)
+    for (case, temporal_split, reference, vector, first) in mismatches:
+      print("engines differ at %s %s: %d reference and %d vector crossings, first difference at crossing %d" % (
+        ",".join(str(r) for r in case), temporal_split, reference, vector, first))
+    exit(1 if mismatches else 0)
+
+  if options.startup > 0:
+    results = startupBenchmarks(configuration, options.startup)
+  else:
+    results = runBenchmarks(configuration, generator, resolutions, splits, engines, options.repeat)
+  document = {"revision": gitRevision(), "python": platform.python_version(), "machine": platform.platform(),
+              "config": options.configFile, "generator": generator.parameters(), "results": results}
+  writeResults(options.output, document)
+  for row in results:
+    if options.startup > 0:
+      print("%-22s %-7s %8.1f ms per start %8d KB" % (row["stage"], row["engine"], 1000.0 * row["seconds"] / row["rows"], row["peak_rss_kb"]))
+      continue
+    print("%-9s %-9s %-8s %-6s %10d rows %9.0f rows/s %9.0f crossings/s %8d KB" % (
+      row["stage"], row["engine"] or "", row["resolution"] or "", row["temporal_split"] or "", row["rows"],
+      row["rows_per_second"] or 0, row["crossings_per_second"] or 0, row["stage_rss_kb"]))
+
+  if options.baseline:
+    with open(options.baseline) as infile:
+      baseline = json.load(infile)
+    if baseline.get("generator") != document["generator"]:
+      print("warning: the baseline was generated with different track parameters")
+    slower = regressions(baseline, results, options.tolerance)
+    for (key, before, after) in slower:
+      print("slower: %s %.0f -> %.0f rows/s" % (" ".join(str(k) for k in key if k is not None), before, after))
+    if slower:
+      exit(1)
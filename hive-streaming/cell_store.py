@@ -0,0 +1,375 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Local query store of the aggregate tables.
+#
+# Every set of aggregate tables (see AggregateMicroPathConfig.outputLevels)
+# becomes one file of fixed size records (key, time, count, velocity,
+# direction), one run of records per blanket.  key is the Morton (Z order)
+# code of the (row, col) of the cell in the blanket grid (see
+# scripts/cell_keys.py), so cells close on the map are mostly close in the file;
+# time is the epoch second of the time bucket.  Records are sorted by
+# (key, time) and cut into blocks of BLOCK_ROWS, the first key and the time
+# range of every block are kept in the manifest and held in memory.
+#
+# A bounding box query turns the rows and columns it covers into a few key
+# ranges (zRanges), finds their blocks in the block index, skips blocks
+# outside the time range and reads the rest from a memmap of the file.
+#
+# buildStore writes the files of a new generation and then replaces
+# store.json, so a CellStore serving queries picks them up on its next
+# query (reload) without ever seeing half a store.
+#
+#   python cell_store.py build -c ais.ini -i output -s output/store
+#   python cell_store.py serve -s output/store --port 8642
+#   curl 'localhost:8642/query?bbox=36,-77,38,-75&from=2015-01-01&to=2015-01-02'
+#
+
+import os
+import sys
+import json
+import time
+import glob
+import urlparse
+import BaseHTTPServer
+from optparse import OptionParser
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from config import AggregateMicroPathConfig
+from timestamps import TimestampParser, formatEpoch
+from cell_keys import mortonKeys, mortonCells
+import raster_export
+
+METRIC_NAMES = [metric[0] for metric in raster_export.METRICS]
+RECORD = numpy.dtype([("key", "<u8"), ("time", "<i8"), ("count", "<i4"), ("velocity", "<f4"), ("direction", "<i4")])
+BLOCK_ROWS = 4096
+MANIFEST = "store.json"
+# a query box is split into key ranges down to cells of about 1/RANGE_DETAIL
+# of its larger side, finer parts of the border are read and filtered
+RANGE_DETAIL = 8
+
+
+#
+# Sorted, merged [low, high] key ranges covering the cells rowLo..rowHi x
+# colLo..colHi (inclusive).  Quadrants smaller than min_size that are only
+# partly inside are taken whole, so the ranges can hold cells outside.
+#
+def zRanges(rowLo, rowHi, colLo, colHi, min_size=1):
+  size = 1
+  while size <= max(rowHi, colHi):
+    size *= 2
+  ranges = []
+  pending = [(0, 0, size, 0)]
+  while pending:
+    (row, col, size, base) = pending.pop()
+    if row > rowHi or row + size - 1 < rowLo or col > colHi or col + size - 1 < colLo:
+      continue
+    inside = rowLo <= row and row + size - 1 <= rowHi and colLo <= col and col + size - 1 <= colHi
+    if inside or size <= min_size:
+      ranges.append([base, base + size * size - 1])
+      continue
+    half = size // 2
+    # pushed in reverse z order so they come off the stack in order
+    for (quadrant, (r, c)) in reversed(list(enumerate([(0, 0), (0, half), (half, 0), (half, half)]))):
+      pending.append((row + r, col + c, half, base + quadrant * half * half))
+  merged = []
+  for (low, high) in ranges:
+    if merged and merged[-1][1] + 1 == low:
+      merged[-1][1] = high
+    else:
+      merged.append([low, high])
+  return merged
+
+
+#
+# {(blanket, (row, col), dt): [count, velocity, direction]} of the aggregate
+# tables of one output level
+#
+def levelCells(configuration, suffix, blankets, source):
+  cells = {}
+  for (table, metrics) in raster_export.metricTables(configuration, suffix):
+    for line in raster_export.tableLines(configuration, table, source):
+      fields = line.rstrip("\r\n").split("\t")
+      position = raster_export.cellPosition(configuration, blankets, fields)
+      if position is None:
+        continue
+      cell = cells.get(position + (fields[-1],))
+      if cell is None:
+        cell = cells[position + (fields[-1],)] = [0, 0.0, 0]
+      for (metric, dtype, column) in metrics:
+        cell[METRIC_NAMES.index(metric)] = float(fields[column])
+  return cells
+
+
+#
+# Write the aggregate tables (a local run's output directory in source, or
+# hive) to store_dir as a new generation and switch store.json over to it.
+# Files of older generations are removed, processes still reading them keep
+# their memmaps.
+#
+def buildStore(configuration, store_dir, source=None):
+  if not os.path.isdir(store_dir):
+    os.makedirs(store_dir)
+  generation = "%d-%d" % (int(time.time() * 1000), os.getpid())
+  timestamps = TimestampParser()
+  manifest = {"generation": generation, "block_rows": BLOCK_ROWS, "tables": {}}
+  for (suffix, blankets) in raster_export.tableLevels(configuration):
+    cells = levelCells(configuration, suffix, blankets, source)
+    name = configuration.table_name + suffix
+    path = name + "." + generation + ".cells"
+    entries = []
+    with open(os.path.join(store_dir, path), "wb") as outfile:
+      start = 0
+      for (k, blanket) in enumerate(blankets):
+        keys = sorted(key for key in cells if key[0] == k)
+        records = numpy.zeros(len(keys), dtype=RECORD)
+        if keys:
+          records["key"] = mortonKeys([key[1][0] for key in keys], [key[1][1] for key in keys])
+          records["time"] = [timestamps.parse(key[2]) for key in keys]
+          values = numpy.array([cells[key] for key in keys])
+          records["count"] = values[:, 0]
+          records["velocity"] = values[:, 1]
+          records["direction"] = values[:, 2]
+          records = records[numpy.lexsort((records["time"], records["key"]))]
+        outfile.write(records.tostring())
+        blocks = range(0, len(records), BLOCK_ROWS)
+        (rows, cols) = raster_export.gridShape(blanket)
+        entries.append({"name": str(blanket[4]), "rows": rows, "cols": cols,
+                        "lat0": blanket[7] * blanket[5], "lon0": blanket[9] * blanket[6],
+                        "resolution_lat": blanket[5], "resolution_lon": blanket[6],
+                        "start": start, "end": start + len(records),
+                        "first_keys": [int(records["key"][b]) for b in blocks],
+                        "min_time": [int(records["time"][b:b + BLOCK_ROWS].min()) for b in blocks],
+                        "max_time": [int(records["time"][b:b + BLOCK_ROWS].max()) for b in blocks]})
+        start += len(records)
+    manifest["tables"][name] = {"file": path, "records": start, "blankets": entries}
+
+  staging = os.path.join(store_dir, MANIFEST + "." + generation)
+  with open(staging, "w") as outfile:
+    json.dump(manifest, outfile)
+  os.rename(staging, os.path.join(store_dir, MANIFEST))
+  for path in glob.glob(os.path.join(store_dir, "*.cells")):
+    if not path.endswith("." + generation + ".cells"):
+      os.remove(path)
+  return manifest
+
+
+class CellStore():
+  def __init__(self, store_dir):
+    self.store_dir = store_dir
+    self.state = None
+    self.generation = None
+    self.tables = {}
+    self.reload()
+
+  #
+  # reopen the store when store.json was replaced, True if it was
+  #
+  def reload(self):
+    path = os.path.join(self.store_dir, MANIFEST)
+    stat = os.stat(path)
+    state = (stat.st_ino, stat.st_mtime, stat.st_size)
+    if state == self.state:
+      return False
+    with open(path) as infile:
+      manifest = json.load(infile)
+    tables = {}
+    for (name, table) in manifest["tables"].items():
+      records = None
+      if table["records"]:
+        records = numpy.memmap(os.path.join(self.store_dir, table["file"]), dtype=RECORD, mode="r", shape=(table["records"],))
+      blankets = []
+      for blanket in table["blankets"]:
+        blanket = dict(blanket)
+        blanket["first_keys"] = numpy.array(blanket["first_keys"], dtype=numpy.uint64)
+        blanket["min_time"] = numpy.array(blanket["min_time"], dtype=numpy.int64)
+        blanket["max_time"] = numpy.array(blanket["max_time"], dtype=numpy.int64)
+        blankets.append(blanket)
+      tables[name] = (records, blankets)
+    (self.tables, self.generation, self.state) = (tables, manifest["generation"], state)
+    return True
+
+  #
+  # epoch seconds of a query time: epoch seconds, YYYY-MM-DD or
+  # YYYY-MM-DD HH:MM:SS
+  #
+  def time(self, value):
+    if value is None or value == "":
+      return None
+    value = str(value)
+    if len(value) == 10 and value[4] == "-":
+      value += " 00:00:00"
+    parsed = TimestampParser().parse(value)
+    if parsed is None:
+      raise ValueError("can't read the time " + value)
+    return parsed
+
+  #
+  # Records of table with their cell centre in lat1..lat2 x lon1..lon2 (lon1 >
+  # lon2 crosses the dateline) and their time bucket in [start, end), as
+  # (blanket entry, records) pairs.  start/end are epoch seconds or
+  # datetimes, None for no limit.
+  #
+  def records(self, table, lat1, lon1, lat2, lon2, start=None, end=None):
+    (records, blankets) = self.tables[table]
+    (start, end) = (self.time(start), self.time(end))
+    boxes = [(lon1, lon2)] if lon1 <= lon2 else [(lon1, 180.0), (-180.0, lon2)]
+    found = []
+    for blanket in blankets:
+      if records is None or blanket["start"] == blanket["end"]:
+        continue
+      (lat0, lon0) = (blanket["lat0"], blanket["lon0"])
+      (resolutionLat, resolutionLon) = (blanket["resolution_lat"], blanket["resolution_lon"])
+      # the cells with their centre in the box, like a WHERE on the x/y columns
+      rowLo = max(int(numpy.ceil((lat1 - lat0) / resolutionLat - 0.5)), 0)
+      rowHi = min(int(numpy.floor((lat2 - lat0) / resolutionLat - 0.5)), blanket["rows"] - 1)
+      for (west, east) in boxes:
+        # the grid can reach past -180, e.g. a blanket from -360
+        for shift in (0.0, -360.0, 360.0):
+          colLo = max(int(numpy.ceil((west + shift - lon0) / resolutionLon - 0.5)), 0)
+          colHi = min(int(numpy.floor((east + shift - lon0) / resolutionLon - 0.5)), blanket["cols"] - 1)
+          if rowLo > rowHi or colLo > colHi:
+            continue
+          part = self.boxRecords(records, blanket, rowLo, rowHi, colLo, colHi, start, end)
+          if len(part):
+            found.append((blanket, part))
+    return found
+
+  def boxRecords(self, records, blanket, rowLo, rowHi, colLo, colHi, start, end):
+    min_size = max(1, max(rowHi - rowLo, colHi - colLo) // RANGE_DETAIL)
+    first_keys = blanket["first_keys"]
+    parts = []
+    for (low, high) in zRanges(rowLo, rowHi, colLo, colHi, min_size):
+      # blocks that can hold keys in [low, high]
+      # the block before the first one starting at low can end with low too
+      first = max(int(numpy.searchsorted(first_keys, numpy.uint64(low), "left")) - 1, 0)
+      last = int(numpy.searchsorted(first_keys, numpy.uint64(high), "right"))
+      for block in range(first, last):
+        if (start is not None and blanket["max_time"][block] < start) or (end is not None and blanket["min_time"][block] >= end):
+          continue
+        offset = blanket["start"] + block * BLOCK_ROWS
+        rows = records[offset:min(offset + BLOCK_ROWS, blanket["end"])]
+        keys = rows["key"]
+        rows = rows[int(numpy.searchsorted(keys, numpy.uint64(low), "left")):int(numpy.searchsorted(keys, numpy.uint64(high), "right"))]
+        if len(rows):
+          parts.append(rows)
+    if not parts:
+      return numpy.zeros(0, dtype=RECORD)
+    rows = numpy.concatenate(parts)
+    (row, col) = mortonCells(rows["key"])
+    keep = (row >= rowLo) & (row <= rowHi) & (col >= colLo) & (col <= colHi)
+    if start is not None:
+      keep &= rows["time"] >= start
+    if end is not None:
+      keep &= rows["time"] < end
+    return rows[keep]
+
+  #
+  # The cells of a query as dicts with the cell centre, the time bucket and
+  # count, velocity and direction.  With by_cell the buckets of every cell
+  # are summed up, velocity and direction are then means over the crossings.
+  #
+  def query(self, table, lat1, lon1, lat2, lon2, start=None, end=None, by_cell=False):
+    cells = []
+    for (blanket, rows) in self.records(table, lat1, lon1, lat2, lon2, start, end):
+      (row, col) = mortonCells(rows["key"])
+      lat = blanket["lat0"] + (row + 0.5) * blanket["resolution_lat"]
+      lon = blanket["lon0"] + (col + 0.5) * blanket["resolution_lon"]
+      lon = numpy.where(lon < -180, lon + 360, lon)
+      if not by_cell:
+        for (y, x, t, count, velocity, direction) in zip(lat.tolist(), lon.tolist(), rows["time"].tolist(), rows["count"].tolist(),
+                                                         rows["velocity"].tolist(), rows["direction"].tolist()):
+          cells.append({"lat": y, "lon": x, "dt": formatEpoch(t), "count": count, "velocity": velocity, "direction": direction})
+        continue
+      sums = {}
+      for (y, x, count, velocity, direction) in zip(lat.tolist(), lon.tolist(), rows["count"].tolist(),
+                                                    rows["velocity"].tolist(), rows["direction"].tolist()):
+        cell = sums.get((y, x))
+        if cell is None:
+          cell = sums[(y, x)] = [0, 0.0, 0.0]
+        cell[0] += count
+        cell[1] += velocity * count
+        cell[2] += direction * count
+      for ((y, x), (count, velocity, direction)) in sorted(sums.items()):
+        cells.append({"lat": y, "lon": x, "count": count, "velocity": velocity / count if count else 0.0,
+                      "direction": direction / count if count else 0.0})
+    return cells
+
+
+#
+# JSON over HTTP: GET /query?table=&bbox=lat1,lon1,lat2,lon2&from=&to=&by_cell=1
+# (table defaults to the plain aggregate tables) and GET /tables.  The store
+# is reloaded before every request when a build replaced it.
+#
+def serve(store_dir, port, default_table=None):
+  store = CellStore(store_dir)
+  if default_table is None:
+    default_table = min(store.tables, key=len)
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+      url = urlparse.urlparse(self.path)
+      params = dict((name, values[-1]) for (name, values) in urlparse.parse_qs(url.query).items())
+      try:
+        store.reload()
+        if url.path == "/tables":
+          body = {"generation": store.generation, "tables": sorted(store.tables)}
+        elif url.path == "/query":
+          started = time.time()
+          (lat1, lon1, lat2, lon2) = [float(v) for v in params["bbox"].split(",")]
+          cells = store.query(params.get("table", default_table), lat1, lon1, lat2, lon2,
+                              params.get("from"), params.get("to"), params.get("by_cell") in ("1", "true"))
+          body = {"generation": store.generation, "cells": cells, "millis": (time.time() - started) * 1000}
+        else:
+          self.send_error(404)
+          return
+      except (KeyError, ValueError) as e:
+        self.send_error(400, str(e))
+        return
+      data = json.dumps(body)
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, format, *args):
+      pass
+
+  server = BaseHTTPServer.HTTPServer(("", port), Handler)
+  print("serving " + store_dir + " on port " + str(port))
+  server.serve_forever()
+
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="%prog build|serve [options]")
+  parser.add_option("-c", "--config", dest="configFile", help="name of configuration file in conf/ (build)")
+  parser.add_option("-i", "--input", dest="inputDir", help="output directory of a local run, the hive tables are read without it (build)")
+  parser.add_option("-s", "--store", dest="storeDir", default="output/store", help="store directory")
+  parser.add_option("--port", dest="port", type="int", default=8642, help="port to serve on (serve)")
+  parser.add_option("-t", "--table", dest="table", help="table queried without a table parameter (serve)")
+  (options, args) = parser.parse_args()
+  if args == ["build"] and options.configFile:
+    configuration = AggregateMicroPathConfig(options.configFile, os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf/"))
+    manifest = buildStore(configuration, options.storeDir, options.inputDir)
+    print("wrote " + ", ".join(name + " (" + str(table["records"]) + " cells)" for (name, table) in sorted(manifest["tables"].items())))
+  elif args == ["serve"]:
+    serve(options.storeDir, options.port, options.table)
+  else:
+    parser.print_help()
+    exit(1)
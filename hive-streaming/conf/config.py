@@ -12,12 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
 import math
-import six
-if six.PY2
-    from ConfigParser import SafeConfigParser
-else
-    from configparser import SafeConfigParser
+import zlib
+import marshal
+
+# as in the haversine distance of the scripts
+EARTH_RADIUS_KM = 6371
+# degrees added to the pruning boxes, above the betweenpts threshold
+PRUNE_EPSILON = 0.000001
+# name suffix and layout version of the frozen config written by freeze()
+FROZEN_SUFFIX = ".frozen"
+FROZEN_VERSION = 1
+
+#
+# [lat1, lon1, lat2, lon2, name, resolutionLat, resolutionLon, latMin, latMax, lonMin, lonMax]
+# as used by tripline_bins.py, the last four are the tripline index ranges
+#
+def tripLineBlanket(lat1, lon1, lat2, lon2, name, resolutionLat, resolutionLon):
+    latMin = int(math.floor(lat1/resolutionLat))
+    latMax = int(math.ceil(lat2/resolutionLat))
+    lonMin = int(math.floor(lon1/resolutionLon))
+    lonMax = int(math.ceil(lon2/resolutionLon))
+    return [lat1,lon1,lat2,lon2,name,resolutionLat,resolutionLon,latMin,latMax,lonMin,lonMax]
 
 class AggregateMicroPathConfig:
     
@@ -40,12 +57,51 @@ class AggregateMicroPathConfig:
     tripLatMax = 0
     tripLonMin = 0
     tripLonMax = 0
-    triplineBlankets = []
+    # set per instance, the tuples only keep them from being shared
+    triplineBlankets = ()
+    tripline_engine = "vector"
+    geometry_kernel = "adaptive"
+    extract_engine = "row"
+    tripline_chunk_size = 4096
+    aggregation_output = "split"
+    tripline_combine_size = 0
+    cell_key = "rowmajor"
+    blanket_index_cell = 1.0
+    stream_window = 3600
+    stream_snapshot_interval = 60
+    reducer_bytes = 268435456
+    sort_buffer_bytes = 268435456
+    max_reducers = 999
+    max_parallel_stages = 4
+    batch_stages = True
+    pyramid_levels = 1
+    rollup_splits = ()
+    velocity_filter = -1.0
+    date_from = None
+    date_to = None
+    prune_to_blankets = False
+    simplify_tolerance = 0.0
+    export_format = "auto"
+    cell_sketches = False
+    hll_precision = 12
+    tdigest_compression = 100
+    sketch_cells = 10000
+    skew_chunk_fixes = 0
+    skew_sample = 0.01
+    skew_max_tracks = 64
     
     def __init__(self, config, basePath = "./"):
+        # only needed to parse the .ini, the scripts mostly load the frozen copy
+        import six
+        if six.PY2:
+            from ConfigParser import SafeConfigParser
+        else:
+            from configparser import SafeConfigParser
         configParser = SafeConfigParser()
         configParser.read(basePath + config)
         self.config_file = config 
+        self.triplineBlankets = []
+        self.rollup_splits = []
         self.database_name = configParser.get("AggregateMicroPath", "database_name")
         self.table_name = configParser.get("AggregateMicroPath", "table_name") 
         self.table_schema_id = configParser.get("AggregateMicroPath", "table_schema_id") 
@@ -54,19 +110,190 @@ class AggregateMicroPathConfig:
         self.table_schema_lon = configParser.get("AggregateMicroPath", "table_schema_lon") 
         self.time_filter = long(configParser.get("AggregateMicroPath", "time_filter")) 
         self.distance_filter = long(configParser.get("AggregateMicroPath", "distance_filter"))
-        self.tripLat1 = float(configParser.get("AggregateMicroPath", "lower_left_lat")) 
-        self.tripLon1 = float(configParser.get("AggregateMicroPath", "lower_left_lon"))
-        self.tripLat2 = float(configParser.get("AggregateMicroPath", "upper_right_lat")) 
-        self.tripLon2 = float(configParser.get("AggregateMicroPath", "upper_right_lon"))
-        self.tripname = configParser.get("AggregateMicroPath", "trip_name") 
-        self.resolutionLat = float(configParser.get("AggregateMicroPath", "resolution_lat"))
-        self.resolutionLon = float(configParser.get("AggregateMicroPath", "resolution_lon"))
-        self.tripLatMin = int(math.floor(self.tripLat1/self.resolutionLat))#6
-        self.tripLatMax = int(math.ceil(self.tripLat2/self.resolutionLat)) #7
-        self.tripLonMin = int(math.floor(self.tripLon1/self.resolutionLon)) #8
-        self.tripLonMax = int(math.ceil(self.tripLon2/self.resolutionLon)) #9
-        self.triplineBlankets.append([self.tripLat1,self.tripLon1,self.tripLat2,self.tripLon2,self.tripname,self.resolutionLat,self.resolutionLon,self.tripLatMin,self.tripLatMax,self.tripLonMin,self.tripLonMax])
+        # the blanket of the main section is optional when [blanket <name>] sections exist
+        if configParser.has_option("AggregateMicroPath", "lower_left_lat"):
+            self.tripLat1 = float(configParser.get("AggregateMicroPath", "lower_left_lat")) 
+            self.tripLon1 = float(configParser.get("AggregateMicroPath", "lower_left_lon"))
+            self.tripLat2 = float(configParser.get("AggregateMicroPath", "upper_right_lat")) 
+            self.tripLon2 = float(configParser.get("AggregateMicroPath", "upper_right_lon"))
+            self.tripname = configParser.get("AggregateMicroPath", "trip_name") 
+            self.resolutionLat = float(configParser.get("AggregateMicroPath", "resolution_lat"))
+            self.resolutionLon = float(configParser.get("AggregateMicroPath", "resolution_lon"))
+            blanket = tripLineBlanket(self.tripLat1,self.tripLon1,self.tripLat2,self.tripLon2,self.tripname,self.resolutionLat,self.resolutionLon)
+            (self.tripLatMin, self.tripLatMax, self.tripLonMin, self.tripLonMax) = blanket[7:11]
+            self.triplineBlankets.append(blanket)
+        for section in configParser.sections():
+            if section.lower().startswith("blanket "):
+                self.triplineBlankets.append(self.readBlanket(configParser, section))
+        if not self.triplineBlankets:
+            raise ValueError("no tripline blanket configured in " + config)
         self.temporal_split = configParser.get("AggregateMicroPath", "temporal_split") 
-        
-        
+        if configParser.has_option("AggregateMicroPath", "tripline_engine"):
+            self.tripline_engine = configParser.get("AggregateMicroPath", "tripline_engine").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "geometry_kernel"):
+            self.geometry_kernel = configParser.get("AggregateMicroPath", "geometry_kernel").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "extract_engine"):
+            self.extract_engine = configParser.get("AggregateMicroPath", "extract_engine").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "tripline_chunk_size"):
+            self.tripline_chunk_size = int(configParser.get("AggregateMicroPath", "tripline_chunk_size"))
+        if configParser.has_option("AggregateMicroPath", "aggregation_output"):
+            self.aggregation_output = configParser.get("AggregateMicroPath", "aggregation_output").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "tripline_combine_size"):
+            self.tripline_combine_size = int(configParser.get("AggregateMicroPath", "tripline_combine_size"))
+        if configParser.has_option("AggregateMicroPath", "cell_key"):
+            self.cell_key = configParser.get("AggregateMicroPath", "cell_key").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "blanket_index_cell"):
+            self.blanket_index_cell = float(configParser.get("AggregateMicroPath", "blanket_index_cell"))
+        if configParser.has_option("AggregateMicroPath", "stream_window"):
+            self.stream_window = long(configParser.get("AggregateMicroPath", "stream_window"))
+        if configParser.has_option("AggregateMicroPath", "stream_snapshot_interval"):
+            self.stream_snapshot_interval = float(configParser.get("AggregateMicroPath", "stream_snapshot_interval"))
+        if configParser.has_option("AggregateMicroPath", "reducer_bytes"):
+            self.reducer_bytes = long(configParser.get("AggregateMicroPath", "reducer_bytes"))
+        if configParser.has_option("AggregateMicroPath", "sort_buffer_bytes"):
+            self.sort_buffer_bytes = long(configParser.get("AggregateMicroPath", "sort_buffer_bytes"))
+        if configParser.has_option("AggregateMicroPath", "max_reducers"):
+            self.max_reducers = int(configParser.get("AggregateMicroPath", "max_reducers"))
+        if configParser.has_option("AggregateMicroPath", "max_parallel_stages"):
+            self.max_parallel_stages = int(configParser.get("AggregateMicroPath", "max_parallel_stages"))
+        if configParser.has_option("AggregateMicroPath", "batch_stages"):
+            self.batch_stages = configParser.getboolean("AggregateMicroPath", "batch_stages")
+        if configParser.has_option("AggregateMicroPath", "velocity_filter"):
+            self.velocity_filter = float(configParser.get("AggregateMicroPath", "velocity_filter"))
+        if configParser.has_option("AggregateMicroPath", "date_from"):
+            self.date_from = configParser.get("AggregateMicroPath", "date_from").strip() or None
+        if configParser.has_option("AggregateMicroPath", "date_to"):
+            self.date_to = configParser.get("AggregateMicroPath", "date_to").strip() or None
+        if configParser.has_option("AggregateMicroPath", "prune_to_blankets"):
+            self.prune_to_blankets = configParser.getboolean("AggregateMicroPath", "prune_to_blankets")
+        if configParser.has_option("AggregateMicroPath", "simplify_tolerance"):
+            self.simplify_tolerance = float(configParser.get("AggregateMicroPath", "simplify_tolerance"))
+        if configParser.has_option("AggregateMicroPath", "export_format"):
+            self.export_format = configParser.get("AggregateMicroPath", "export_format").strip().lower()
+        if configParser.has_option("AggregateMicroPath", "skew_chunk_fixes"):
+            self.skew_chunk_fixes = long(configParser.get("AggregateMicroPath", "skew_chunk_fixes"))
+        if configParser.has_option("AggregateMicroPath", "skew_sample"):
+            self.skew_sample = float(configParser.get("AggregateMicroPath", "skew_sample"))
+        if configParser.has_option("AggregateMicroPath", "skew_max_tracks"):
+            self.skew_max_tracks = int(configParser.get("AggregateMicroPath", "skew_max_tracks"))
+        if configParser.has_option("AggregateMicroPath", "cell_sketches"):
+            self.cell_sketches = configParser.getboolean("AggregateMicroPath", "cell_sketches")
+        if configParser.has_option("AggregateMicroPath", "hll_precision"):
+            self.hll_precision = int(configParser.get("AggregateMicroPath", "hll_precision"))
+        if configParser.has_option("AggregateMicroPath", "tdigest_compression"):
+            self.tdigest_compression = float(configParser.get("AggregateMicroPath", "tdigest_compression"))
+        if configParser.has_option("AggregateMicroPath", "sketch_cells"):
+            self.sketch_cells = int(configParser.get("AggregateMicroPath", "sketch_cells"))
+        if configParser.has_option("AggregateMicroPath", "pyramid_levels"):
+            self.pyramid_levels = int(configParser.get("AggregateMicroPath", "pyramid_levels"))
+        if configParser.has_option("AggregateMicroPath", "rollup_splits"):
+            self.rollup_splits = [split.strip().lower() for split in configParser.get("AggregateMicroPath", "rollup_splits").split(",") if split.strip()]
+
+    #
+    # Write the parsed config, blankets and tripline index ranges included,
+    # to <config>.frozen next to the .ini.  The driver does this once per
+    # run and ships the file with the scripts, loadConfig then restores it
+    # with one marshal.load instead of parsing the .ini in every task.
+    #
+    def freeze(self, basePath = "./"):
+        frozen = {"version": FROZEN_VERSION, "checksum": iniChecksum(basePath + self.config_file),
+                  "attributes": dict(self.__dict__)}
+        with open(basePath + self.config_file + FROZEN_SUFFIX, "wb") as outfile:
+            marshal.dump(frozen, outfile)
+        return basePath + self.config_file + FROZEN_SUFFIX
+
+    #
+    # a [blanket <name>] section, trip_name defaults to <name>
+    #
+    def readBlanket(self, configParser, section):
+        name = section[len("blanket "):].strip()
+        if configParser.has_option(section, "trip_name"):
+            name = configParser.get(section, "trip_name")
+        return tripLineBlanket(float(configParser.get(section, "lower_left_lat")),
+                               float(configParser.get(section, "lower_left_lon")),
+                               float(configParser.get(section, "upper_right_lat")),
+                               float(configParser.get(section, "upper_right_lon")),
+                               name,
+                               float(configParser.get(section, "resolution_lat")),
+                               float(configParser.get(section, "resolution_lon")))
+
+    #
+    # the blankets of a level of the resolution pyramid, level 0 is the
+    # configured resolution and every level above is ten times coarser
+    #
+    def levelBlankets(self, level):
+        if level == 0:
+            return self.triplineBlankets
+        factor = 10 ** level
+        return [tripLineBlanket(b[0], b[1], b[2], b[3], b[4], round(b[5] * factor, 12), round(b[6] * factor, 12))
+                for b in self.triplineBlankets]
+
+    #
+    # (pyramid level, temporal split, table name suffix) of every set of
+    # aggregate tables, level 0 at temporal_split keeps the plain names
+    #
+    def outputLevels(self):
+        levels = []
+        for level in range(max(1, self.pyramid_levels)):
+            for split in [self.temporal_split] + self.rollup_splits:
+                suffix = ""
+                if level > 0 or split != self.temporal_split:
+                    suffix = "_level%d_%s" % (level, re.sub(r'\W+', '', split))
+                levels.append((level, split, suffix))
+        return levels
+
+    #
+    # (latMin, latMax, lonMin, lonMax) boxes around the blankets, padded by
+    # distance_filter, that hold every fix a segment touching a blanket can
+    # start or end on (lonMin/lonMax are None when any longitude can).  A fix
+    # outside all of them can't be part of a crossing.  Longitudes are padded
+    # by the widest angle a great circle of distance_filter km spans at the
+    # highest latitude of the box.  None when prune_to_blankets is off.
+    #
+    def pruneBoxes(self, max_boxes=32):
+        if not self.prune_to_blankets:
+            return None
+        blankets = self.triplineBlankets
+        if len(blankets) > max_boxes:
+            blankets = [[min(b[0] for b in blankets), min(b[1] for b in blankets), max(b[2] for b in blankets), max(b[3] for b in blankets)]]
+        radians = float(self.distance_filter) / EARTH_RADIUS_KM
+        padLat = math.degrees(radians) + PRUNE_EPSILON
+        boxes = []
+        for b in blankets:
+            (latMin, latMax) = (b[0] - padLat, b[2] + padLat)
+            cosLat = math.cos(math.radians(min(90.0, max(abs(latMin), abs(latMax)))))
+            (lonMin, lonMax) = (None, None)
+            if cosLat > 0 and math.sin(radians / 2) / cosLat < 1:
+                padLon = math.degrees(2 * math.asin(math.sin(radians / 2) / cosLat)) + PRUNE_EPSILON
+                if b[3] - b[1] + 2 * padLon < 360:
+                    (lonMin, lonMax) = (b[1] - padLon, b[3] + padLon)
+            boxes.append((latMin, latMax, lonMin, lonMax))
+        return boxes
 
+
+#
+# A config restored from the attributes of a frozen one
+#
+class FrozenConfig(AggregateMicroPathConfig):
+
+    def __init__(self, attributes):
+        self.__dict__.update(attributes)
+
+
+def iniChecksum(path):
+    with open(path, "rb") as infile:
+        return zlib.crc32(infile.read()) & 0xffffffff
+
+#
+# The config of a script: the frozen copy written by freeze() when it is
+# there and was made from the .ini as it is now, the parsed .ini otherwise
+#
+def loadConfig(config, basePath = "./"):
+    try:
+        with open(basePath + config + FROZEN_SUFFIX, "rb") as infile:
+            frozen = marshal.load(infile)
+        if frozen["version"] == FROZEN_VERSION and frozen["checksum"] == iniChecksum(basePath + config):
+            return FrozenConfig(frozen["attributes"])
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
+        pass
+    return AggregateMicroPathConfig(config, basePath)
@@ -0,0 +1,220 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# External merge sort of text lines, the SORT BY of the hive path extraction
+# for inputs that don't fit in memory.
+#
+# Lines are buffered until they take about buffer_bytes, then sorted and
+# spilled to a run file in the work directory.  The runs are merged with a
+# heap over memory mapped reads of them, at most MERGE_FAN_IN runs at a
+# time; when there are more, the first ones are merged into a longer run
+# first.  Each run is mapped a window at a time, the windows of all runs
+# being merged take about half of buffer_bytes, so the merge stays in the
+# same memory as the buffer however long the runs are.  Input that fits in
+# the buffer is sorted in memory and never written.  The sort is stable,
+# lines with equal keys keep their input order.
+#
+# On its own it sorts raw position files by (id, dt), the input of
+# extract_path_segments.py, and with --segments streams the sorted rows
+# through the path extraction, so an archive can be turned into segments
+# without hive:
+#
+#   python external_sort.py -c ais.ini -i positions.tsv -t /bigdisk/tmp --segments > segments.tsv
+#
+
+import os
+import sys
+import mmap
+import heapq
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from config import AggregateMicroPathConfig
+from counters import Counters
+
+# runs merged at once, each one holds a file descriptor and a mapping
+MERGE_FAN_IN = 64
+# memory a buffered line takes on top of its characters: the string object,
+# the list slot and the key tuple the sort builds for it
+LINE_OVERHEAD = 256
+
+
+#
+# (id, dt) of a tab separated id, dt, lat, lon line, as the hive stage
+# sorts the rows of a track
+#
+def trackKey(line):
+  fields = line.split("\t", 2)
+  return (fields[0], fields[1].rstrip("\n"))
+
+
+def writeRun(lines, work_dir):
+  (handle, path) = tempfile.mkstemp(prefix="run-", suffix=".tsv", dir=work_dir)
+  with os.fdopen(handle, "w") as outfile:
+    outfile.writelines(lines)
+  return path
+
+#
+# the lines of a run file through read only mappings of window bytes (a
+# multiple of mmap.ALLOCATIONGRANULARITY) moving through it, a line cut
+# by the end of a window is finished from the next one
+#
+def runLines(path, window):
+  with open(path, "rb") as infile:
+    size = os.fstat(infile.fileno()).st_size
+    offset = 0
+    carry = ""
+    while offset < size:
+      length = min(window, size - offset)
+      mapped = mmap.mmap(infile.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+      try:
+        for line in iter(mapped.readline, ""):
+          if carry:
+            (line, carry) = (carry + line, "")
+          if line.endswith("\n"):
+            yield line
+          else:
+            carry = line
+      finally:
+        mapped.close()
+      offset += length
+    if carry:
+      yield carry
+
+def decorated(lines, key, position):
+  for line in lines:
+    yield (key(line), position, line)
+
+#
+# the lines of sorted iterables as one sorted sequence, ties go to the
+# iterable given first
+#
+def mergeSorted(iterables, key):
+  for (unused, position, line) in heapq.merge(*[decorated(lines, key, position) for (position, lines) in enumerate(iterables)]):
+    yield line
+
+
+class ExternalSorter():
+  def __init__(self, work_dir, buffer_bytes, key=trackKey, counters=None):
+    self.work_dir = work_dir
+    self.buffer_bytes = buffer_bytes
+    self.key = key
+    self.counters = counters
+    self.runs = []
+    granularity = mmap.ALLOCATIONGRANULARITY
+    self.window = max(granularity, buffer_bytes // (2 * MERGE_FAN_IN) // granularity * granularity)
+
+  #
+  # sort the buffer and write it out as the next run
+  #
+  def spill(self, buffer):
+    buffer.sort(key=self.key)
+    self.runs.append(writeRun(buffer, self.work_dir))
+    if self.counters is not None:
+      self.counters.increment('sort_runs')
+      self.counters.increment('sort_spilled_lines', len(buffer))
+
+  #
+  # merge runs until at most MERGE_FAN_IN are left, each pass merges the
+  # first MERGE_FAN_IN into one run that takes their place in front, so
+  # ties keep their order
+  #
+  def reduceRuns(self):
+    while len(self.runs) > MERGE_FAN_IN:
+      (merged, self.runs) = (self.runs[:MERGE_FAN_IN], self.runs[MERGE_FAN_IN:])
+      self.runs.insert(0, writeRun(mergeSorted([runLines(path, self.window) for path in merged], self.key), self.work_dir))
+      for path in merged:
+        os.remove(path)
+      if self.counters is not None:
+        self.counters.increment('sort_merge_passes')
+
+  #
+  # the lines sorted by key, newline terminated.  The run files are removed
+  # once the result is read to the end.
+  #
+  def sort(self, lines):
+    buffer = []
+    size = 0
+    for line in lines:
+      if not line.endswith("\n"):
+        line += "\n"
+      buffer.append(line)
+      size += len(line) + LINE_OVERHEAD
+      if size >= self.buffer_bytes:
+        self.spill(buffer)
+        buffer = []
+        size = 0
+    if not self.runs:
+      buffer.sort(key=self.key)
+      return iter(buffer)
+    if buffer:
+      self.spill(buffer)
+    del buffer
+    self.reduceRuns()
+    return self.merged()
+
+  def merged(self):
+    try:
+      for line in mergeSorted([runLines(path, self.window) for path in self.runs], self.key):
+        yield line
+    finally:
+      for path in self.runs:
+        if os.path.exists(path):
+          os.remove(path)
+      self.runs = []
+
+
+#
+# Sort the (id, dt, lat, lon) rows of local files by id and dt to stdout,
+# as tab separated lines extract_path_segments.py reads, or with --segments
+# the segments it makes of them.  The rows go through the same reading and
+# filters as a local run (see local_engine).
+#
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-c", "--config", dest="configFile", help="REQUIRED: name of configuration file in conf/")
+  parser.add_option("-i", "--input", dest="inputFiles", action="append",
+                    help="REQUIRED: TSV/CSV file of id, dt, lat, lon positions, can be given more than once")
+  parser.add_option("-t", "--tmp", dest="workDir", help="directory for the sorted runs, the system temp directory by default")
+  parser.add_option("-b", "--buffer-bytes", dest="bufferBytes", type="long",
+                    help="memory of the sort buffer, sort_buffer_bytes of the config by default")
+  parser.add_option("--segments", dest="segments", action="store_true", default=False,
+                    help="write the segments of the sorted tracks instead of the rows")
+  (options, args) = parser.parse_args()
+  if not options.configFile or not options.inputFiles:
+    parser.print_help()
+    exit(1)
+
+  import local_engine
+  configuration = AggregateMicroPathConfig(options.configFile, os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf/"))
+  boxes = configuration.pruneBoxes()
+  rows = (row for path in options.inputFiles for row in local_engine.readInputRows(configuration, path) if local_engine.keepRow(row, boxes))
+  work_dir = tempfile.mkdtemp(prefix="micro_path_sort_", dir=options.workDir)
+  try:
+    counters = Counters("micro_path_extract", sys.stderr)
+    sorter = ExternalSorter(work_dir, options.bufferBytes or configuration.sort_buffer_bytes, counters=counters)
+    lines = sorter.sort("\t".join(row) for row in rows)
+    if options.segments:
+      import extract_path_segments
+      segments = extract_path_segments.extractSegments(configuration, extract_path_segments.parseLines(lines), counters=counters)
+      sys.stdout.writelines("\t".join(segment) + "\n" for segment in segments)
+    else:
+      sys.stdout.writelines(lines)
+    counters.flush()
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,460 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Hive free execution of the micro path stages on local files.
+#
+# The input rows are sharded by track id into temporary files, every shard is
+# sorted by (id, dt) and pushed through the extract_path_segments and
+# tripline_bins logic by a worker process, and the per cell aggregates of the
+# shards are merged into the count, velocity and direction tables.  Shards
+# larger than sort_buffer_bytes are sorted on disk (see external_sort.py),
+# so the input can be much larger than the memory of the host.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import zlib
+import math
+import itertools
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from config import AggregateMicroPathConfig
+from counters import Counters, countedRows
+from timestamps import RollupLabeler
+from run_summary import addCounts
+
+SHARDS_PER_PROCESS = 4
+
+
+#
+# (id, dt, lat, lon) rows of a local TSV/CSV file.  A header naming the
+# table_schema_* columns selects them, otherwise the first four columns are used.
+#
+def readInputRows(configuration, path):
+  with open(path) as infile:
+    first = infile.readline()
+    delimiter = "\t" if "\t" in first else ","
+    names = [name.strip().strip('"') for name in first.rstrip("\r\n").split(delimiter)]
+    schema = [configuration.table_schema_id, configuration.table_schema_dt, configuration.table_schema_lat, configuration.table_schema_lon]
+    if all(name in names for name in schema):
+      columns = [names.index(name) for name in schema]
+      pending = []
+    else:
+      columns = [0, 1, 2, 3]
+      pending = [first]
+    for line in itertools.chain(pending, infile):
+      fields = line.rstrip("\r\n").split(delimiter)
+      if len(fields) <= max(columns):
+        continue
+      yield [fields[c] for c in columns]
+
+
+#
+# False for rows the hive stage filters out in front of the sort (see
+# source_predicates in AggregateMicroPath.py): lat/lon that are not numbers
+# and, with boxes (AggregateMicroPathConfig.pruneBoxes), fixes outside all of them
+#
+def keepRow(row, boxes):
+  try:
+    lat = float(row[2].replace('"', ''))
+    lon = float(row[3].replace('"', ''))
+  except ValueError:
+    return False
+  if not boxes:
+    return True
+  for (latMin, latMax, lonMin, lonMax) in boxes:
+    if latMin <= lat <= latMax and (lonMin is None or any(lonMin <= lon + shift <= lonMax for shift in (0, -360, 360))):
+      return True
+  return False
+
+
+#
+# {id: chunk boundaries} of the tracks to split (skew_chunk_fixes, see
+# skewPlan in extract_path_segments.py), from every 1 / skew_sample-th row
+#
+def samplePlan(configuration, paths):
+  import extract_path_segments
+  boxes = configuration.pruneBoxes()
+  stride = max(1, int(round(1 / configuration.skew_sample)))
+  sampled = {}
+  for path in paths:
+    for row in itertools.islice(readInputRows(configuration, path), 0, None, stride):
+      if keepRow(row, boxes):
+        sampled.setdefault(row[0].strip().replace('"', ''), []).append(row[1])
+  return extract_path_segments.skewPlan(configuration, sampled)
+
+
+#
+# write the input rows into shard files, keyed by a stable hash of the id.
+# The rows of the tracks in plan get their chunk as a fifth column and are
+# keyed by id and chunk; every chunk after the first also gets the last fix
+# of the chunk before it, marked with a sixth column.
+#
+def shardInput(configuration, paths, shard_dir, shards, plan=None):
+  import extract_path_segments
+  def shardOf(key):
+    return (zlib.crc32(key) & 0xffffffff) % shards
+  boxes = configuration.pruneBoxes()
+  plan = plan or {}
+  # (id, chunk) -> the row of its last fix
+  ends = {}
+  shard_paths = [os.path.join(shard_dir, "shard-%05d.tsv" % i) for i in range(shards)]
+  shard_files = [open(shard_path, "w") for shard_path in shard_paths]
+  try:
+    for path in paths:
+      for row in readInputRows(configuration, path):
+        if not keepRow(row, boxes):
+          continue
+        track = row[0].strip().replace('"', '')
+        if track in plan:
+          chunk = extract_path_segments.chunkOf(plan[track], row[1])
+          end = ends.get((track, chunk))
+          if end is None or row[1:4] > end[1:4]:
+            ends[(track, chunk)] = row
+          row = row + [str(chunk)]
+          track += extract_path_segments.CHUNK_SEPARATOR + str(chunk)
+        shard_files[shardOf(track)].write("\t".join(row) + "\n")
+    for (track, boundaries) in plan.items():
+      for chunk in range(1, len(boundaries) + 1):
+        if (track, chunk - 1) in ends and (track, chunk) in ends:
+          shard = shardOf(track + extract_path_segments.CHUNK_SEPARATOR + str(chunk))
+          shard_files[shard].write("\t".join(ends[(track, chunk - 1)] + [str(chunk), "start"]) + "\n")
+  finally:
+    for shard_file in shard_files:
+      shard_file.close()
+  return shard_paths
+
+
+#
+# write the rows of the split tracks in tracks from the shards into one
+# shard without their chunks
+#
+def joinChunks(shard_paths, tracks, path):
+  with open(path, "w") as outfile:
+    for shard_path in shard_paths:
+      with open(shard_path) as shard_file:
+        for line in shard_file:
+          row = line.rstrip("\n").split("\t")
+          if len(row) == 5 and row[0].strip().replace('"', '') in tracks:
+            outfile.write("\t".join(row[:4]) + "\n")
+  return path
+
+
+#
+# ids of the split tracks with a chunk that did not end on its last fix or
+# without a chunk (no start fix for the next one), from the (id, chunk,
+# exact) boundaries of all chunks
+#
+def inexactTracks(boundaries):
+  last = {}
+  chunks = {}
+  for (track, chunk, exact) in boundaries:
+    last[track] = max(last.get(track, 0), chunk)
+    chunks[track] = chunks.get(track, 0) + 1
+  return set(track for (track, chunk, exact) in boundaries
+             if (not exact and chunk < last[track]) or chunks[track] != last[track] + 1)
+
+
+#
+# sort key of a shard line, DISTRIBUTE BY id SORT BY id, dt, the rows of
+# chunks by id, chunk, dt, lat, lon
+#
+def shardKey(line):
+  row = line.rstrip("\n").split("\t")
+  if len(row) < 5:
+    return (row[0], row[1])
+  return (row[0], row[4], row[1], row[2], row[3])
+
+#
+# run the segment and tripline stages over one shard, returns the
+# {group: (aggregates, sketches)} of the crossings (see crossingAggregates),
+# the (id, chunk, exact) boundaries of the chunks of split tracks in the
+# shard and the counts of the extract and tripline stages.  The crossings of
+# unsplit tracks are in group None, those of a split track in a group of its
+# id, so it can be dropped when its chunks turn out inexact.  chunks tells
+# whether the shard can hold rows of chunks.  The sorted rows are streamed
+# through the stages, only the aggregates are kept in memory.
+#
+def processShard(job):
+  (config_file, base_path, shard_path, chunks) = job
+  import extract_path_segments
+  import external_sort
+
+  configuration = AggregateMicroPathConfig(config_file, base_path)
+  extract_counters = Counters("micro_path_extract")
+  tripline_counters = Counters("micro_path_tripline")
+  work_dir = tempfile.mkdtemp(prefix="sort_", dir=os.path.dirname(shard_path))
+  try:
+    sorter = external_sort.ExternalSorter(work_dir, configuration.sort_buffer_bytes, shardKey, extract_counters)
+    with open(shard_path) as shard_file:
+      sorted_lines = sorter.sort(shard_file)
+    lines = extract_path_segments.parseLines(line.rstrip("\n") for line in countedRows(sorted_lines, extract_counters, 'rows_in'))
+    (groups, boundaries) = shardCrossings(configuration, lines, chunks, extract_counters, tripline_counters)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  tripline_counters.increment('rows_in', extract_counters.counts.get('segments_out', 0))
+  return (groups, boundaries, {extract_counters.group: extract_counters.counts, tripline_counters.group: tripline_counters.counts})
+
+#
+# the {group: (aggregates, sketches)} and chunk boundaries of processShard
+# from the sorted rows of a shard
+#
+def shardCrossings(configuration, lines, chunks, extract_counters, tripline_counters):
+  import extract_path_segments
+  boundaries = []
+  chunked = []
+  if chunks:
+    def boundary(user_id, chunk, exact):
+      extract_counters.increment('track_chunks')
+      boundaries.append((user_id, int(chunk), exact))
+    def plainSegments():
+      for (plain, segments) in extract_path_segments.chunkedSegmentBlocks(configuration, lines, boundary, extract_counters):
+        chunked.extend(segments)
+        for segment in plain:
+          yield segment
+    segments = plainSegments()
+  else:
+    segments = extract_path_segments.extractSegments(configuration, lines, counters=extract_counters)
+
+  groups = crossingAggregates(configuration, segments, tripline_counters)
+  groups.update(crossingAggregates(configuration, chunked, tripline_counters, True))
+  return (groups, boundaries)
+
+
+#
+# {group: (aggregates, sketches)} of the tripline crossings of segments:
+# aggregates maps (blanket, cell, dt) to [count, velocity sum, direction sum,
+# direction sin sum, direction cos sum] ((blanket, cell, dt, level) keys with
+# pyramid_levels), sketches to the cell_sketches.CellSketch of the cell with
+# cell_sketches (None without).  All crossings are in group None, or in the
+# group of their track id with by_track.
+#
+def crossingAggregates(configuration, segments, counters, by_track=False):
+  import tripline_bins
+  import cell_sketches
+  # (id, alat, blat, alon, blon, adt, bdt, time, distance, velocity) -> TRANSFORM(alat, alon, blat, blon, adt, bdt, velocity, id)
+  track_rows = ([s[1], s[3], s[2], s[4], s[5], s[6], s[9], s[0]] for s in segments)
+  groups = {}
+  for crossing in tripline_bins.triplineCrossings(configuration, track_rows, counters):
+    group = crossing[5] if by_track else None
+    if group not in groups:
+      groups[group] = ({}, {} if configuration.cell_sketches else None)
+    (aggregates, sketches) = groups[group]
+    # the pyramid level follows the track id
+    key = (int(crossing[0]), int(crossing[1]), crossing[2]) + tuple(crossing[6:])
+    addCrossing(aggregates, key, float(crossing[3]), float(crossing[4]))
+    if sketches is not None:
+      sketch = sketches.get(key)
+      if sketch is None:
+        sketch = sketches[key] = cell_sketches.newSketch(configuration)
+      sketch.add(crossing[5], float(crossing[3]))
+    counters.increment('crossings')
+  return groups
+
+
+def addCrossing(aggregates, key, velocity, direction):
+  cell = aggregates.get(key)
+  if cell is None:
+    cell = aggregates[key] = [0, 0.0, 0.0, 0.0, 0.0]
+  cell[0] += 1
+  cell[1] += velocity
+  cell[2] += direction
+  cell[3] += math.sin(math.radians(direction))
+  cell[4] += math.cos(math.radians(direction))
+
+
+def mergeAggregates(total, partial):
+  for (key, values) in partial.items():
+    cell = total.get(key)
+    if cell is None:
+      total[key] = values
+    else:
+      for i in range(len(cell)):
+        cell[i] += values[i]
+
+
+def mergeSketches(total, partial):
+  for (key, sketch) in partial.items():
+    cell = total.get(key)
+    if cell is None:
+      total[key] = sketch
+    else:
+      cell.merge(sketch)
+
+
+def mergeGroups(total, partial):
+  for (group, (aggregates, sketches)) in partial.items():
+    if group not in total:
+      total[group] = (aggregates, sketches)
+      continue
+    mergeAggregates(total[group][0], aggregates)
+    if sketches is not None:
+      mergeSketches(total[group][1], sketches)
+
+
+#
+# {table name suffix: {(blanket, cell, dt): cell}} of every output level (see
+# AggregateMicroPathConfig.outputLevels), the rollup_splits buckets summed up
+# from the temporal_split ones.  merge and copy handle the cells, the default
+# ones the aggregate lists of processShard.
+#
+def levelAggregates(configuration, aggregates, merge=mergeAggregates, copy=list):
+  levels = configuration.outputLevels()
+  if len(levels) == 1:
+    return {"": aggregates}
+  labeler = RollupLabeler(configuration.temporal_split, configuration.rollup_splits)
+  suffixes = dict(((level, split), suffix) for (level, split, suffix) in levels)
+  tables = dict((suffix, {}) for (level, split, suffix) in levels)
+  for (key, cell) in aggregates.items():
+    level = int(key[3]) if len(key) > 3 else 0
+    merge(tables[suffixes[(level, configuration.temporal_split)]], {key[:3]: copy(cell)})
+    for (split, label) in zip(configuration.rollup_splits, labeler.labels(key[2])):
+      merge(tables[suffixes[(level, split)]], {(key[0], key[1], label): copy(cell)})
+  return tables
+
+
+#
+# write the micro_path_intersect_* tables as tab separated files, following
+# the aggregation_output setting like the hive aggregation stage, and the
+# micro_path_intersect_sketch tables when sketches are given.  The x and y
+# of the cell centres are worked out from the blanket and cell keys here.
+#
+def writeTables(configuration, aggregates, output_dir, sketches=None):
+  columns = {
+    "counts": lambda cell: str(cell[0]),
+    "velocity": lambda cell: str(cell[1] / cell[0]),
+    # avg(direction) lands in an int column
+    "direction": lambda cell: str(int(cell[2] / cell[0])),
+    "stats": lambda cell: "\t".join([str(cell[0]), str(cell[1]), str(cell[1] / cell[0]), str(int(cell[2] / cell[0])), str(cell[3]), str(cell[4])])
+  }
+  tables = []
+  if configuration.aggregation_output in ("split", "both"):
+    tables += ["counts", "velocity", "direction"]
+  if configuration.aggregation_output in ("wide", "both"):
+    tables.append("stats")
+
+  import cell_keys
+  levels = dict((suffix, level) for (level, split, suffix) in configuration.outputLevels())
+  # (x, y, blanket, cell) fields of the keys of the tables of a level
+  def cellFields(suffix, keys):
+    blankets = configuration.levelBlankets(levels[suffix])
+    return dict((key, list(cell_keys.keyCentre(blankets[int(key[0])], key[1], configuration.cell_key)) + [str(key[0]), str(key[1])])
+                for key in keys)
+
+  paths = {}
+  for (suffix, cells) in levelAggregates(configuration, aggregates).items():
+    keys = sorted(cells)
+    fields = cellFields(suffix, keys)
+    for table in tables:
+      path = os.path.join(output_dir, "micro_path_intersect_" + table + "_" + configuration.table_name + suffix + ".tsv")
+      value = columns[table]
+      with open(path, "w") as outfile:
+        for key in keys:
+          outfile.write("\t".join(fields[key][:2] + [value(cells[key])] + fields[key][2:] + [key[2]]) + "\n")
+      paths[table + suffix] = path
+
+  if sketches is not None:
+    for (suffix, cells) in levelAggregates(configuration, sketches, mergeSketches, lambda sketch: sketch.copy()).items():
+      path = os.path.join(output_dir, "micro_path_intersect_sketch_" + configuration.table_name + suffix + ".tsv")
+      keys = sorted(cells)
+      fields = cellFields(suffix, keys)
+      with open(path, "w") as outfile:
+        for key in keys:
+          outfile.write("\t".join(fields[key][:2] + cells[key].fields() + fields[key][2:] + [key[2]]) + "\n")
+      paths["sketch" + suffix] = path
+  return paths
+
+
+#
+# run the whole pipeline locally, returns the paths of the written tables.
+# Stages are timed and counted in summary (a run_summary.RunSummary) if given.
+#
+def run(configuration, input_paths, output_dir, processes=None, base_path="conf/", summary=None):
+  def stage(name, function, *args):
+    if summary is None:
+      return function(*args)
+    return summary.stage(name, function, *args)
+
+  if not processes:
+    processes = multiprocessing.cpu_count()
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  shard_dir = tempfile.mkdtemp(prefix="micro_path_shards_", dir=output_dir)
+  try:
+    plan = {}
+    if configuration.skew_chunk_fixes > 0:
+      plan = stage("skew_sample", samplePlan, configuration, input_paths)
+      if summary is not None:
+        summary.document["split_tracks"] = dict((track, len(boundaries) + 1) for (track, boundaries) in plan.items())
+    print("sharding input by " + configuration.table_schema_id + (", " + str(len(plan)) + " tracks split into chunks" if plan else ""))
+    shard_paths = stage("shard_input", shardInput, configuration, input_paths, shard_dir, processes * SHARDS_PER_PROCESS, plan)
+
+    print("extracting paths and trip line intersects on " + str(processes) + " processes")
+    jobs = [(configuration.config_file, base_path, shard_path, bool(plan)) for shard_path in shard_paths]
+    (groups, boundaries, counts) = stage("paths_and_intersects", processShards, jobs, processes)
+    if summary is not None:
+      for group in counts:
+        summary.addCounters(group, counts[group])
+    inexact = inexactTracks(boundaries)
+    if inexact:
+      # a filter dropped the last fix of a chunk, these tracks are extracted in one piece
+      print("extracting " + str(len(inexact)) + " split tracks again in one piece")
+      path = joinChunks(shard_paths, inexact, os.path.join(shard_dir, "rejoined.tsv"))
+      (rejoined, unused, counts) = stage("rejoin_tracks", processShard, (configuration.config_file, base_path, path, False))
+      for track in inexact:
+        groups.pop(track, None)
+      mergeGroups(groups, rejoined)
+      addCounts(counts, "micro_path_extract", {"rejoined_tracks": len(inexact)})
+      if summary is not None:
+        for group in counts:
+          summary.addCounters(group, counts[group])
+  finally:
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+  # the crossings of the split tracks go with the others
+  (aggregates, sketches) = groups.pop(None, ({}, {} if configuration.cell_sketches else None))
+  for (group, (partial, partial_sketches)) in groups.items():
+    mergeAggregates(aggregates, partial)
+    if sketches is not None:
+      mergeSketches(sketches, partial_sketches)
+
+  print("aggregate intersection points, velocity and direction")
+  return stage("write_tables", writeTables, configuration, aggregates, output_dir, sketches)
+
+
+#
+# processShard over a pool, returns the merged groups, the boundaries and
+# the counts
+#
+def processShards(jobs, processes):
+  groups = {}
+  boundaries = []
+  counts = {}
+  pool = multiprocessing.Pool(processes)
+  try:
+    for (partial, partial_boundaries, partial_counts) in pool.imap_unordered(processShard, jobs):
+      mergeGroups(groups, partial)
+      boundaries.extend(partial_boundaries)
+      for (group, values) in partial_counts.items():
+        addCounts(counts, group, values)
+  finally:
+    pool.close()
+    pool.join()
+  return (groups, boundaries, counts)
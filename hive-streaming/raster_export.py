@@ -0,0 +1,267 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Binary export of the aggregate tables.
+#
+# Every (table, blanket, time bucket, metric) grid is written to its own
+# file: a HEADER_SIZE byte header followed by the cells, so a viewer can
+# numpy.memmap the data without parsing anything (see openRaster).  The grid
+# spans the tripline index range of the blanket (tripLatMin/Max,
+# tripLonMin/Max): row 0 is the southern most row of cells, column 0 the
+# western most, and the cell at (row, col) has its lower left corner at
+# (lat0 + row * resolution_lat, lon0 + col * resolution_lon).
+#
+# A raster file holds rows * cols values in row major order, cells without
+# crossings are 0.  A coo file holds nnz uint32 row indexes, nnz uint32
+# column indexes and nnz values, sorted by (row, col).  export_format picks
+# one of them or, with auto, whichever is smaller for the grid.
+#
+# The cell of a table row is read from its blanket and cell key columns
+# (see scripts/cell_keys.py), not from its x and y.
+#
+# A manifest.json next to the files lists them with their grid, bucket and
+# metric.
+#
+#   python raster_export.py -c ais.ini -i output -o output/raster
+#
+
+import os
+import re
+import sys
+import json
+import struct
+import subprocess
+from optparse import OptionParser
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from config import AggregateMicroPathConfig
+from cell_keys import gridShape, cellRowCol
+
+MAGIC = "MPGRID01"
+HEADER_SIZE = 256
+# magic, layout, value dtype, rows, cols, nnz, lat0, lon0, resolution lat/lon,
+# nodata, time bucket, metric, blanket name
+HEADER_FORMAT = "<8s8s4sIIQddddd32s16s64s"
+LAYOUTS = ["raster", "coo"]
+# value dtype and column of every metric in the split and wide (stats) tables
+METRICS = [("counts", "<i4", 2, 2), ("velocity", "<f4", 2, 4), ("direction", "<i4", 2, 5)]
+
+
+#
+# (blanket index, (row, col)) of the cell of a table row, from the blanket
+# and cell columns in front of dt.  None for rows without them.
+#
+def cellPosition(configuration, blankets, fields):
+  try:
+    (k, key) = (int(fields[-3]), int(fields[-2]))
+  except (ValueError, IndexError):
+    return None
+  if not 0 <= k < len(blankets):
+    return None
+  return (k, cellRowCol(blankets[k], key, configuration.cell_key))
+
+
+#
+# header fields of a grid file as a dict
+#
+def header(layout, dtype, blanket, nnz, dt, metric):
+  (rows, cols) = gridShape(blanket)
+  return {"layout": layout, "dtype": numpy.dtype(dtype).str, "rows": rows, "cols": cols, "nnz": nnz,
+          "lat0": blanket[7] * blanket[5], "lon0": blanket[9] * blanket[6],
+          "resolution_lat": blanket[5], "resolution_lon": blanket[6], "nodata": 0.0,
+          "dt": dt, "metric": metric, "blanket": str(blanket[4])}
+
+
+def packHeader(fields):
+  packed = struct.pack(HEADER_FORMAT, MAGIC, fields["layout"], fields["dtype"], fields["rows"], fields["cols"],
+                       fields["nnz"], fields["lat0"], fields["lon0"], fields["resolution_lat"], fields["resolution_lon"],
+                       fields["nodata"], fields["dt"], fields["metric"], fields["blanket"])
+  return packed + "\0" * (HEADER_SIZE - len(packed))
+
+
+def unpackHeader(data):
+  values = struct.unpack(HEADER_FORMAT, data[:struct.calcsize(HEADER_FORMAT)])
+  if values[0] != MAGIC:
+    raise ValueError("not a micro path grid file")
+  names = ["layout", "dtype", "rows", "cols", "nnz", "lat0", "lon0", "resolution_lat", "resolution_lon", "nodata",
+           "dt", "metric", "blanket"]
+  return dict(zip(names, [v.rstrip("\0") if isinstance(v, str) else v for v in values[1:]]))
+
+
+#
+# (header, data) of a grid file.  data is a (rows, cols) memmap for a
+# raster and a (row, col, value) tuple of memmaps for a coo file.
+#
+def openRaster(path):
+  with open(path, "rb") as infile:
+    fields = unpackHeader(infile.read(HEADER_SIZE))
+  dtype = numpy.dtype(fields["dtype"])
+  if fields["layout"] == "raster":
+    return (fields, numpy.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(fields["rows"], fields["cols"])))
+  nnz = fields["nnz"]
+  if nnz == 0:
+    return (fields, (numpy.zeros(0, "<u4"), numpy.zeros(0, "<u4"), numpy.zeros(0, dtype)))
+  rows = numpy.memmap(path, dtype="<u4", mode="r", offset=HEADER_SIZE, shape=(nnz,))
+  cols = numpy.memmap(path, dtype="<u4", mode="r", offset=HEADER_SIZE + 4 * nnz, shape=(nnz,))
+  values = numpy.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE + 8 * nnz, shape=(nnz,))
+  return (fields, (rows, cols, values))
+
+
+#
+# raster or coo, whichever file is smaller for nnz cells when layout is auto
+#
+def chooseLayout(layout, blanket, nnz, dtype):
+  if layout != "auto":
+    return layout
+  (rows, cols) = gridShape(blanket)
+  if nnz * (8 + numpy.dtype(dtype).itemsize) < rows * cols * numpy.dtype(dtype).itemsize:
+    return "coo"
+  return "raster"
+
+
+#
+# Write one grid.  The raster file is sized first and only the occupied
+# cells are written through a memmap, so the empty part of a large grid
+# stays a hole in the file on filesystems that support it.
+#
+def writeGrid(path, fields, rows, cols, values):
+  order = numpy.lexsort((cols, rows))
+  (rows, cols, values) = (rows[order], cols[order], values[order])
+  with open(path, "wb") as outfile:
+    outfile.write(packHeader(fields))
+    if fields["layout"] == "coo":
+      outfile.write(rows.astype("<u4").tostring())
+      outfile.write(cols.astype("<u4").tostring())
+      outfile.write(values.tostring())
+      return
+    outfile.truncate(HEADER_SIZE + fields["rows"] * fields["cols"] * values.dtype.itemsize)
+  if len(values):
+    grid = numpy.memmap(path, dtype=values.dtype, mode="r+", offset=HEADER_SIZE, shape=(fields["rows"], fields["cols"]))
+    grid[rows, cols] = values
+    grid.flush()
+    del grid
+
+
+#
+# [(table suffix, blankets)] of every set of aggregate tables
+#
+def tableLevels(configuration):
+  return [(suffix, configuration.levelBlankets(level)) for (level, split, suffix) in configuration.outputLevels()]
+
+
+#
+# lines of an aggregate table: the .tsv written by a local run in source
+# when it is a directory, the hive table otherwise
+#
+def tableLines(configuration, name, source):
+  if source is not None:
+    path = os.path.join(source, name + ".tsv")
+    with open(path) as infile:
+      for line in infile:
+        yield line
+    return
+  process = subprocess.Popen(["hive", "-S", "-e", "SELECT * FROM " + configuration.database_name + "." + name + ";"],
+                             stdout=subprocess.PIPE)
+  for line in process.stdout:
+    yield line
+  if process.wait() != 0:
+    raise RuntimeError("hive query of " + name + " failed")
+
+
+#
+# [(table, [(metric, dtype, column)])]: the split tables when there are any,
+# the stats table holding all metrics otherwise
+#
+def metricTables(configuration, suffix):
+  if configuration.aggregation_output in ("split", "both"):
+    return [("micro_path_intersect_" + metric + "_" + configuration.table_name + suffix, [(metric, dtype, split_column)])
+            for (metric, dtype, split_column, stats_column) in METRICS]
+  return [("micro_path_intersect_stats_" + configuration.table_name + suffix,
+           [(metric, dtype, stats_column) for (metric, dtype, split_column, stats_column) in METRICS])]
+
+
+def fileLabel(value):
+  return re.sub(r'[^\w.-]+', '_', str(value)).strip('_')
+
+
+#
+# Write the grids of every aggregate table to output_dir.  source is the
+# output directory of a local run, None reads the hive tables.  Returns
+# the manifest entries.
+#
+def export(configuration, output_dir, source=None, layout=None):
+  if layout is None:
+    layout = configuration.export_format
+  if layout not in LAYOUTS + ["auto"]:
+    raise ValueError("unknown export_format " + layout)
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  manifest = []
+  for (suffix, blankets) in tableLevels(configuration):
+    for (table, metrics) in metricTables(configuration, suffix):
+      # (blanket, dt) -> [rows, cols, [values of every metric]]
+      cells = {}
+      for line in tableLines(configuration, table, source):
+        fields = line.rstrip("\r\n").split("\t")
+        cell = cellPosition(configuration, blankets, fields)
+        if cell is None:
+          continue
+        (k, position) = cell
+        grid = cells.get((k, fields[-1]))
+        if grid is None:
+          grid = cells[(k, fields[-1])] = ([], [], [[] for metric in metrics])
+        grid[0].append(position[0])
+        grid[1].append(position[1])
+        for (values, (metric, dtype, column)) in zip(grid[2], metrics):
+          values.append(fields[column])
+
+      for ((k, dt), (rows, cols, columns)) in sorted(cells.items()):
+        blanket = blankets[k]
+        rows = numpy.array(rows, dtype=numpy.int64)
+        cols = numpy.array(cols, dtype=numpy.int64)
+        for (values, (metric, dtype, column)) in zip(columns, metrics):
+          values = numpy.array([float(v) for v in values]).astype(dtype)
+          grid_layout = chooseLayout(layout, blanket, len(values), dtype)
+          fields = header(grid_layout, dtype, blanket, len(values), dt, metric)
+          parts = [configuration.table_name + suffix, blanket[4] if len(blankets) > 1 else None, dt, metric]
+          name = "_".join(fileLabel(part) for part in parts if part is not None) + "." + grid_layout
+          writeGrid(os.path.join(output_dir, name), fields, rows, cols, values)
+          entry = dict(fields)
+          entry["file"] = name
+          entry["table"] = table
+          manifest.append(entry)
+
+  with open(os.path.join(output_dir, "manifest.json"), "w") as outfile:
+    json.dump(manifest, outfile, indent=1, sort_keys=True)
+  return manifest
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-c", "--config", dest="configFile", help="REQUIRED: name of configuration file in conf/")
+  parser.add_option("-i", "--input", dest="inputDir", help="output directory of a local run, the hive tables are read without it")
+  parser.add_option("-o", "--output", dest="outputDir", default="output/raster", help="directory for the grid files")
+  parser.add_option("-f", "--format", dest="layout", help="raster, coo or auto, export_format of the config by default")
+  (options, args) = parser.parse_args()
+  if not options.configFile:
+    parser.print_help()
+    exit(1)
+  configuration = AggregateMicroPathConfig(options.configFile, os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf/"))
+  manifest = export(configuration, options.outputDir, options.inputDir, options.layout)
+  print("wrote " + str(len(manifest)) + " grids to " + options.outputDir)
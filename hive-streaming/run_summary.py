@@ -0,0 +1,129 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Timing and counter summary of a run.
+#
+# Every stage is timed.  Hive stages note the ids of the jobs hive started
+# (see watchHiveOutput) and the micro_path_* counters of the streaming
+# scripts are read back from those jobs with `mapred job -status`; local runs
+# add their counters directly.  The summary is written as JSON.
+#
+
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+
+COUNTER_GROUP_PREFIX = "micro_path"
+JOB_PATTERN = re.compile(r"Starting Job = (job_\w+)")
+
+# ids of the hadoop jobs started since the current stage began
+launched_jobs = []
+
+
+#
+# copy hive's stderr through and remember the jobs it starts, in jobs when
+# given (hive sessions running side by side) or in launched_jobs
+#
+def watchHiveOutput(stream, jobs=None):
+  if jobs is None:
+    jobs = launched_jobs
+  for line in iter(stream.readline, ''):
+    sys.stderr.write(line)
+    match = JOB_PATTERN.search(line)
+    if match and match.group(1) not in jobs:
+      jobs.append(match.group(1))
+
+
+#
+# {group: {counter: value}} of the micro_path_* counter groups of a job, as
+# printed by `mapred job -status`: a tab and the group name, then two tabs
+# and name=value for every counter
+#
+def jobCounters(job_id):
+  try:
+    process = subprocess.Popen(["mapred", "job", "-status", job_id], stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    (out, err) = process.communicate()
+  except OSError:
+    return {}
+  counters = {}
+  group = None
+  for line in out.splitlines():
+    if line.startswith("\t\t") and group is not None and "=" in line:
+      (name, value) = line.strip().rsplit("=", 1)
+      try:
+        counters.setdefault(group, {})[name] = int(value)
+      except ValueError:
+        pass
+    elif line.startswith("\t") and not line.startswith("\t\t"):
+      group = line.strip() if line.strip().startswith(COUNTER_GROUP_PREFIX) else None
+  return counters
+
+
+def addCounts(total, group, counts):
+  target = total.setdefault(group, {})
+  for (name, value) in counts.items():
+    target[name] = target.get(name, 0) + value
+
+
+class RunSummary():
+  def __init__(self, configuration, mode):
+    self.start = time.time()
+    self.document = {"config": configuration.config_file, "table": configuration.table_name, "mode": mode,
+                     "start": self.start, "stages": []}
+
+  #
+  # run function(*args) as the stage name, returns what it returns
+  #
+  def stage(self, name, function, *args):
+    del launched_jobs[:]
+    started = time.time()
+    try:
+      return function(*args)
+    finally:
+      self.record(name, started, time.time() - started, launched_jobs)
+
+  #
+  # add a stage that ran elsewhere (e.g. a hive session of the stage DAG)
+  # and the counters of the jobs it started
+  #
+  def record(self, name, started, seconds, jobs=()):
+    entry = {"name": name, "start": started, "seconds": seconds, "counters": {}}
+    self.document["stages"].append(entry)
+    if jobs:
+      entry["jobs"] = list(jobs)
+      for job_id in jobs:
+        for (group, counts) in jobCounters(job_id).items():
+          addCounts(entry["counters"], group, counts)
+
+  #
+  # add counts to the stage that ran last
+  #
+  def addCounters(self, group, counts):
+    addCounts(self.document["stages"][-1]["counters"], group, counts)
+
+  def finish(self, output_dir=None):
+    self.document["seconds"] = time.time() - self.start
+    text = json.dumps(self.document, indent=2, sort_keys=True)
+    if output_dir:
+      if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+      path = os.path.join(output_dir, "micro_path_summary_" + self.document["table"] + ".json")
+      with open(path, "w") as outfile:
+        outfile.write(text + "\n")
+      self.document["path"] = path
+    return text
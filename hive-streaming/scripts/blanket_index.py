@@ -0,0 +1,98 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Grid index over the bounding boxes of the tripline blankets.
+#
+# A segment is only processed by a blanket that contains one of its end
+# points (betweenpts in tripline_bins.py), so each blanket is registered in
+# every grid cell its box, padded by the betweenpts threshold, overlaps and
+# a segment looks up the cells of its two end points.  Blankets spanning
+# more than max_cells grid cells are checked for every segment instead.
+# Segments routed over the dateline can be shifted by an earlier blanket,
+# they are candidates for every blanket.
+#
+
+import math
+
+BETWEEN_THRESHOLD = 0.0000001
+
+
+class BlanketIndex():
+  def __init__(self, blankets, cell_size=1.0, max_cells=10000):
+    self.blankets = blankets
+    self.cell_size = float(cell_size)
+    self.cells = {}
+    self.everywhere = []
+    for (i, blanket) in enumerate(blankets):
+      latLo = self.cellIndex(min(blanket[0], blanket[2]) - BETWEEN_THRESHOLD)
+      latHi = self.cellIndex(max(blanket[0], blanket[2]) + BETWEEN_THRESHOLD)
+      lonLo = self.cellIndex(min(blanket[1], blanket[3]) - BETWEEN_THRESHOLD)
+      lonHi = self.cellIndex(max(blanket[1], blanket[3]) + BETWEEN_THRESHOLD)
+      if (latHi - latLo + 1) * (lonHi - lonLo + 1) > max_cells:
+        self.everywhere.append(i)
+        continue
+      for ci in range(latLo, latHi + 1):
+        for cj in range(lonLo, lonHi + 1):
+          self.cells.setdefault((ci, cj), []).append(i)
+
+  def cellIndex(self, value):
+    return int(math.floor(value / self.cell_size))
+
+  def pointBlankets(self, lat, lon):
+    return self.cells.get((self.cellIndex(lat), self.cellIndex(lon)), [])
+
+  #
+  # the indexes of the blankets a segment can touch, in config order
+  #
+  def segmentBlanketIndexes(self, lat1, lon1, lat2, lon2):
+    if abs(lon1 - lon2) > 180:
+      return range(len(self.blankets))
+    found = set(self.everywhere)
+    found.update(self.pointBlankets(lat1, lon1))
+    found.update(self.pointBlankets(lat2, lon2))
+    return sorted(found)
+
+  #
+  # the blankets a segment can touch, in config order
+  #
+  def segmentBlankets(self, lat1, lon1, lat2, lon2):
+    return [self.blankets[i] for i in self.segmentBlanketIndexes(lat1, lon1, lat2, lon2)]
+
+  #
+  # Array version for the vector engine: a list holding, for every blanket,
+  # the sorted indexes of the segments that can touch it.
+  #
+  def candidateSegments(self, lat1, lon1, lat2, lon2):
+    import numpy
+
+    lat1 = numpy.asarray(lat1, dtype=numpy.float64)
+    lon1 = numpy.asarray(lon1, dtype=numpy.float64)
+    lat2 = numpy.asarray(lat2, dtype=numpy.float64)
+    lon2 = numpy.asarray(lon2, dtype=numpy.float64)
+    everything = numpy.arange(len(lat1))
+    wrapped = numpy.nonzero(numpy.abs(lon1 - lon2) > 180)[0]
+
+    found = [[wrapped] for blanket in self.blankets]
+    for i in self.everywhere:
+      found[i] = [everything]
+    for (lat, lon) in ((lat1, lon1), (lat2, lon2)):
+      keys = numpy.column_stack((numpy.floor(lat / self.cell_size), numpy.floor(lon / self.cell_size))).astype(numpy.int64)
+      (cells, inverse) = numpy.unique(keys, axis=0, return_inverse=True)
+      order = numpy.argsort(inverse, kind='mergesort')
+      bounds = numpy.searchsorted(inverse[order], numpy.arange(len(cells) + 1))
+      for (c, (ci, cj)) in enumerate(cells.tolist()):
+        for i in self.cells.get((ci, cj), []):
+          found[i].append(order[bounds[c]:bounds[c+1]])
+    return [numpy.unique(numpy.concatenate(parts)) if len(parts) > 1 else parts[0] for parts in found]
@@ -0,0 +1,147 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Integer cell keys.
+#
+# A crossing is keyed by its blanket, the index of the blanket in
+# triplineBlankets (levelBlankets for the levels of a pyramid), and the
+# (row, col) of its cell in the grid of that blanket: row 0 is the row of
+# cells north of tripline blanket[7], col 0 the column east of tripline
+# blanket[9].  cell_key picks how (row, col) is packed into one integer:
+#
+#   rowmajor  row * cols + col
+#   morton    the bits of col on the even, those of row on the odd
+#             positions (Z order), so cells close on the map mostly get
+#             close keys
+#
+# The lat/lon of the cell centre is only worked out when a table is
+# written (cellCentre), as a decimal with one digit more than the
+# resolution, e.g. -15.55 for a cell of 0.1 degrees.
+#
+
+import math
+
+CELL_KEYS = ["rowmajor", "morton"]
+MORTON_BITS = 32
+
+
+def gridShape(blanket):
+  return (blanket[8] - blanket[7], blanket[10] - blanket[9])
+
+
+#
+# Morton code of (row, col) and back, see also the array versions below
+#
+def morton(row, col):
+  key = 0
+  for bit in range(MORTON_BITS):
+    key |= ((col >> bit) & 1) << (2 * bit) | ((row >> bit) & 1) << (2 * bit + 1)
+  return key
+
+def unmorton(key):
+  (row, col) = (0, 0)
+  for bit in range(MORTON_BITS):
+    col |= ((key >> (2 * bit)) & 1) << bit
+    row |= ((key >> (2 * bit + 1)) & 1) << bit
+  return (row, col)
+
+
+#
+# key of the cell at the tripline indexes (i, j) of blanket, None when the
+# cell is off the blanket grid
+#
+def cellKey(blanket, i, j, order="rowmajor"):
+  (rows, cols) = gridShape(blanket)
+  (row, col) = (i - blanket[7], j - blanket[9])
+  if not (0 <= row < rows and 0 <= col < cols):
+    return None
+  if order == "morton":
+    return morton(row, col)
+  if order == "rowmajor":
+    return row * cols + col
+  raise ValueError("unknown cell_key " + order + ", one of " + ", ".join(CELL_KEYS))
+
+def cellRowCol(blanket, key, order="rowmajor"):
+  key = int(key)
+  if order == "morton":
+    return unmorton(key)
+  if order == "rowmajor":
+    return divmod(key, gridShape(blanket)[1])
+  raise ValueError("unknown cell_key " + order + ", one of " + ", ".join(CELL_KEYS))
+
+
+#
+# decimals of the centres of cells of resolution, cells of a power of ten
+# degrees are centred on half of it
+#
+def centreDecimals(resolution):
+  return max(1, int(round(-math.log10(resolution))) + 1)
+
+#
+# (lat, lon) of the centre of the cell at (row, col) as output strings
+#
+def cellCentre(blanket, row, col):
+  return ("%.*f" % (centreDecimals(blanket[5]), (blanket[7] + row + 0.5) * blanket[5]),
+          "%.*f" % (centreDecimals(blanket[6]), (blanket[9] + col + 0.5) * blanket[6]))
+
+def keyCentre(blanket, key, order="rowmajor"):
+  (row, col) = cellRowCol(blanket, key, order)
+  return cellCentre(blanket, row, col)
+
+
+#
+# Array versions for the vector engine and the store (need numpy)
+#
+def spreadBits(values):
+  import numpy
+  values = numpy.asarray(values, dtype=numpy.uint64) & numpy.uint64(0xffffffff)
+  for (shift, mask) in ((16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff), (4, 0x0f0f0f0f0f0f0f0f),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+    values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+  return values
+
+def compactBits(values):
+  import numpy
+  values = numpy.asarray(values, dtype=numpy.uint64) & numpy.uint64(0x5555555555555555)
+  for (shift, mask) in ((1, 0x3333333333333333), (2, 0x0f0f0f0f0f0f0f0f), (4, 0x00ff00ff00ff00ff),
+                        (8, 0x0000ffff0000ffff), (16, 0x00000000ffffffff)):
+    values = (values | (values >> numpy.uint64(shift))) & numpy.uint64(mask)
+  return values
+
+def mortonKeys(rows, cols):
+  import numpy
+  return (spreadBits(rows) << numpy.uint64(1)) | spreadBits(cols)
+
+def mortonCells(keys):
+  import numpy
+  keys = numpy.asarray(keys, dtype=numpy.uint64)
+  return (compactBits(keys >> numpy.uint64(1)).astype(numpy.int64), compactBits(keys).astype(numpy.int64))
+
+#
+# (keys, on grid mask) of the cells at the tripline indexes (i, j) of
+# blanket, keys only hold the cells on the grid
+#
+def cellKeyArrays(blanket, i, j, order="rowmajor"):
+  import numpy
+  (rows, cols) = gridShape(blanket)
+  row = numpy.asarray(i, dtype=numpy.int64) - blanket[7]
+  col = numpy.asarray(j, dtype=numpy.int64) - blanket[9]
+  on = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+  (row, col) = (row[on], col[on])
+  if order == "morton":
+    return (mortonKeys(row, col).astype(numpy.int64), on)
+  if order == "rowmajor":
+    return (row * cols + col, on)
+  raise ValueError("unknown cell_key " + order + ", one of " + ", ".join(CELL_KEYS))
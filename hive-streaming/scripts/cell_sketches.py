@@ -0,0 +1,376 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Mergeable per cell sketches of the tripline crossings.
+#
+# Every (cell, time bucket) gets a HyperLogLog sketch of the track ids that
+# crossed it, so a vessel jittering across a tripline counts as one track,
+# and a t-digest of the crossing velocities for their quantiles.  Both take
+# a fixed amount of memory however many crossings they see (2^hll_precision
+# registers, about tdigest_compression centroids) and two sketches of the
+# same cell merge into the sketch of all their crossings.
+#
+# As a hive TRANSFORM the script runs twice:
+#
+#   map     reads the tripline bins rows (blanket, cell, dt, velocity,
+#           track_id, crossings, level, rollup_dts), keeps the
+#           sketches of at most sketch_cells cells and flushes the least
+#           recently used one as a partial sketch row when full
+#   reduce  reads the partial sketch rows sorted by cell and merges the
+#           consecutive rows of every cell into one output row, with the
+#           centre of the cell (see cell_keys.py)
+#
+# Rows the in-mapper combiner of tripline_bins.py (tripline_combine_size)
+# pre-aggregated have lost their track ids and hold velocity sums: they go
+# into the digest as their mean velocity weighted by their crossings, and are
+# counted as sketch_rows_without_id, but can't be added to the track sketch.
+#
+
+import sys
+import math
+import base64
+import struct
+import hashlib
+import collections
+sys.path.append('./')
+
+sys.path.append('../conf')
+from config import loadConfig
+from counters import Counters
+import cell_keys
+
+# quantiles of the velocity columns of the sketch tables
+QUANTILES = [0.5, 0.9, 0.99]
+# a HyperLogLog keeps its registers in a dict until more than 1 / SPARSE_FRACTION
+# of them are set
+SPARSE_FRACTION = 16
+# unmerged values a t-digest buffers, in multiples of its compression
+BUFFER_FACTOR = 4
+
+
+#
+# 64 bit hash of a track id, the same in every process
+#
+def hash64(value):
+  return struct.unpack("<Q", hashlib.md5(value).digest()[:8])[0]
+
+
+#
+# HyperLogLog (Flajolet et al.) with 2^precision one byte registers, sparse
+# while few registers are set.  The standard error of estimate() is about
+# 1.04 / sqrt(2^precision), small counts are exact up to hash collisions
+# (linear counting).
+#
+class HyperLogLog():
+  def __init__(self, precision=12):
+    if not 4 <= precision <= 16:
+      raise ValueError("hll_precision has to be between 4 and 16")
+    self.precision = precision
+    self.sparse = {}
+    self.registers = None
+
+  def add(self, value):
+    h = hash64(value)
+    rest = 64 - self.precision
+    self.set(h >> rest, rest - (h & ((1 << rest) - 1)).bit_length() + 1)
+
+  def set(self, index, rank):
+    if self.registers is not None:
+      if rank > self.registers[index]:
+        self.registers[index] = rank
+      return
+    if rank > self.sparse.get(index, 0):
+      self.sparse[index] = rank
+      if len(self.sparse) > (1 << self.precision) // SPARSE_FRACTION:
+        self.densify()
+
+  def densify(self):
+    self.registers = bytearray(1 << self.precision)
+    for (index, rank) in self.sparse.items():
+      self.registers[index] = rank
+    self.sparse = None
+
+  def merge(self, other):
+    if other.precision != self.precision:
+      raise ValueError("can't merge HyperLogLog sketches of precision %d and %d" % (self.precision, other.precision))
+    if other.registers is None:
+      for (index, rank) in other.sparse.items():
+        self.set(index, rank)
+      return
+    if self.registers is None:
+      self.densify()
+    self.registers = bytearray(max(pair) for pair in zip(self.registers, other.registers))
+
+  def estimate(self):
+    m = 1 << self.precision
+    ranks = self.sparse.values() if self.registers is None else [rank for rank in self.registers if rank]
+    zeros = m - len(ranks)
+    harmonic = zeros + sum(2.0 ** -rank for rank in ranks)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    estimate = alpha * m * m / harmonic
+    if estimate <= 2.5 * m and zeros:
+      estimate = m * math.log(float(m) / zeros)
+    return int(round(estimate))
+
+  #
+  # <precision>:s<base64 of (index, rank) pairs> while sparse,
+  # <precision>:d<base64 of the registers> once dense
+  #
+  def serialize(self):
+    if self.registers is None:
+      pairs = "".join(struct.pack("<HB", index, rank) for (index, rank) in sorted(self.sparse.items()))
+      return "%d:s%s" % (self.precision, base64.b64encode(pairs))
+    return "%d:d%s" % (self.precision, base64.b64encode(str(self.registers)))
+
+  @staticmethod
+  def parse(text):
+    (precision, data) = text.split(":", 1)
+    sketch = HyperLogLog(int(precision))
+    packed = base64.b64decode(data[1:])
+    if data[0] == "d":
+      sketch.sparse = None
+      sketch.registers = bytearray(packed)
+    else:
+      for offset in range(0, len(packed), 3):
+        sketch.set(*struct.unpack("<HB", packed[offset:offset + 3]))
+    return sketch
+
+
+#
+# Merging t-digest (Dunning) with the k1 (arcsine) scale function: centroids
+# at the tails hold few values, so the high quantiles stay accurate, and
+# there are never more than about compression of them.
+#
+class TDigest():
+  def __init__(self, compression=100):
+    self.compression = float(compression)
+    self.centroids = []
+    self.buffer = []
+    self.total = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, value, weight=1.0):
+    self.buffer.append((value, float(weight)))
+    self.total += weight
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    if len(self.buffer) >= BUFFER_FACTOR * self.compression:
+      self.compress()
+
+  def merge(self, other):
+    if other.total == 0:
+      return
+    self.buffer.extend(other.centroids)
+    self.buffer.extend(other.buffer)
+    self.total += other.total
+    self.min = other.min if self.min is None else min(self.min, other.min)
+    self.max = other.max if self.max is None else max(self.max, other.max)
+    if len(self.buffer) >= BUFFER_FACTOR * self.compression:
+      self.compress()
+
+  def limit(self, q):
+    k = self.compression / (2 * math.pi) * math.asin(2 * min(1.0, q) - 1) + 1
+    if k >= self.compression / 4:
+      return self.total
+    return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2 * self.total
+
+  def compress(self):
+    if not self.buffer:
+      return
+    points = sorted(self.centroids + self.buffer)
+    self.buffer = []
+    centroids = []
+    (mean, weight) = points[0]
+    done = 0.0
+    limit = self.limit(0.0)
+    for (value, w) in points[1:]:
+      if done + weight + w <= limit:
+        weight += w
+        mean += (value - mean) * w / weight
+      else:
+        centroids.append((mean, weight))
+        done += weight
+        limit = self.limit(done / self.total)
+        (mean, weight) = (value, w)
+    centroids.append((mean, weight))
+    self.centroids = centroids
+
+  #
+  # value at quantile q, interpolated between the centres of the centroids
+  # and towards min and max at the ends.  None when empty.
+  #
+  def quantile(self, q):
+    self.compress()
+    if not self.centroids:
+      return None
+    target = q * self.total
+    (mean, weight) = self.centroids[0]
+    if target < weight / 2:
+      return self.min + (mean - self.min) * target / (weight / 2)
+    done = 0.0
+    for ((mean, weight), (nextMean, nextWeight)) in zip(self.centroids, self.centroids[1:]):
+      centre = done + weight / 2
+      nextCentre = done + weight + nextWeight / 2
+      if target <= nextCentre:
+        return mean + (nextMean - mean) * (target - centre) / (nextCentre - centre)
+      done += weight
+    (mean, weight) = self.centroids[-1]
+    centre = self.total - weight / 2
+    if target >= self.total or weight <= 0:
+      return self.max
+    return mean + (self.max - mean) * (target - centre) / (weight / 2)
+
+  #
+  # <compression>:<base64 of min, max and the (mean, weight) pairs as doubles>
+  #
+  def serialize(self):
+    self.compress()
+    values = [self.min or 0.0, self.max or 0.0] + [v for centroid in self.centroids for v in centroid]
+    return "%g:%s" % (self.compression, base64.b64encode(struct.pack("<%dd" % len(values), *values)))
+
+  @staticmethod
+  def parse(text):
+    (compression, data) = text.split(":", 1)
+    digest = TDigest(float(compression))
+    packed = base64.b64decode(data)
+    values = struct.unpack("<%dd" % (len(packed) // 8), packed)
+    digest.centroids = zip(values[2::2], values[3::2])
+    digest.total = sum(weight for (mean, weight) in digest.centroids)
+    if digest.centroids:
+      (digest.min, digest.max) = values[:2]
+    return digest
+
+
+#
+# the track and velocity sketches of one cell
+#
+class CellSketch():
+  def __init__(self, precision=12, compression=100, tracks=None, velocity=None):
+    self.tracks = tracks if tracks is not None else HyperLogLog(precision)
+    self.velocity = velocity if velocity is not None else TDigest(compression)
+
+  #
+  # a crossing, or a combined row of crossings (see the module comment) when
+  # track_id is None
+  #
+  def add(self, track_id, velocity, crossings=1):
+    if track_id is not None:
+      self.tracks.add(track_id)
+    self.velocity.add(velocity / crossings, crossings)
+
+  def merge(self, other):
+    self.tracks.merge(other.tracks)
+    self.velocity.merge(other.velocity)
+    return self
+
+  def copy(self):
+    return CellSketch(self.tracks.precision, self.velocity.compression).merge(self)
+
+  #
+  # crossings, distinct tracks, the QUANTILES of the velocity and the two
+  # serialized sketches, as output fields
+  #
+  def fields(self):
+    quantiles = [self.velocity.quantile(q) for q in QUANTILES]
+    return ([str(int(round(self.velocity.total))), str(self.tracks.estimate())] + [repr(q) for q in quantiles] +
+            [self.tracks.serialize(), self.velocity.serialize()])
+
+  def serialize(self):
+    return [self.tracks.serialize(), self.velocity.serialize()]
+
+  @staticmethod
+  def parse(tracks, velocity):
+    return CellSketch(tracks=HyperLogLog.parse(tracks), velocity=TDigest.parse(velocity))
+
+
+def newSketch(configuration):
+  return CellSketch(configuration.hll_precision, configuration.tdigest_compression)
+
+
+#
+# Map side.  Rows of the tripline bins table become partial sketches keyed by
+# (level, split, blanket, cell, bucket): one for the temporal_split bucket of the row
+# and one for each of its rollup_dts buckets.  At most max_entries sketches
+# are held, the least recently used one is written out when it runs full.
+#
+def mapRows(configuration, rows, counters, max_entries):
+  splits = [configuration.temporal_split] + configuration.rollup_splits
+  entries = collections.OrderedDict()
+  for fields in rows:
+    (blanket, cell, dt, velocity, track_id, crossings) = fields[:6]
+    level = fields[6] if len(fields) > 6 and fields[6] not in ("", "\\N") else "0"
+    buckets = [dt]
+    if len(fields) > 7 and fields[7] not in ("", "\\N"):
+      buckets += fields[7].split(",")
+    if track_id in ("", "\\N"):
+      track_id = None
+      counters.increment('sketch_rows_without_id')
+    crossings = int(crossings) if crossings not in ("", "\\N") else 1
+    velocity = float(velocity)
+    for (split, bucket) in zip(splits, buckets):
+      key = (level, split, blanket, cell, bucket)
+      sketch = entries.pop(key, None)
+      if sketch is None:
+        sketch = newSketch(configuration)
+      sketch.add(track_id, velocity, crossings)
+      entries[key] = sketch
+      if len(entries) > max_entries:
+        (key, sketch) = entries.popitem(last=False)
+        yield list(key) + sketch.serialize()
+  while entries:
+    (key, sketch) = entries.popitem(last=False)
+    yield list(key) + sketch.serialize()
+
+
+#
+# Reduce side.  Merges consecutive partial sketch rows of the same key into
+# (level, split, x, y, crossings, tracks, velocity quantiles..., tracks
+# sketch, velocity sketch, blanket, cell, bucket) rows.
+#
+def reduceRows(configuration, rows, counters):
+  def row(key, sketch):
+    blanket = configuration.levelBlankets(int(key[0]))[int(key[2])]
+    centre = cell_keys.keyCentre(blanket, key[3], configuration.cell_key)
+    return list(key[:2]) + list(centre) + sketch.fields() + list(key[2:])
+  key = None
+  sketch = None
+  for fields in rows:
+    counters.increment('sketch_partials')
+    partial = CellSketch.parse(fields[5], fields[6])
+    if tuple(fields[:5]) == key:
+      sketch.merge(partial)
+      continue
+    if key is not None:
+      yield row(key, sketch)
+    (key, sketch) = (tuple(fields[:5]), partial)
+  if key is not None:
+    yield row(key, sketch)
+
+
+if __name__ == "__main__":
+  configuration = loadConfig(sys.argv.pop())
+  mode = sys.argv.pop()
+  counters = Counters("micro_path_sketch", sys.stderr)
+  rows = (line.rstrip("\n").split("\t") for line in sys.stdin)
+  if mode == "map":
+    out = mapRows(configuration, rows, counters, configuration.sketch_cells)
+  else:
+    out = reduceRows(configuration, rows, counters)
+  for fields in out:
+    sys.stdout.write("\t".join(fields) + "\n")
+  counters.flush()
@@ -0,0 +1,93 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Counters of the streaming scripts.
+#
+# Counts are kept in memory.  With a stream (stderr under hadoop streaming)
+# flush() writes them as reporter:counter:<group>,<name>,<amount> lines,
+# which the framework adds to the job counters, and starts over from zero;
+# without one they just add up (local runs read counts at the end).
+#
+
+import time
+
+# every SAMPLE_EVERY-th row is timed, a prime so the samples don't line up
+# with the chunks of the vector engine
+SAMPLE_EVERY = 997
+FLUSH_EVERY = 100000
+
+
+class Counters():
+  def __init__(self, group, stream=None):
+    self.group = group
+    self.stream = stream
+    self.counts = {}
+
+  def increment(self, name, amount=1):
+    self.counts[name] = self.counts.get(name, 0) + amount
+
+  def flush(self):
+    if self.stream is None:
+      return
+    for name in sorted(self.counts):
+      if self.counts[name]:
+        self.stream.write("reporter:counter:%s,%s,%d\n" % (self.group, name, self.counts[name]))
+    self.stream.flush()
+    self.counts = {}
+
+
+#
+# Pass rows through, counting them as rows_in and flushing the counters
+# every FLUSH_EVERY rows.  The time from handing out a sampled row until the
+# next one is pulled is the work spent on it downstream, it is added up in
+# sampled_micros over sampled_rows.  Batched work (the vector engine) only
+# lands on the row closing a chunk, elapsed_micros, the time from the first
+# row to the end of the input, gives the mean for those.
+#
+def timedRows(rows, counters, every=SAMPLE_EVERY):
+  n = 0
+  started = None
+  first = None
+  for row in rows:
+    if first is None:
+      first = time.time()
+    if started is not None:
+      counters.increment('sampled_micros', int((time.time() - started) * 1000000))
+      counters.increment('sampled_rows')
+      started = None
+    n += 1
+    if n % FLUSH_EVERY == 0:
+      counters.increment('rows_in', FLUSH_EVERY)
+      counters.flush()
+    if n % every == 0:
+      started = time.time()
+    yield row
+  if started is not None:
+    counters.increment('sampled_micros', int((time.time() - started) * 1000000))
+    counters.increment('sampled_rows')
+  counters.increment('rows_in', n % FLUSH_EVERY)
+  if first is not None:
+    counters.increment('elapsed_micros', int((time.time() - first) * 1000000))
+
+
+#
+# pass rows through, counting them under name
+#
+def countedRows(rows, counters, name):
+  n = 0
+  for row in rows:
+    n += 1
+    yield row
+  counters.increment(name, n)
@@ -13,17 +13,15 @@
 # limitations under the License.
 
 import sys
-import datetime
-from datetime import datetime
 import math
+import bisect
+import itertools
 sys.path.append('./') 
-from config import AggregateMicroPathConfig
+from config import loadConfig
+from timestamps import TimestampParser, TemporalBucketer
+from counters import Counters, timedRows
 
-current_user = None
-prevtime = None
-prevline = None
-hash_latlon = None
-dt_parse = None
+INFINITY = float('inf')
 
 #
 # print usage to command line and exit
@@ -58,90 +56,774 @@ def computeDistanceKM(lat1, lon1, lat2, lon2):
   d = float(R * c)
   return d
 
-def dateStrptime(dt):
-    try:
-        return datetime.strptime(dt, '%Y-%m-%d %H:%M:%S')
-    except ValueError:
-        pass
-    try:
-        return datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S')
-    except ValueError:
-        pass
-    return None
-
-configuration = AggregateMicroPathConfig(sys.argv.pop())
-for line in sys.stdin:
-  line = line.replace('\"','') # remove quotes
-  #print line+"\n"
-  
-  #(user_id, dt, lat, lon) = line.strip().split("\t")
-  (user_id, dt, lat, lon) = map(lambda x: x.strip(),line.split("\t"))
-  try:
-    dt = dt.split('.')[0]
-    dt_parse = dateStrptime(dt)
-    if not dt_parse:
-        continue
-  except:
-      continue
+#
+# split the tab separated TRANSFORM input into (user_id, dt, lat, lon)
+#
+def parseLines(stream):
+  for line in stream:
+    line = line.replace('\"','') # remove quotes
+    #print line+"\n"
+
+    #(user_id, dt, lat, lon) = line.strip().split("\t")
+    yield [field.strip() for field in line.split("\t")]
 
-  if current_user is None or current_user != user_id:
-    current_user = user_id
-    prevtime = dt_parse
-    prevline = (user_id, dt_parse, lat, lon)
-    hash_latlon = {}
-    continue
-  delta = dt_parse-prevline[1]
-  total_time = float(delta.days*24*60*60+delta.seconds)
+#
+# Step a track from prevline, the (id, epoch dt, lat, lon) fix its last
+# segment ended on, to the next fix.  Returns the segment between them, or
+# None when the fix is filtered out or didn't move, and the fix the next
+# segment starts from.  counters, when given, counts why fixes were dropped.
+#
+def nextSegment(configuration, prevline, fix, counters=None):
+  (user_id, dt_parse, lat, lon) = fix
+  total_time = float(dt_parse-prevline[1])
   #if too much time had passed... then skip the line
   if total_time > configuration.time_filter:  
-    continue
+    if counters is not None:
+      counters.increment('dropped_time_filter')
+    return (None, prevline)
   (auid,adt,alt,aln) = prevline
-  (buid,bdt,blt,bln) = (user_id, dt_parse, lat, lon)
-  
+  (buid,bdt,blt,bln) = fix
+
   try:
     alt = float(alt)
     aln = float(aln)
     blt = float(blt)
     bln = float(bln)
+    #float() reads nan and inf too, they are no more a position than junk
+    if not all(-INFINITY < value < INFINITY for value in (alt, aln, blt, bln)):
+      raise ValueError(str((alt, aln, blt, bln)))
   except:
-    continue
+    if counters is not None:
+      counters.increment('dropped_bad_coordinates')
+    return (None, prevline)
 
   distance = computeDistanceKM(alt, aln, blt, bln)
 
   #if the distance was too large, skip the segment
   if distance > configuration.distance_filter:
-    continue
+    if counters is not None:
+      counters.increment('dropped_distance_filter')
+    return (None, prevline)
 
   #calculate km / hr
-            
+          
   latitude_diff = abs(float(alt) - float(blt))
   longitude_diff = abs(float(aln) - float(bln))
 
   #Make sure we actually went somewhere and didn't stay stationary
-  if latitude_diff + longitude_diff > 0:
-                
-    hash_latlon[str(alt) + ',' + str(aln) + ',' + str(blt) + ',' + str(bln)] = 1
-    segment = []
-    segment.append(user_id)
-    segment.append(str(alt))
-    segment.append(str(blt))         
-    segment.append(str(aln))
-    segment.append(str(bln))
-    segment.append(str(adt))
-    segment.append(str(bdt))
-    segment.append(str(total_time))
-    segment.append(str(distance))
-    
-    if total_time == 0:
-      segment.append('-1')
+  if latitude_diff + longitude_diff == 0:
+    if counters is not None:
+      counters.increment('dropped_stationary')
+    return (None, fix)
+
+  #a jump without time passing is too fast for any velocity_filter
+  velocity = -1
+  if total_time != 0:
+    velocity = distance/(total_time/3600)
+  if configuration.velocity_filter >= 0 and (total_time == 0 or velocity >= configuration.velocity_filter):
+    if counters is not None:
+      counters.increment('dropped_velocity_filter')
+    return (None, prevline)
+
+  segment = []
+  segment.append(user_id)
+  segment.append(str(alt))
+  segment.append(str(blt))         
+  segment.append(str(aln))
+  segment.append(str(bln))
+  segment.append(str(adt))
+  segment.append(str(bdt))
+  segment.append(str(total_time))
+  segment.append(str(distance))
+
+  if total_time == 0:
+    segment.append('-1')
+  else:
+    segment.append(str(velocity))
+  return (segment, fix)
+
+# degrees from a tripline, blanket edge or grid corner within which the
+# crossings of a segment are left to the tripline stage to decide
+EDGE_EPSILON = 0.000001
+# rows per block of the block engine
+EXTRACT_BLOCK_ROWS = 65536
+# output lines written at once
+OUTPUT_LINES = 4096
+# most segments of a track simplified at once
+COMPRESSION_WINDOW = 256
+
+#
+# cells (row, column) a straight segment passes through on a grid with
+# triplines at multiples of resLat / resLon, None when it passes within
+# EDGE_EPSILON of a grid corner and the order of its crossings is unclear
+#
+def cellWalk(lat1, lon1, lat2, lon2, resLat, resLon):
+  (row, col) = (int(math.floor(lat1/resLat)), int(math.floor(lon1/resLon)))
+  (endRow, endCol) = (int(math.floor(lat2/resLat)), int(math.floor(lon2/resLon)))
+  stepRow = 1 if lat2 > lat1 else -1
+  stepCol = 1 if lon2 > lon1 else -1
+  length = math.hypot(lat2 - lat1, lon2 - lon1)
+  walk = [(row, col)]
+  while row != endRow or col != endCol:
+    #fraction of the segment at which the next horizontal / vertical tripline is crossed
+    tRow = tCol = float('inf')
+    if row != endRow:
+      tRow = (float(row + (stepRow > 0))*resLat - lat1) / (lat2 - lat1)
+    if col != endCol:
+      tCol = (float(col + (stepCol > 0))*resLon - lon1) / (lon2 - lon1)
+    if abs(tRow - tCol)*length < EDGE_EPSILON:
+      return None
+    if tRow < tCol:
+      row += stepRow
+    else:
+      col += stepCol
+    walk.append((row, col))
+  return walk
+
+#
+# distance (in degrees, like the tripline geometry) of a point from a segment
+#
+def segmentDeviation(lat, lon, lat1, lon1, lat2, lon2):
+  (dLat, dLon) = (lat2 - lat1, lon2 - lon1)
+  squared = dLat*dLat + dLon*dLon
+  t = 0.0
+  if squared > 0:
+    t = max(0.0, min(1.0, ((lat - lat1)*dLat + (lon - lon1)*dLon) / squared))
+  return math.hypot(lat - lat1 - t*dLat, lon - lon1 - t*dLon)
+
+#
+# Optional track compression (simplify_tolerance > 0).
+#
+# Runs of segments that chain, the next starting where the last ended, are
+# simplified Douglas-Peucker style: the fixes between the first and the last
+# of a run are dropped when all of them lie within simplify_tolerance cells
+# of the segment from the first to the last and that segment yields the same
+# tripline crossings as the run, the same cells in the same order with the
+# same temporal_split labels, on the grid of every blanket resolution and
+# pyramid level.  The count tables stay the same, only the velocity and
+# direction of the crossings become the ones of the longer segment.
+#
+# A run stays on one side of every blanket edge.  Segments whose crossings
+# hinge on rounding (endpoints within EDGE_EPSILON of a tripline or blanket
+# edge, passing a grid corner, routed over the dateline) are passed through
+# as they are.
+#
+class TrackCompressor():
+  def __init__(self, configuration, counters=None):
+    self.configuration = configuration
+    self.counters = counters
+    blankets = [blanket for level in range(max(1, configuration.pyramid_levels)) for blanket in configuration.levelBlankets(level)]
+    self.grids = sorted(set((blanket[5], blanket[6]) for blanket in blankets))
+    self.roundfactors = [(-1*int(round(math.log(resLat))), -1*int(round(math.log(resLon)))) for (resLat, resLon) in self.grids]
+    self.boxes = [blanket[0:4] for blanket in configuration.triplineBlankets]
+    self.tolerance = configuration.simplify_tolerance * min(min(grid) for grid in self.grids)
+    self.bucketer = TemporalBucketer(configuration.temporal_split)
+    # ((lat, lon), fixState) of the end of the last segment
+    self.lastFix = (None, None)
+
+  #
+  # the inside/outside flags of a fix for every blanket, None when it sits
+  # on a tripline or blanket edge
+  #
+  def fixState(self, lat, lon):
+    for (resLat, resLon) in self.grids:
+      if abs(lat - round(lat/resLat)*resLat) < EDGE_EPSILON or abs(lon - round(lon/resLon)*resLon) < EDGE_EPSILON:
+        return None
+    inside = []
+    for (lat1, lon1, lat2, lon2) in self.boxes:
+      if min(abs(lat - lat1), abs(lat - lat2), abs(lon - lon1), abs(lon - lon2)) < EDGE_EPSILON:
+        return None
+      inside.append(lat1 < lat < lat2 and lon1 < lon < lon2)
+    return tuple(inside)
+
+  #
+  # (x, y) of the cells tripline_bins.py puts the crossings of a segment in,
+  # for every grid.  None when the order of the crossings is unclear.
+  #
+  def crossingCells(self, alat, alon, blat, blon):
+    grids = []
+    for ((resLat, resLon), (roundfactorLat, roundfactorLon)) in zip(self.grids, self.roundfactors):
+      walk = cellWalk(alat, alon, blat, blon, resLat, resLon)
+      if walk is None:
+        return None
+      cells = []
+      for ((row1, col1), (row2, col2)) in zip(walk, walk[1:]):
+        #the cell above a horizontal and right of a vertical tripline
+        (row, col) = (max(row1, row2), col1) if col1 == col2 else (row1, max(col1, col2))
+        cells.append((round(float(row)*resLat + resLat*0.5, roundfactorLat), round(float(col)*resLon + resLon*0.5, roundfactorLon)))
+      grids.append(cells)
+    return grids
+
+  #
+  # temporal_split labels of the crossings in cells, from interpolatedTime of
+  # tripline_bins.py
+  #
+  def crossingLabels(self, cells, alat, alon, adt, velocity):
+    labels = []
+    for found in cells:
+      labels.append([])
+      for (intersectX, intersectY) in found:
+        hours = 0.00001
+        if velocity > 0.00001:
+          hours = computeDistanceKM(alat, alon, intersectX, intersectY) / velocity
+        labels[-1].append(self.bucketer.label(adt + int(round(hours*60*60))))
+    return labels
+
+  #
+  # (alat, alon, blat, blon, crossing cells, state) of a segment that can be
+  # part of a run, None otherwise
+  #
+  def segmentGeometry(self, segment):
+    (alat, blat, alon, blon) = [float(value) for value in segment[1:5]]
+    if abs(alon - blon) > 180:
+      return None
+    #a segment usually starts where the last one ended
+    if (alat, alon) == self.lastFix[0]:
+      state = self.lastFix[1]
+    else:
+      state = self.fixState(alat, alon)
+    self.lastFix = ((blat, blon), self.fixState(blat, blon))
+    if state is None or state != self.lastFix[1]:
+      return None
+    cells = self.crossingCells(alat, alon, blat, blon)
+    if cells is None:
+      return None
+    return (alat, alon, blat, blon, cells, state)
+
+  def compress(self, segments):
+    run = []
+    for segment in segments:
+      geometry = self.segmentGeometry(segment)
+      if run and (geometry is None or segment[0] != run[-1][0][0] or geometry[5] != run[-1][1][5] or
+                  geometry[0:2] != run[-1][1][2:4] or len(run) >= COMPRESSION_WINDOW):
+        for simplified in self.simplify(run):
+          yield simplified
+        run = []
+      if geometry is None:
+        yield segment
+      else:
+        run.append((segment, geometry))
+    for simplified in self.simplify(run):
+      yield simplified
+
+  #
+  # the segments left of a run after Douglas-Peucker
+  #
+  def simplify(self, run):
+    merged = {}
+    # crossing labels of the segments of the run, computed when needed
+    labels = [None]*len(run)
+    kept = set([0, len(run)])
+    pending = [(0, len(run))]
+    while pending:
+      (first, last) = pending.pop()
+      if last - first < 2:
+        continue
+      (farthest, deviation) = (None, -1.0)
+      (alat, alon) = run[first][1][0:2]
+      (blat, blon) = run[last - 1][1][2:4]
+      for i in range(first + 1, last):
+        d = segmentDeviation(run[i][1][0], run[i][1][1], alat, alon, blat, blon)
+        if d > deviation:
+          (farthest, deviation) = (i, d)
+      if deviation <= self.tolerance:
+        merged[(first, last)] = self.mergedSegment(run, labels, first, last)
+        if merged[(first, last)] is not None:
+          continue
+      kept.add(farthest)
+      pending.append((first, farthest))
+      pending.append((farthest, last))
+    kept = sorted(kept)
+    for (first, last) in zip(kept, kept[1:]):
+      if last - first == 1:
+        yield run[first][0]
+        continue
+      if self.counters is not None:
+        for i in range(first + 1, last):
+          (lat, lon) = run[i][1][0:2]
+          if math.hypot(lat - run[i - 1][1][0], lon - run[i - 1][1][1]) <= self.tolerance:
+            self.counters.increment('compressed_near_duplicates')
+          else:
+            self.counters.increment('compressed_fixes')
+      yield merged[(first, last)]
+
+  #
+  # the segment from the start of run[first] to the end of run[last - 1] when
+  # it passes the segment filters and has the crossings of the run, None
+  # otherwise
+  #
+  def mergedSegment(self, run, labels, first, last):
+    (alat, alon) = run[first][1][0:2]
+    (blat, blon) = run[last - 1][1][2:4]
+    if abs(alon - blon) > 180:
+      return None
+    (adt, bdt) = (run[first][0][5], run[last - 1][0][6])
+    total_time = float(bdt) - float(adt)
+    distance = computeDistanceKM(alat, alon, blat, blon)
+    if distance > self.configuration.distance_filter:
+      return None
+    velocity = -1
+    if total_time != 0:
+      velocity = distance/(total_time/3600)
+    if self.configuration.velocity_filter >= 0 and (total_time == 0 or velocity >= self.configuration.velocity_filter):
+      return None
+    segment = [run[first][0][0], str(alat), str(blat), str(alon), str(blon), adt, bdt,
+               str(total_time), str(distance), str(velocity)]
+
+    cells = self.crossingCells(alat, alon, blat, blon)
+    if cells is None:
+      return None
+    grids = range(len(self.grids))
+    if cells != [[cell for i in range(first, last) for cell in run[i][1][4][g]] for g in grids]:
+      return None
+    if any(cells):
+      for i in range(first, last):
+        if labels[i] is None:
+          (original, geometry) = run[i]
+          labels[i] = self.crossingLabels(geometry[4], geometry[0], geometry[1], int(float(original[5])), float(original[9]))
+      #the tripline stage reads the velocity back from its string
+      if self.crossingLabels(cells, alat, alon, int(float(adt)), float(segment[9])) != [[label for i in range(first, last) for label in labels[i][g]] for g in grids]:
+        return None
+    return segment
+
+#
+# (start, end) epoch seconds of date_from / date_to, None where not set
+#
+def dateRange(configuration):
+  timestamps = TimestampParser()
+  bounds = []
+  for value in (configuration.date_from, configuration.date_to):
+    if value is not None and len(value) == 10:
+      value += ' 00:00:00'
+    bounds.append(None if value is None else timestamps.parse(value))
+  return tuple(bounds)
+
+#
+# turn rows sorted by (id, dt) into path segments, adt and bdt are epoch seconds
+#
+# checkpoint, when given, is called with (id, dt, lat, lon) of the fix every
+# track ends on, i.e. the one the next segment of that track would start
+# from.  Feeding those fixes back in front of later rows continues the
+# tracks as if all rows had been processed at once.
+#
+# counters, when given, counts the rows dropped for every reason, the rows
+# starting a track and the segments out.
+#
+# With simplify_tolerance the segments go through TrackCompressor.
+#
+def extractSegments(configuration, rows, checkpoint=None, counters=None):
+  for block in segmentBlocks(configuration, rows, checkpoint, counters):
+    if counters is not None:
+      counters.increment('segments_out', len(block))
+    for segment in block:
+      yield segment
+
+#
+# extractSegments as lists of segments, one per row with the row engine and
+# up to a block of rows with the block engine
+#
+def segmentBlocks(configuration, rows, checkpoint=None, counters=None):
+  if configuration.extract_engine == "block":
+    blocks = blockSegments(configuration, rows, checkpoint, counters)
+  else:
+    blocks = ([segment] for segment in fixSegments(configuration, rows, checkpoint, counters))
+  if configuration.simplify_tolerance > 0:
+    segments = (segment for block in blocks for segment in block)
+    blocks = ([segment] for segment in TrackCompressor(configuration, counters).compress(segments))
+  return blocks
+
+#
+# Split tracks (skew_chunk_fixes).
+#
+# The fixes of the few tracks with far more fixes than the others (fixed
+# buoys, base stations) are cut into time ranges, chunks, that are extracted
+# on different reducers.  Their rows carry the chunk as a fifth column and
+# every chunk but the first starts with the last fix of the chunk before it,
+# marked 'start' in a sixth column, so its first segment joins the two.  A
+# chunk is extracted as a track of its own, keyed id CHUNK_SEPARATOR chunk.
+# The segments are those of the whole track as long as every chunk ended on
+# its last fix: when a filter dropped that fix the next chunk started from
+# the wrong one.  boundary(id, chunk, exact) reports this for every chunk,
+# the runs extract the tracks with an inexact boundary or a missing chunk
+# again in one piece.
+#
+CHUNK_SEPARATOR = "\x01"
+
+#
+# {id: chunk boundaries} of the tracks to split.  sampled maps ids to the dt
+# strings of the fixes sampled at skew_sample.  The skew_max_tracks tracks
+# with most samples above skew_chunk_fixes estimated fixes are cut into
+# chunks of about skew_chunk_fixes, chunk k holds the fixes from boundary k
+# (a sampled dt, so no chunk is empty) up to boundary k + 1.
+#
+def skewPlan(configuration, sampled):
+  plan = {}
+  threshold = configuration.skew_chunk_fixes * configuration.skew_sample
+  largest = sorted(sampled.items(), key=lambda item: (-len(item[1]), item[0]))[:configuration.skew_max_tracks]
+  for (user_id, dts) in largest:
+    if len(dts) <= threshold:
+      continue
+    dts = sorted(dts)
+    chunks = int(math.ceil(len(dts) / threshold))
+    boundaries = []
+    for i in range(1, chunks):
+      dt = dts[i * len(dts) // chunks]
+      if dt > (boundaries[-1] if boundaries else dts[0]):
+        boundaries.append(dt)
+    if boundaries:
+      plan[user_id] = boundaries
+  return plan
+
+#
+# chunk of a fix of a split track
+#
+def chunkOf(boundaries, dt):
+  return bisect.bisect_right(boundaries, dt)
+
+#
+# segmentBlocks over rows that may carry a chunk (see skewPlan), as
+# (segments of unsplit tracks, segments of chunks) pairs.  boundary is called
+# as described above, fix with every row of a chunk but the fix it starts
+# from.
+#
+def chunkedSegmentBlocks(configuration, rows, boundary, counters=None, fix=None):
+  # (dt, lat, lon) of the last row of every chunk still going on
+  last = {}
+  def keyed(rows):
+    for row in rows:
+      if len(row) > 4 and row[4] not in ("", "\\N"):
+        key = row[0] + CHUNK_SEPARATOR + row[4]
+        if fix is not None and (len(row) < 6 or row[5] != "start"):
+          fix(row[:4])
+        last[key] = (row[1].split('.')[0], row[2], row[3])
+        row = [key, row[1], row[2], row[3]]
+      yield row[:4]
+  def ended(end):
+    if CHUNK_SEPARATOR in end[0]:
+      (user_id, chunk) = end[0].split(CHUNK_SEPARATOR)
+      boundary(user_id, chunk, last.pop(end[0], None) == tuple(end[1:]))
+  for block in segmentBlocks(configuration, keyed(rows), ended, counters):
+    if counters is not None:
+      counters.increment('segments_out', len(block))
+    plain = []
+    chunked = []
+    for segment in block:
+      if CHUNK_SEPARATOR in segment[0]:
+        chunked.append([segment[0].split(CHUNK_SEPARATOR)[0]] + list(segment[1:]))
+      else:
+        plain.append(segment)
+    yield (plain, chunked)
+  # chunks without a single fix the filters took
+  for key in sorted(last):
+    (user_id, chunk) = key.split(CHUNK_SEPARATOR)
+    boundary(user_id, chunk, False)
+
+#
+# the segments between the fixes of rows, see extractSegments
+#
+def fixSegments(configuration, rows, checkpoint, counters):
+  current_user = None
+  prevline = None
+  dt_parse = None
+  prev_dt = None
+  timestamps = TimestampParser()
+  (date_from, date_to) = dateRange(configuration)
+  for (user_id, dt, lat, lon) in rows:
+    try:
+      dt = dt.split('.')[0]
+      dt_parse = timestamps.parse(dt)
+      if dt_parse is None:
+          if counters is not None:
+            counters.increment('dropped_bad_date')
+          continue
+    except:
+        if counters is not None:
+          counters.increment('dropped_bad_date')
+        continue
+    if (date_from is not None and dt_parse < date_from) or (date_to is not None and dt_parse >= date_to):
+      if counters is not None:
+        counters.increment('dropped_date_range')
+      continue
+
+    if current_user is None or current_user != user_id:
+      if checkpoint is not None and prevline is not None:
+        checkpoint((prevline[0], prev_dt, prevline[2], prevline[3]))
+      current_user = user_id
+      prevline = (user_id, dt_parse, lat, lon)
+      prev_dt = dt
+      if counters is not None:
+        counters.increment('track_starts')
+      continue
+
+    (segment, nextline) = nextSegment(configuration, prevline, (user_id, dt_parse, lat, lon), counters)
+    if segment is not None:
+      yield segment
+    if nextline is not prevline:
+      prevline = nextline
+      prev_dt = dt
+
+  if checkpoint is not None and prevline is not None:
+    checkpoint((prevline[0], prev_dt, prevline[2], prevline[3]))
+
+
+#
+# Block engine, the same segments as fixSegments from whole blocks of rows.
+#
+# Rows are read in blocks of EXTRACT_BLOCK_ROWS, the tracks still going on at
+# the end of a block are held back for the next one.  Every fix is first
+# assumed to be taken, so each segment runs from the row before it, and the
+# time, distance and velocity of all of them are computed as arrays in the
+# operation order of nextSegment.  Tracks where the filters turn down a
+# segment (the fix after it would start from an earlier one) or that hold a
+# coordinate float() can't read go through nextSegment row by row.
+#
+def blockSegments(configuration, rows, checkpoint=None, counters=None):
+  import numpy
+  import tripline_vector
+
+  timestamps = TimestampParser()
+  (date_from, date_to) = dateRange(configuration)
+  # (id, epoch dt, dt, lat, lon, float lat, float lon) of the rows not taken yet
+  pending = [[] for i in range(7)]
+  (ids, dts, dtStrings, lats, lons, floatLats, floatLons) = pending
+  rows = iter(rows)
+  while True:
+    block = list(itertools.islice(rows, EXTRACT_BLOCK_ROWS))
+    for row in block:
+      if len(row) != 4:
+        # fails like the row engine
+        (user_id, dt, lat, lon) = row
+    if block:
+      columns = [list(column) for column in zip(*block)]
+      columns[1] = [dt.split('.')[0] for dt in columns[1]]
+      try:
+        parsed = timestamps.parseMany(columns[1])
+      except Exception:
+        parsed = []
+        for dt in columns[1]:
+          try:
+            parsed.append(timestamps.parse(dt))
+          except:
+            parsed.append(None)
+      kept = [i for (i, dt_parse) in enumerate(parsed) if dt_parse is not None and
+              (date_from is None or dt_parse >= date_from) and (date_to is None or dt_parse < date_to)]
+      if counters is not None and len(kept) < len(block):
+        bad = parsed.count(None)
+        counters.increment('dropped_bad_date', bad)
+        counters.increment('dropped_date_range', len(block) - len(kept) - bad)
+      columns.insert(1, parsed)
+      if len(kept) < len(block):
+        columns = [[column[i] for i in kept] for column in columns]
+      try:
+        columns.append(map(float, columns[3]))
+        columns.append(map(float, columns[4]))
+      except ValueError:
+        columns[5:] = [[], []]
+        for (lat, lon) in zip(columns[3], columns[4]):
+          try:
+            (floatLat, floatLon) = (float(lat), float(lon))
+          except:
+            (floatLat, floatLon) = (None, None)
+          columns[5].append(floatLat)
+          columns[6].append(floatLon)
+      for (column, values) in zip(pending, columns):
+        column.extend(values)
+
+    # tracks ending in this block, all of them at the end of the input
+    end = len(ids)
+    if block:
+      while end > 0 and ids[end - 1] == ids[-1]:
+        end -= 1
+      if end == 0:
+        continue
+    if end == 0:
+      break
+    starts = [0] + [i for i in range(1, end) if ids[i] != ids[i - 1]]
+    tracks = zip(starts, starts[1:] + [end])
+
+    # segment i runs from row i - 1 to row i
+    scalar = [i for i in range(end) if floatLats[i] is None]
+    lat = numpy.array([0.0 if value is None else value for value in floatLats[:end]] if scalar else floatLats[:end], dtype=numpy.float64)
+    lon = numpy.array([0.0 if value is None else value for value in floatLons[:end]] if scalar else floatLons[:end], dtype=numpy.float64)
+    # nan and inf coordinates are turned down by nextSegment like unreadable ones
+    finite = numpy.isfinite(lat) & numpy.isfinite(lon)
+    if not finite.all():
+      scalar = sorted(set(scalar) | set(numpy.nonzero(~finite)[0].tolist()))
+      lat[~finite] = 0.0
+      lon[~finite] = 0.0
+    dt = numpy.array(dts[:end], dtype=numpy.int64)
+    total_time = numpy.zeros(end)
+    total_time[1:] = (dt[1:] - dt[:-1]).astype(numpy.float64)
+    distance = numpy.zeros(end)
+    with numpy.errstate(all='ignore'):
+      distance[1:] = tripline_vector.computeDistanceKMArrays(lat[:-1], lon[:-1], lat[1:], lon[1:])
+      velocity = numpy.where(total_time != 0, distance/(total_time/3600), -1)
+    stationary = numpy.zeros(end, dtype=bool)
+    stationary[1:] = numpy.abs(lat[:-1] - lat[1:]) + numpy.abs(lon[:-1] - lon[1:]) == 0
+    rejected = (total_time > configuration.time_filter) | (distance > configuration.distance_filter)
+    if configuration.velocity_filter >= 0:
+      rejected |= ~stationary & ((total_time == 0) | (velocity >= configuration.velocity_filter))
+    first = numpy.zeros(end, dtype=bool)
+    first[starts] = True
+    # tracks that need nextSegment
+    track = numpy.cumsum(first) - 1
+    fallback = set(track[rejected & ~first].tolist()) | set(track[scalar].tolist())
+
+    taken = ~stationary & ~first
+    if counters is not None:
+      counters.increment('track_starts', len(starts))
+      counters.increment('dropped_stationary', int((stationary & ~first & ~numpy.in1d(track, list(fallback))).sum()))
+    if fallback:
+      taken &= ~numpy.in1d(track, list(fallback))
+    taken = numpy.nonzero(taken)[0]
+    before = taken - 1
+    strings = [map(str, floatLats[:end]), map(str, floatLons[:end]), map(str, dts[:end])]
+    segments = zip([ids[i] for i in taken.tolist()],
+                   [strings[0][i] for i in before.tolist()], [strings[0][i] for i in taken.tolist()],
+                   [strings[1][i] for i in before.tolist()], [strings[1][i] for i in taken.tolist()],
+                   [strings[2][i] for i in before.tolist()], [strings[2][i] for i in taken.tolist()],
+                   map(str, total_time[taken].tolist()), map(str, distance[taken].tolist()),
+                   ['-1' if v is None else str(v) for v in numpy.where(total_time[taken] == 0, None, velocity[taken]).tolist()])
+    if checkpoint is None and not fallback:
+      yield segments
+    else:
+      out = []
+      # index into segments of the first one of the next track
+      next_segment = 0
+      taken = taken.tolist()
+      for (k, (start, stop)) in enumerate(tracks):
+        if k in fallback:
+          prevline = (ids[start], dts[start], lats[start], lons[start])
+          prev_dt = dtStrings[start]
+          for i in range(start + 1, stop):
+            (segment, nextline) = nextSegment(configuration, prevline, (ids[i], dts[i], lats[i], lons[i]), counters)
+            if segment is not None:
+              out.append(segment)
+            if nextline is not prevline:
+              prevline = nextline
+              prev_dt = dtStrings[i]
+          last = (prevline[0], prev_dt, prevline[2], prevline[3])
+        else:
+          first_segment = next_segment
+          while next_segment < len(taken) and taken[next_segment] < stop:
+            next_segment += 1
+          out.extend(segments[first_segment:next_segment])
+          last = (ids[stop - 1], dtStrings[stop - 1], lats[stop - 1], lons[stop - 1])
+        if checkpoint is not None:
+          yield out
+          out = []
+          checkpoint(last)
+      if out:
+        yield out
+    for column in pending:
+      del column[:end]
+
+#
+# With --checkpoints (incremental runs) every row starts with its kind:
+# 'segment' rows carry the usual columns, 'checkpoint' rows carry the last
+# fix of a track as id, alat, alon and its original dt string in time.
+#
+# With --chunks (split tracks, see skewPlan) the segments of chunks are
+# 'chunked' rows, every fix of a chunk is repeated as a 'fix' row in the
+# layout of a checkpoint and 'boundary' rows carry the chunk in time and 1
+# or 0 for an exact or inexact boundary in distance.
+#
+def checkpointRow(fix, kind='checkpoint'):
+  (user_id, dt, lat, lon) = fix
+  return [kind, user_id, lat, '\\N', lon, '\\N', '\\N', '\\N', dt, '\\N', '\\N']
+
+def boundaryRow(user_id, chunk, exact):
+  return ['boundary', user_id, '\\N', '\\N', '\\N', '\\N', '\\N', '\\N', chunk, '1' if exact else '0', '\\N']
+
+#
+# Stale checkpoints (--checkpoints).  The rows carry their batch as a fifth
+# column, 0 for the checkpoints fed back and 1 for the new rows.  A
+# checkpoint more than time_filter older than the newest new fix can't start
+# a segment any more and is dropped instead of being carried through every
+# later run.  The newest fix is only known at the end of the input, until
+# then the checkpoints that aren't stale yet are held.
+#
+class CheckpointPruner():
+  def __init__(self, configuration, write, counters=None):
+    self.time_filter = configuration.time_filter
+    self.write = write
+    self.counters = counters
+    self.timestamps = TimestampParser()
+    self.newest = None
+    self.held = []
+
+  # the rows without their batch, noting the newest new fix
+  def rows(self, rows):
+    for row in rows:
+      if len(row) > 4:
+        if row[4] == '1':
+          dt_parse = self.timestamps.parse(row[1].split('.')[0])
+          if dt_parse is not None and (self.newest is None or dt_parse > self.newest):
+            self.newest = dt_parse
+        row = row[:4]
+      yield row
+
+  def stale(self, dt_parse):
+    return self.newest is not None and dt_parse is not None and dt_parse < self.newest - self.time_filter
+
+  def checkpoint(self, fix):
+    dt_parse = self.timestamps.parse(fix[1].split('.')[0])
+    if self.stale(dt_parse):
+      if self.counters is not None:
+        self.counters.increment('stale_checkpoints')
     else:
-      segment.append(str(distance/(total_time/3600)))
-    
+      self.held.append((dt_parse, fix))
+
+  def flush(self):
+    for (dt_parse, fix) in self.held:
+      if self.stale(dt_parse):
+        if self.counters is not None:
+          self.counters.increment('stale_checkpoints')
+      else:
+        self.write(fix)
+    self.held = []
 
-    print "\t".join(segment)
-     
-  prevline = (user_id, dt_parse, lat, lon)             
-         
 
-    
-    
+if __name__ == "__main__":
+  configuration = loadConfig(sys.argv.pop())
+  counters = Counters("micro_path_extract", sys.stderr)
+  rows = parseLines(timedRows(sys.stdin, counters))
+  # output lines, written OUTPUT_LINES at a time
+  lines = []
+  prefix = ''
+  printCheckpoint = None
+  pruner = None
+  if '--checkpoints' in sys.argv:
+    prefix = 'segment\t'
+    def writeCheckpoint(fix):
+      counters.increment('checkpoints_out')
+      lines.append("\t".join(checkpointRow(fix)))
+    pruner = CheckpointPruner(configuration, writeCheckpoint, counters)
+    rows = pruner.rows(rows)
+    printCheckpoint = pruner.checkpoint
+  if '--chunks' in sys.argv:
+    def printBoundary(user_id, chunk, exact):
+      counters.increment('track_chunks')
+      if not exact:
+        counters.increment('inexact_chunk_boundaries')
+      lines.append("\t".join(boundaryRow(user_id, chunk, exact)))
+    def printFix(fix):
+      lines.append("\t".join(checkpointRow(fix, 'fix')))
+    for (plain, chunked) in chunkedSegmentBlocks(configuration, rows, printBoundary, counters, printFix):
+      lines.extend('segment\t' + "\t".join(segment) for segment in plain)
+      lines.extend('chunked\t' + "\t".join(segment) for segment in chunked)
+      if len(lines) >= OUTPUT_LINES:
+        sys.stdout.write("\n".join(lines) + "\n")
+        del lines[:]
+  else:
+    for block in segmentBlocks(configuration, rows, printCheckpoint, counters):
+      counters.increment('segments_out', len(block))
+      lines.extend(prefix + "\t".join(segment) for segment in block)
+      if len(lines) >= OUTPUT_LINES:
+        sys.stdout.write("\n".join(lines) + "\n")
+        del lines[:]
+  if pruner is not None:
+    pruner.flush()
+  if lines:
+    sys.stdout.write("\n".join(lines) + "\n")
+  counters.flush()
@@ -0,0 +1,231 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Segment / tripline intersection kernels.
+#
+# The crossing test of the tripline engines (intersect in the reference loop,
+# intersectArrays in tripline_vector.py) can run on one of these kernels,
+# chosen with geometry_kernel:
+#
+#   float     plain float64, the arithmetic the gmpy2 version had at its
+#             default 53 bit precision
+#   exact     rational arithmetic (fractions.Fraction) on the float inputs,
+#             the coordinates are rounded to the nearest float at the end
+#   adaptive  float64 with a running error bound; the few tests the bound
+#             can't decide (an end point on or next to a tripline, nearly
+#             parallel lines, a crossing at the very end of the segment) are
+#             redone by the exact kernel
+#   check     adaptive, every test is also run by the exact kernel and the
+#             differences are counted and written to stderr
+#
+# The bounds follow Shewchuk's orient2d filter: the float value of
+# ab - cd with differences of the inputs in a, b, c and d is off by at most
+# DETERMINANT_BOUND * (|ab| + |cd|).
+#
+
+import sys
+from counters import Counters
+
+EPSILON = 2.0 ** -53
+DETERMINANT_BOUND = (3.0 + 16.0 * EPSILON) * EPSILON
+BETWEEN_THRESHOLD = 0.0000001
+KERNELS = ["adaptive", "float", "exact", "check"]
+# mismatches written to stderr per process in check mode
+MISMATCH_REPORTS = 20
+MISS = (0, 0, 0)
+
+
+class Point () :
+    def __init__(self,x,y):
+        self.x = x
+        self.y = y;
+
+def ccw(A,B,C):
+    return - ((C.y-A.y) * (B.x-A.x)) + ((B.y-A.y) * (C.x-A.x))
+
+def isgtzero (a) :
+    return a > 0
+
+def betweenpts(A1,A2,Q,threshold=BETWEEN_THRESHOLD):
+    compAxMin = min(A1.x,A2.x) - threshold
+    compAxMax = max(A1.x,A2.x) + threshold
+    compAyMin = min(A1.y,A2.y) - threshold
+    compAyMax = max(A1.y,A2.y) + threshold
+    if compAxMin <= Q.x <= compAxMax and compAyMin <= Q.y <= compAyMax:
+        return True
+    return False
+
+#
+# -1 when the crossing goes south, or west on a segment along a tripline
+#
+def crossingSign(A, B):
+  if (A.y == B.y and A.x > B.x) or (A.y > B.y):
+    return -1
+  return 1
+
+#
+# the original test: does segment AB cross line CD, and where.
+# (x, y, sign) of the crossing, (0, 0, 0) for none
+#
+def floatIntersect(A,B,C,D):
+    acd = ccw(A,C,D)
+    bcd = ccw(B,C,D)
+    abc = ccw(A,B,C)
+    abd = ccw(A,B,D)
+
+    #literal edge cases, when one of our points lies on the opposite line
+    if (acd == 0 and betweenpts(A,C,D)) or (bcd == 0 and betweenpts(B,C,D))\
+    or (abc == 0 and betweenpts(A,B,C)) or (abd == 0 and betweenpts(A,B,D))\
+    or (isgtzero (acd) != isgtzero (bcd) and isgtzero (abc) != isgtzero (abd)) :
+
+        denom = ((D.y-C.y)*(B.x-A.x))- ((D.x-C.x)*(B.y-A.y))
+        uanumerator = ((D.x-C.x)*(A.y-C.y))-((D.y-C.y)*(A.x-C.x))
+        if denom == 0:
+            # Lines are parallel, so return no
+            return MISS
+        ua = uanumerator/denom
+
+        #if ua and ub are both between 0 and 1, then the intersection is in  both segments
+        #NOTE: it does not matter which determinant we use for the equations below
+        x = A.x + (ua*(B.x-A.x))
+        y = A.y + (ua*(B.y-A.y))
+        if min(A.x,B.x) <= x <= max(A.x,B.x) and\
+          min(A.y,B.y) <= y <= max(A.y,B.y):
+          return (x,y,crossingSign(A,B))
+    return MISS
+
+#
+# floatIntersect in rational arithmetic, the inputs are taken as the exact
+# values of their floats
+#
+def exactIntersect(A,B,C,D):
+  # imported here, most tasks never need it
+  from fractions import Fraction
+  (a, b, c, d) = [Point(Fraction(P.x), Fraction(P.y)) for P in (A, B, C, D)]
+  threshold = Fraction(BETWEEN_THRESHOLD)
+  acd = ccw(a,c,d)
+  bcd = ccw(b,c,d)
+  abc = ccw(a,b,c)
+  abd = ccw(a,b,d)
+  if not ((acd == 0 and betweenpts(a,c,d,threshold)) or (bcd == 0 and betweenpts(b,c,d,threshold))
+          or (abc == 0 and betweenpts(a,b,c,threshold)) or (abd == 0 and betweenpts(a,b,d,threshold))
+          or ((acd > 0) != (bcd > 0) and (abc > 0) != (abd > 0))):
+    return MISS
+  denom = ((d.y-c.y)*(b.x-a.x)) - ((d.x-c.x)*(b.y-a.y))
+  if denom == 0:
+    return MISS
+  ua = (((d.x-c.x)*(a.y-c.y)) - ((d.y-c.y)*(a.x-c.x))) / denom
+  x = a.x + ua*(b.x-a.x)
+  y = a.y + ua*(b.y-a.y)
+  if min(a.x,b.x) <= x <= max(a.x,b.x) and min(a.y,b.y) <= y <= max(a.y,b.y):
+    return (float(x), float(y), crossingSign(A,B))
+  return MISS
+
+#
+# float value and error bound of left - right
+#
+def boundedDifference(left, right):
+  return (left - right, DETERMINANT_BOUND * (abs(left) + abs(right)))
+
+#
+# True when value may lie on either side of limit
+#
+def straddles(value, error, limit):
+  return error > 0 and abs(value - limit) <= error
+
+#
+# floatIntersect with an error bound.  Returns (result, error), result is
+# None when the float arithmetic can't decide the test and error bounds the
+# distance of the crossing coordinates from the exact ones.
+#
+def boundedIntersect(A,B,C,D):
+  signs = []
+  for (P, Q, R) in ((A, C, D), (B, C, D), (A, B, C), (A, B, D)):
+    (det, error) = boundedDifference((Q.y-P.y) * (R.x-P.x), (R.y-P.y) * (Q.x-P.x))
+    if abs(det) <= error:
+      # on or next to the other line
+      return (None, 0.0)
+    signs.append(det > 0)
+  if signs[0] == signs[1] or signs[2] == signs[3]:
+    return (MISS, 0.0)
+
+  (denom, denomError) = boundedDifference((D.y-C.y)*(B.x-A.x), (D.x-C.x)*(B.y-A.y))
+  if abs(denom) <= 2 * denomError:
+    # nearly parallel
+    return (None, 0.0)
+  (uanumerator, numeratorError) = boundedDifference((D.x-C.x)*(A.y-C.y), (D.y-C.y)*(A.x-C.x))
+  ua = uanumerator/denom
+  uaError = (numeratorError + abs(ua) * denomError) / (abs(denom) - denomError) + EPSILON * abs(ua)
+
+  dx = B.x-A.x
+  dy = B.y-A.y
+  x = A.x + (ua*dx)
+  y = A.y + (ua*dy)
+  # the differences are exact when zero, so are the coordinates
+  errorX = 0.0 if dx == 0 else 2 * (uaError * abs(dx) + 2 * EPSILON * abs(ua*dx) + EPSILON * abs(x))
+  errorY = 0.0 if dy == 0 else 2 * (uaError * abs(dy) + 2 * EPSILON * abs(ua*dy) + EPSILON * abs(y))
+  (loX, hiX, loY, hiY) = (min(A.x,B.x), max(A.x,B.x), min(A.y,B.y), max(A.y,B.y))
+  if straddles(x, errorX, loX) or straddles(x, errorX, hiX) or straddles(y, errorY, loY) or straddles(y, errorY, hiY):
+    # crossing at the very end of the segment
+    return (None, 0.0)
+  if loX <= x <= hiX and loY <= y <= hiY:
+    return ((x,y,crossingSign(A,B)), max(errorX, errorY))
+  return (MISS, 0.0)
+
+
+class GeometryKernel():
+  def __init__(self, name="adaptive", counters=None, report=sys.stderr):
+    if name not in KERNELS:
+      raise ValueError("unknown geometry_kernel " + name + ", one of " + ", ".join(KERNELS))
+    self.name = name
+    self.counters = counters if counters is not None else Counters("micro_path_tripline")
+    self.report = report
+    self.reported = 0
+
+  #
+  # (x, y, sign) of the crossing of segment AB with line CD, (0, 0, 0) for none
+  #
+  def intersect(self, A, B, C, D):
+    if self.name == "float":
+      return floatIntersect(A, B, C, D)
+    if self.name == "exact":
+      self.counters.increment('geometry_exact')
+      return exactIntersect(A, B, C, D)
+    (result, error) = boundedIntersect(A, B, C, D)
+    if result is None:
+      self.counters.increment('geometry_exact')
+      result = exactIntersect(A, B, C, D)
+    if self.name == "check":
+      self.compare(A, B, C, D, result, error, floatIntersect(A, B, C, D))
+    return result
+
+  #
+  # count (and report) a result that is further from the exact one than its
+  # error bound.  fast is the plain float result, its crossings that are
+  # missing, extra or of the other direction count as float mismatches.
+  #
+  def compare(self, A, B, C, D, result, error, fast):
+    exact = exactIntersect(A, B, C, D)
+    self.counters.increment('geometry_checks')
+    if (fast == MISS) != (exact == MISS) or fast[2] != exact[2]:
+      self.counters.increment('geometry_float_mismatches')
+    if ((result == MISS) == (exact == MISS) and result[2] == exact[2] and
+        abs(result[0] - exact[0]) <= error and abs(result[1] - exact[1]) <= error):
+      return
+    self.counters.increment('geometry_mismatches')
+    if self.report is not None and self.reported < MISMATCH_REPORTS:
+      self.reported += 1
+      self.report.write("geometry mismatch: %r %r %r %r %s=%r exact=%r\n" % (
+        (A.x, A.y), (B.x, B.y), (C.x, C.y), (D.x, D.y), self.name, result, exact))
@@ -0,0 +1,285 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Timestamps travel between the stages as integer epoch seconds (UTC, the
+# naive input times are taken as UTC).  Input values are parsed by slicing
+# the fixed width 'YYYY-MM-DD HH:MM:SS' / 'YYYY-MM-DDTHH:MM:SS' layouts, with
+# the strptime formats of the original scripts as the fallback for anything
+# else, and only the final output is formatted again.
+#
+
+import re
+import datetime
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# (year, month) -> (epoch of the first of the month, days in the month)
+_monthStarts = {}
+# days since the epoch -> 'YYYY-MM-DD'
+_dayLabels = {}
+
+
+def monthStart(year, month):
+  start = _monthStarts.get((year, month))
+  if start is None:
+    # imported here, it pulls in locale, which tasks without rows don't need
+    import calendar
+    start = _monthStarts[(year, month)] = (calendar.timegm((year, month, 1, 0, 0, 0)), calendar.monthrange(year, month)[1])
+  return start
+
+
+def epochFromDatetime(dt):
+  delta = dt - EPOCH
+  return delta.days*24*60*60 + delta.seconds
+
+
+def datetimeFromEpoch(seconds):
+  return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+#
+# 'YYYY-MM-DD HH:MM:SS' of an epoch second
+#
+def formatEpoch(seconds):
+  (days, rest) = divmod(seconds, 86400)
+  label = _dayLabels.get(days)
+  if label is None:
+    label = _dayLabels[days] = (EPOCH + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+  (hour, rest) = divmod(rest, 3600)
+  (minute, second) = divmod(rest, 60)
+  return '%s %02d:%02d:%02d' % (label, hour, minute, second)
+
+
+#
+# Parses timestamps into epoch seconds, None when a value can't be parsed.
+# The layout is detected from the first value that parses and kept for the
+# rest of the stream: epoch seconds are taken as they are, datetimes are
+# sliced.  Values of another layout still parse, only slower.
+#
+class TimestampParser():
+  def __init__(self):
+    self.layout = None
+
+  def parse(self, value):
+    if self.layout is not None:
+      return self.parseLayout(value, self.layout)
+    layout = self.detect(value)
+    seconds = self.parseLayout(value, layout)
+    if seconds is not None:
+      self.layout = layout
+    return seconds
+
+  def parseLayout(self, value, layout):
+    if layout == 'epoch':
+      try:
+        return int(value)
+      except ValueError:
+        return self.parseStrptime(value)
+    if len(value) == 19 and value[10] == layout and value[4] == '-' and value[7] == '-' and value[13] == ':' and value[16] == ':':
+      digits = value[0:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:19]
+      if digits.isdigit():
+        month = int(digits[4:6])
+        day = int(digits[6:8])
+        hour = int(digits[8:10])
+        minute = int(digits[10:12])
+        second = int(digits[12:14])
+        year = int(digits[0:4])
+        if year >= 1 and 1 <= month <= 12 and hour < 24 and minute < 60 and second < 60:
+          (start, days) = monthStart(year, month)
+          if 1 <= day <= days:
+            return start + (day-1)*86400 + hour*3600 + minute*60 + second
+    if value.lstrip('-').isdigit():
+      return int(value)
+    return self.parseStrptime(value)
+
+  #
+  # parse() of every value in a list.  Datetimes of the detected layout are
+  # sliced as arrays (needs numpy), anything else goes through parse().
+  #
+  def parseMany(self, values):
+    if not values:
+      return []
+    if self.layout is None:
+      for value in values:
+        if self.parse(value) is not None:
+          break
+      else:
+        return [None]*len(values)
+    if self.layout == 'epoch':
+      return [self.parse(value) for value in values]
+    import numpy
+
+    strings = numpy.array(values, dtype=str)
+    parsed = [None]*len(values)
+    if strings.dtype.itemsize >= 19:
+      chars = strings.view(numpy.uint8).reshape(len(values), strings.dtype.itemsize)[:, :19].astype(numpy.int64)
+      ok = (numpy.char.str_len(strings) == 19) & (chars[:, 10] == ord(self.layout)) & (chars[:, 4] == ord('-')) &\
+        (chars[:, 7] == ord('-')) & (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+      digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] - ord('0')
+      ok &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+      (year, month, day, hour, minute, second) = [digits[:, i]*10 + digits[:, i + 1] for i in (2, 4, 6, 8, 10, 12)]
+      year += (digits[:, 0]*10 + digits[:, 1])*100
+      ok &= (year >= 1) & (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60) & (second < 60)
+      (months, inverse) = numpy.unique(numpy.where(ok, year*12 + month - 1, 12), return_inverse=True)
+      bounds = numpy.array([monthStart(m // 12, m % 12 + 1) for m in months.tolist()], dtype=numpy.int64)
+      ok &= (day >= 1) & (day <= bounds[inverse, 1])
+      epoch = bounds[inverse, 0] + (day - 1)*86400 + hour*3600 + minute*60 + second
+      parsed = epoch.tolist()
+    else:
+      ok = numpy.zeros(len(values), dtype=bool)
+    for i in numpy.nonzero(~ok)[0].tolist():
+      parsed[i] = self.parse(values[i])
+    return parsed
+
+  def detect(self, value):
+    if value.lstrip('-').isdigit():
+      return 'epoch'
+    if len(value) > 10 and value[10] == 'T':
+      return 'T'
+    return ' '
+
+  def parseStrptime(self, value):
+    for date_format in DATE_FORMATS:
+      try:
+        return epochFromDatetime(datetime.datetime.strptime(value, date_format))
+      except ValueError:
+        pass
+    return None
+
+
+#
+# Maps epoch seconds to the label of their temporal_split bucket.
+#
+# Built once per stream: all, year, month, week (starting Monday), day,
+# hour, 10min and minute as before, plus N minute / N hour buckets written
+# as e.g. 15min, 5minutes, 6hour or 12h, counted from midnight.  Any other
+# value keeps the full timestamp like temporalSplit did.  Bucket bounds are
+# integer arithmetic on the epoch seconds and the label of each bucket is
+# formatted once; the bucket of the previous call is checked first since the
+# crossings of a track are close together in time.
+#
+class TemporalBucketer():
+  MAX_LABELS = 100000
+
+  def __init__(self, which):
+    self.which = which.strip().lower()
+    self.size = None
+    self.start = 0
+    self.end = 0
+    self.last = None
+    self.labels = {}
+    match = re.match(r'^(\d+)\s*(min|mins|minute|minutes|h|hour|hours)$', self.which)
+    if self.which == 'all':
+      # one bucket for everything, labelled with the first of datetime.MAXYEAR
+      (self.start, self.end) = (float('-inf'), float('inf'))
+      self.last = formatEpoch(monthStart(datetime.MAXYEAR, 1)[0])
+    elif self.which == 'year':
+      self.bucket = self.yearBucket
+    elif self.which == 'month':
+      self.bucket = self.monthBucket
+    elif self.which == 'week':
+      self.bucket = self.weekBucket
+    elif self.which == 'day':
+      self.size = 86400
+    elif self.which == 'hour':
+      self.size = 3600
+    elif self.which == 'minute':
+      self.size = 60
+    elif match and int(match.group(1)) > 0:
+      self.size = int(match.group(1)) * (60 if match.group(2).startswith('m') else 3600)
+    else:
+      self.size = 1
+    if self.size is not None:
+      self.bucket = self.dayBucket
+
+  def label(self, seconds):
+    if self.start <= seconds < self.end:
+      return self.last
+    (self.start, self.end) = self.bucket(seconds)
+    self.last = self.labels.get(self.start)
+    if self.last is None:
+      if len(self.labels) >= self.MAX_LABELS:
+        self.labels.clear()
+      self.last = self.labels[self.start] = formatEpoch(self.start)
+    return self.last
+
+  # (start, end) epoch seconds of the bucket holding seconds
+  def bounds(self, seconds):
+    self.label(seconds)
+    return (self.start, self.end)
+
+  # fixed size buckets counted from midnight, the last one of a day may be short
+  def dayBucket(self, seconds):
+    (days, rest) = divmod(seconds, 86400)
+    start = days*86400 + rest - rest % self.size
+    return (start, min(start + self.size, (days+1)*86400))
+
+  def weekBucket(self, seconds):
+    # 1970-01-05 was a Monday
+    start = seconds - (seconds - 4*86400) % (7*86400)
+    return (start, start + 7*86400)
+
+  def monthBucket(self, seconds):
+    day = datetimeFromEpoch(seconds - seconds % 86400)
+    (start, days) = monthStart(day.year, day.month)
+    return (start, start + days*86400)
+
+  def yearBucket(self, seconds):
+    year = datetimeFromEpoch(seconds - seconds % 86400).year
+    start = monthStart(year, 1)[0]
+    if year == datetime.MAXYEAR:
+      return (start, float('inf'))
+    return (start, monthStart(year + 1, 1)[0])
+
+
+#
+# True when every bucket of the split fine lies inside a single bucket of
+# coarse, so coarse aggregates are sums of fine ones.  Fixed size buckets
+# start at midnight, as do calendar ones.
+#
+def nestedSplits(fine, coarse):
+  (fine, coarse) = (TemporalBucketer(fine), TemporalBucketer(coarse))
+  if fine.which == coarse.which or coarse.which == 'all':
+    return True
+  if fine.size is not None:
+    # coarse buckets of a day or more only break at midnight
+    return coarse.size is None or coarse.size >= 86400 or coarse.size % fine.size == 0
+  return fine.which == 'month' and coarse.which == 'year'
+
+
+#
+# Labels of the coarser buckets holding a fine bucket, looked up by the
+# label of the fine one, for the rollup_splits of a temporal_split.
+#
+class RollupLabeler():
+  MAX_LABELS = 100000
+
+  def __init__(self, which, rollups):
+    for rollup in rollups:
+      if not nestedSplits(which, rollup):
+        raise ValueError("temporal_split " + which + " buckets don't fit into " + rollup + " buckets")
+    self.timestamps = TimestampParser()
+    self.bucketers = [TemporalBucketer(rollup) for rollup in rollups]
+    self.known = {}
+
+  def labels(self, label):
+    labels = self.known.get(label)
+    if labels is None:
+      if len(self.known) >= self.MAX_LABELS:
+        self.known.clear()
+      seconds = self.timestamps.parse(label)
+      labels = self.known[label] = [bucketer.label(seconds) for bucketer in self.bucketers]
+    return labels
@@ -14,29 +14,17 @@
 
 import sys
 import math
-import datetime
+import itertools
+import collections
 sys.path.append('./') 
 
-# The line below works in python shell but doesn't work via hive, replace it with load_dynamic
-#import gmpy2 
-import imp
-gmpy2 = imp.load_dynamic('gmpy2', '/opt/anaconda/lib/python2.7/site-packages/gmpy2.so')
-
 sys.path.append('../conf')
-from config import AggregateMicroPathConfig
-#import numpy
-#from numpy import *
-
-class Point () :
-    def __init__(self,x,y):
-        self.x = x
-        self.y = y;
-
-def ccw(A,B,C):
-    return - ((C.y-A.y) * (B.x-A.x)) + ((B.y-A.y) * (C.x-A.x))
-
-def isgtzero (a) :
-    return a > 0
+from config import loadConfig
+from timestamps import TimestampParser, TemporalBucketer, RollupLabeler
+from blanket_index import BlanketIndex
+from counters import Counters, timedRows, countedRows
+from geometry import Point, betweenpts, GeometryKernel
+import cell_keys
 
 #
 # modify a pair of lat or lon coordinates to correctly
@@ -65,131 +53,6 @@ def computeDistanceKM(lat1, lon1, lat2, lon2):
   return d
 
 
-def betweenpts(A1,A2,Q,threshold=0.0000001):
-    compAxMin = gmpy2.mpfr(min(A1.x,A2.x) - gmpy2.mpfr(threshold));
-    compAxMax = gmpy2.mpfr(max(A1.x,A2.x) + gmpy2.mpfr(threshold));
-    compAyMin = gmpy2.mpfr(min(A1.y,A2.y) - gmpy2.mpfr(threshold));
-    compAyMax = gmpy2.mpfr(max(A1.y,A2.y) + gmpy2.mpfr(threshold));
-    if compAxMin <= Q.x <= compAxMax and compAyMin <= Q.y <= compAyMax:
-        return True
-    return False
-
-def intersect_gmpy (A,B,C,D):
-    acd = ccw(A,C,D)
-    bcd = ccw(B,C,D)
-    abc = ccw(A,B,C)
-    abd = ccw(A,B,D)
-
-    #literal edge cases, when one of our points lies on the opposite line
-    if (acd == 0 and betweenpts(A,C,D)) or (bcd == 0 and betweenpts(B,C,D))\
-    or (abc == 0 and betweenpts(A,B,C)) or (abd == 0 and betweenpts(A,B,D))\
-    or (isgtzero (acd) != isgtzero (bcd) and isgtzero (abc) != isgtzero (abd)) :
-
-        denom = gmpy2.mpfr(((D.y-C.y)*(B.x-A.x))- ((D.x-C.x)*(B.y-A.y)))
-        uanumerator = gmpy2.mpfr(((D.x-C.x)*(A.y-C.y))-((D.y-C.y)*(A.x-C.x)))
-        ubnumerator = gmpy2.mpfr(((B.x-A.x)*(A.y-C.y))-((B.y-A.y)*(A.x-C.x)))
-        if denom == 0:
-            # Lines are parallel, so return no
-            return (0,0,0)
-        else:
-            ua = gmpy2.mpfr(uanumerator/denom)
-            ub = gmpy2.mpfr(ubnumerator/denom)
-
-            #if ua and ub are both between 0 and 1, then the intersection is in  both segments
-            #NOTE: it does not matter which determinant we use for the equations below
-            x = gmpy2.mpfr (A.x + (ua*(B.x-A.x)))
-            y = gmpy2.mpfr (A.y + (ua*(B.y-A.y)))
-            sign = 1
-
-            #if the segment has the same y values (horizontal) then if going west it is negative
-            #if the segment has different y values, going south is negative
-            if (A.y==B.y and A.x>B.x) or (A.y>B.y):
-                sign = sign * -1
-
-            if min(A.x,B.x) <= x <= max(A.x,B.x) and\
-              min(A.y,B.y) <= y <= max(A.y,B.y):
-              return (x,y,sign)
-            else:
-              return (0,0,0)
-
-    return (0,0,0)
-
-def perp(a):
-    b = empty_like(a)
-    b[0] = -a[1]
-    b[1] = a[0]
-    return b
-
-def seg_intersect(a1, a2, b1, b2):
-    da = a2-a1
-    db = b2-b1
-    dp = a1-b1
-    dap = perp(da)
-    denom = dot(dap, db)
-    if denom == 0:
-      return(0,0)
-    num = dot(dap, dp)
-    (intx, inty) = (num / denom)*db + b1 
-    #Make sure we are within the bounds of the segment
-    if min(a1[0],a2[0]) <= intx <= max(a1[0],a2[0]) and\
-      min(b1[0] ,b2[0]) <= intx <= max(b1[0],b2[0]) and\
-      min(a1[1] ,a2[1]) <= inty <= max(a1[1],a2[1]) and\
-      min(b1[1] ,b2[1]) <= inty <= max(b1[1],b2[1]):
-        return (intx, inty)
-    return (0,0)
-
-
-# Returns the point of intersection as the first two parameters (latitude, longitude) and the last parameter as the direction of crossing.
-# first two points are the GMTI segment. Second two points are the tripline we check against.
-def intersect(a1,a2,b1,b2):
-    swap = 0
-    if a1[0] == a2[0]:
-        (a1, a2, b1, b2, swap) = (b1, b2, a1, a2, 1)
-        if a1[0] == a2[0]:
-            return (0,0,0)
-    if b1[0] == b2[0]:
-        slopea = (a2[1]-a1[1]) / (a2[0]-a1[0])
-        inty = a1[1] + (b1[0]-a1[0])*slopea
-        if min(a1[0],a2[0]) <= b1[0] <= max(a1[0],a2[0]) and\
-          min(b1[1],b2[1]) <= inty <= max(b1[1],b2[1]):
-            if swap:
-                if b2[1] > b1[1]:
-                    return (b1[0],inty,1)
-                else:
-                    return (b1[0],inty,-1)
-            else:
-                if a2[0] > a1[0]:
-                    return (b1[0],inty,1)
-                else:
-                    return (b1[0],inty,-1)
-        return (0,0,0)
-    slopea = (a2[1] -a1[1]) / (a2[0] -a1[0])
-    slopeb = (b2[1] -b1[1]) / (b2[0] -b1[0])
-    if (slopea == slopeb):
-        return (0,0,0)
-    inta = a1[1] - a1[0]*slopea
-    intb = b1[1] - b1[0]*slopeb
-    
-    intx = (intb - inta)/(slopea - slopeb)
-    inty = slopea * intx + inta
-
-    sign = 1
-    if slopeb > slopea:
-            sign *= -1
-    if a1[0] > a2[0]:
-            sign *= -1
-
-    if min(a1[0],a2[0]) <= intx <= max(a1[0],a2[0]) and\
-      min(b1[0] ,b2[0]) <= intx <= max(b1[0],b2[0]) and\
-      min(a1[1] ,a2[1]) <= inty <= max(a1[1],a2[1]) and\
-      min(b1[1] ,b2[1]) <= inty <= max(b1[1],b2[1]):
-        return (intx, inty,sign)
-    else:
-      return (0,0,0)
-    #revisit this line
-    #return (intx,inty,-40)
-#starttime = time()
-
 def bearing(lat1, lon1, lat2, lon2):
     #lat1, lon1 = origin
     #lat2, lon2 = destination
@@ -206,160 +69,319 @@ def bearing(lat1, lon1, lat2, lon2):
     
     return bn
 
+#
+# tripline index of the cell holding a crossing at value, the old
+# value - value % resolution taken as a multiple of resolution
+#
+def cellIndex(value, resolution):
+  return int(round((value - (value % resolution)) / resolution))
+
+#
+# (blanket index, cell key) output fields of the crossing into the cell at
+# tripline indexes (i, j) of the k-th blanket, and the lat/lon of the cell
+# centre the crossing time is interpolated to.  None when the cell is off
+# the blanket grid.
+#
+def crossingCell(configuration, k, blanket, i, j):
+  #Re-adjust for the international date line
+  halfTurn = int(round(180 / blanket[6]))
+  if j < -halfTurn:
+    j += 2 * halfTurn
+  key = cell_keys.cellKey(blanket, i, j, configuration.cell_key)
+  if key is None:
+    return None
+  roundfactorLat = -1*int(round(math.log(blanket[5])))
+  roundfactorLon = -1*int(round(math.log(blanket[6])))
+  return ([str(k), str(key)], round((i + 0.5) * blanket[5], roundfactorLat), round((j + 0.5) * blanket[6], roundfactorLon))
+
+# start_dt and the result are epoch seconds
 def interpolatedTime(start_dt, start_lat, start_lon, end_lat, end_lon, vel):
     distance = computeDistanceKM(start_lat, start_lon, end_lat, end_lon)
     hours = distance / vel if vel > 0.00001 else 0.00001
     seconds = hours * 60 * 60 
-    return start_dt + datetime.timedelta(seconds=int(round(seconds))) 
-
-
-def temporalSplit(dt, which):
-    identity = lambda d : d 
-
-    def min10(d):
-        newMin = d.minute - (d.minute % 10)
-        return d.replace(minute=newMin, second=0, microsecond=0)
+    return start_dt + int(round(seconds))
 
-    conds = {
-        'all' : lambda d : d.replace(year=datetime.MAXYEAR, month=1, day=1, hour=0, minute=0, second=0, microsecond=0),
-        'year': lambda d : d.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0),
-        'month': lambda d : d.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
-        'day' : lambda d : d.replace(hour=0, minute=0, second=0, microsecond=0),
-        'hour': lambda d : d.replace(minute=0, second=0, microsecond=0),
-        '10min' : min10,
-        'minute' : lambda d: d.replace(second=0, microsecond=0) 
-    }
 
-    finalDt = conds.get(which.lower(), identity)(dt)
-    return finalDt.strftime('%Y-%m-%d %H:%M:%S')
+#
+# grid index over the blankets, only worth it with more than one blanket
+#
+def blanketIndex(configuration):
+  if len(configuration.triplineBlankets) < 2:
+    return None
+  return BlanketIndex(configuration.triplineBlankets, configuration.blanket_index_cell)
 
-configuration = AggregateMicroPathConfig(sys.argv.pop())
-for line in sys.stdin:
-  track_row = line.split("\t")
-  (lat1, lon1, lat2, lon2, date1, date2, vel, track_id) = track_row
+#
+# (level, blankets) of every level of the resolution pyramid.  A crossing of
+# a coarse tripline is also one of the finer lines below it, every level is
+# computed like a run at its resolution would so the cells and interpolated
+# times match.
+#
+def pyramidLevels(configuration):
+  return [(level, configuration.levelBlankets(level)) for level in range(max(1, configuration.pyramid_levels))]
 
-  track_id = track_id.strip()  
-  start_dt = datetime.datetime.strptime(date1, '%Y-%m-%d %H:%M:%S')
+#
+# original per tripline loop, kept as the reference engine
+#
+def referenceTriplineBins(configuration, rows, kernel):
+  timestamps = TimestampParser()
+  bucketer = TemporalBucketer(configuration.temporal_split)
+  index = blanketIndex(configuration)
+  levels = pyramidLevels(configuration)
+  tagged = len(levels) > 1
+  for track_row in rows:
+    (lat1, lon1, lat2, lon2, date1, date2, vel, track_id) = track_row
+
+    track_id = track_id.strip()  
+    start_dt = timestamps.parse(date1)
   
-  lat1 = float(lat1)
-  lon1 = float(lon1)
-  lat2 = float(lat2)
-  lon2 = float(lon2)
+    lat1 = float(lat1)
+    lon1 = float(lon1)
+    lat2 = float(lat2)
+    lon2 = float(lon2)
   
-  vel = float(vel)
-  direction = bearing(lat1, lon1, lat2, lon2)
-
-  for blanket in configuration.triplineBlankets:
-
-    tripLat1 = blanket[0]#0 lower left
-    tripLon1 = blanket[1]#1 lower left
-    tripLat2 = blanket[2]#2 upper right
-    tripLon2 = blanket[3]#3 upper right
-    resolutionLat = blanket[5]
-    resolutionLon = blanket[6]
-      
-    roundfactorLat=-1*int(round(math.log(resolutionLat)))
-    roundfactorLon=-1*int(round(math.log(resolutionLon)))
+    vel = float(vel)
+    direction = bearing(lat1, lon1, lat2, lon2)
+
+    indexes = range(len(configuration.triplineBlankets))
+    if index is not None:
+      indexes = index.segmentBlanketIndexes(lat1, lon1, lat2, lon2)
+    blankets = [(level, k == 0, i, levelBlankets[i]) for (level, levelBlankets) in levels for (k, i) in enumerate(indexes)]
+
+    (segmentLon1, segmentLon2) = (lon1, lon2)
+    for (level, first, blanketPosition, blanket) in blankets:
+      if first:
+        #every level starts from the segment as it was read
+        (lon1, lon2) = (segmentLon1, segmentLon2)
+
+      tripLat1 = blanket[0]#0 lower left
+      tripLon1 = blanket[1]#1 lower left
+      tripLat2 = blanket[2]#2 upper right
+      tripLon2 = blanket[3]#3 upper right
+      resolutionLat = blanket[5]
+      resolutionLon = blanket[6]
    
-    tlon1 = lon1 
-    tlon2 = lon2 
-
-    A=Point(lat1, lon1)
-    B=Point(lat2, lon2)
-    #Make sure the blanket covers this segment
-    lowerLeftAOI = Point(tripLat1, tripLon1)
-    upperRightAOI = Point(tripLat2, tripLon2)
-    firstPointOK = betweenpts(lowerLeftAOI, upperRightAOI, A)
-    secondPointOK = betweenpts(lowerLeftAOI, upperRightAOI, B)
-
-    if not (firstPointOK or secondPointOK):
-      #This will however exclude segments that go over the entire blanket region
-      continue
-
-    #check to see if we should route the segment over the international dateline 
-    if abs(lon1-lon2) > 180: 
-      if lon1 > lon2:
-        lon1 = lon1 - 360
-      else:
-        lon2 = lon2 - 360
-    #Start iterating over the latitudes (horizontal triplines)
-    #these two calls give us the max and min tripline indexes
-    latscaledmin = int(math.floor((min(lat1,lat2)-resolutionLat)/resolutionLat))
-    latscaledmax = int(math.ceil((max(lat1,lat2)+resolutionLat)/resolutionLat))
-    
-    #the max and min calls make sure we don't get fuzzy edges, by clamping the range to the bounding box
-    for interval in range (max(latscaledmin,blanket[7]),min(latscaledmax,blanket[8])):
-      currentTripLat = float(interval)*resolutionLat
-      C=Point(currentTripLat, tripLon1)
-      D=Point(currentTripLat, tripLon2)
-      #multiply to get the latitude from the interval!
-      #(intersectX, intersectY, intersectDir) = intersect((lat1,lon1), (lat2,lon2),(currentTripLat,tripLon1),(currentTripLat,tripLon2))
-      #(intersectX, intersectY) = seg_intersect(numpy.array([lat1,lon1]), numpy.array([lat2,lon2]),numpy.array([currentTripLat,tripLon1]),numpy.array([currentTripLat,tripLon2]))
-      (intersectX, intersectY, intersectDir) = intersect_gmpy(A, B, C, D)
-      #if abs(intersectX - intersectX2)> float(0.0001) or abs(intersectY - intersectY2) > float(0.0001):
-      #  print('DIFF')
-      #  print(lat1, lon1, lat2, lon2)
-      #  print(intersectX, intersectX2, intersectY, intersectY2)
-      #  print(currentTripLat, tripLon1, currentTripLat, tripLon2)
-      #  out = [lat1,tlon1,lat2,tlon2,date1,date2,intersectX,intersectY]
-      #  out = map(lambda x: str(x),out)
-      #  print "\t".join(out)   
-
-      if intersectX ==0 and intersectY == 0:
-        #intersection is not on line segment... off to side
+      tlon1 = lon1 
+      tlon2 = lon2 
+
+      A=Point(lat1, lon1)
+      B=Point(lat2, lon2)
+      #Make sure the blanket covers this segment
+      lowerLeftAOI = Point(tripLat1, tripLon1)
+      upperRightAOI = Point(tripLat2, tripLon2)
+      firstPointOK = betweenpts(lowerLeftAOI, upperRightAOI, A)
+      secondPointOK = betweenpts(lowerLeftAOI, upperRightAOI, B)
+
+      if not (firstPointOK or secondPointOK):
+        #This will however exclude segments that go over the entire blanket region
         continue
+
+      #check to see if we should route the segment over the international dateline 
+      if abs(lon1-lon2) > 180: 
+        if lon1 > lon2:
+          lon1 = lon1 - 360
+        else:
+          lon2 = lon2 - 360
+      #Start iterating over the latitudes (horizontal triplines)
+      #these two calls give us the max and min tripline indexes
+      latscaledmin = int(math.floor((min(lat1,lat2)-resolutionLat)/resolutionLat))
+      latscaledmax = int(math.ceil((max(lat1,lat2)+resolutionLat)/resolutionLat))
+    
+      #the max and min calls make sure we don't get fuzzy edges, by clamping the range to the bounding box
+      for interval in range (max(latscaledmin,blanket[7]),min(latscaledmax,blanket[8])):
+        currentTripLat = float(interval)*resolutionLat
+        C=Point(currentTripLat, tripLon1)
+        D=Point(currentTripLat, tripLon2)
+        #multiply to get the latitude from the interval!
+        (intersectX, intersectY, intersectDir) = kernel.intersect(A, B, C, D)
+
+        if intersectX ==0 and intersectY == 0:
+          #intersection is not on line segment... off to side
+          continue
  
-      #TODO: currently this rounding is hardcoded - need to configure it
-      intersectX = round(intersectX + resolutionLat*0.5, roundfactorLat)
-      intersectY = round((intersectY) - (intersectY % resolutionLon) + (resolutionLon*0.5), roundfactorLon)
-        
-      #Re-adjust for the international date line 
-      if intersectY < -180:
-        intersectY = intersectY + 360.0
-      dt = interpolatedTime(start_dt, lat1, lon1, intersectX, intersectY, vel)
-      finalDate = temporalSplit(dt, configuration.temporal_split)
-      out = [intersectX,intersectY,finalDate,vel,direction,track_id]
-      out = map(lambda x: str(x),out)
-      print "\t".join(out)   
+        #the cell above the tripline
+        cell = crossingCell(configuration, blanketPosition, blanket, interval, cellIndex(intersectY, resolutionLon))
+        if cell is None:
+          kernel.counters.increment('cells_off_grid')
+          continue
+        (key, cellX, cellY) = cell
+        dt = interpolatedTime(start_dt, lat1, lon1, cellX, cellY, vel)
+        finalDate = bucketer.label(dt)
+        out = key + [finalDate,str(vel),str(direction),track_id]
+        if tagged:
+          out.append(str(level))
+        yield out
   
-    #Start iterating over the longitudes (vertical triplines)
-    #these two calls give us the max and min tripline indexes
-    lonscaledmin = int(math.floor((min(lon1,lon2)-resolutionLon)/resolutionLon))
-    lonscaledmax = int(math.ceil((max(lon1,lon2)+resolutionLon)/resolutionLon))
+      #Start iterating over the longitudes (vertical triplines)
+      #these two calls give us the max and min tripline indexes
+      lonscaledmin = int(math.floor((min(lon1,lon2)-resolutionLon)/resolutionLon))
+      lonscaledmax = int(math.ceil((max(lon1,lon2)+resolutionLon)/resolutionLon))
     
-    #the max and min calls make sure we don't get fuzzy edges, by clamping the range to the bounding box
-    for interval in range (max(lonscaledmin,blanket[9]),min(lonscaledmax, blanket[10])):
-      #multiply to get the longitude from the interval!
-      currentTripLon = float(interval)*resolutionLon
-      #(intersectX, intersectY, intersectDir) = intersect((lat1,lon1), (lat2,lon2),(tripLat1,currentTripLon),(tripLat2,currentTripLon))
-      #(intersectX, intersectY) = seg_intersect(numpy.array([lat1,lon1]), numpy.array([lat2,lon2]),numpy.array([tripLat1,currentTripLon]),numpy.array([tripLat2,currentTripLon]))
-      C = Point(tripLat1, currentTripLon)
-      D = Point(tripLat2, currentTripLon)
-      (intersectX, intersectY, intersectDir) = intersect_gmpy(A, B, C, D)
-      #if abs(intersectX - intersectX2)> float(0.0001) or abs(intersectY - intersectY2) > float(0.0001):
-      #  print('Diff')
-      #  print(lat1, lon1, lat2, lon2)
-      #  print(intersectX, intersectX2, intersectY, intersectY2)
-      #  print(tripLat1, currentTripLon, tripLat2, currentTripLon)
-      #  out = [lat1,tlon1,lat2,tlon2,date1,date2,intersectX,intersectY]
-      #  out = map(lambda x: str(x),out)
-      #  print "\t".join(out)   
-
-      if intersectX == 0 and intersectY == 0:
-        #intersection is not on line segment... off to side
-        continue
+      #the max and min calls make sure we don't get fuzzy edges, by clamping the range to the bounding box
+      for interval in range (max(lonscaledmin,blanket[9]),min(lonscaledmax, blanket[10])):
+        #multiply to get the longitude from the interval!
+        currentTripLon = float(interval)*resolutionLon
+        C = Point(tripLat1, currentTripLon)
+        D = Point(tripLat2, currentTripLon)
+        (intersectX, intersectY, intersectDir) = kernel.intersect(A, B, C, D)
+
+        if intersectX == 0 and intersectY == 0:
+          #intersection is not on line segment... off to side
+          continue
+
+        #the cell right of the tripline
+        cell = crossingCell(configuration, blanketPosition, blanket, cellIndex(intersectX, resolutionLat), interval)
+        if cell is None:
+          kernel.counters.increment('cells_off_grid')
+          continue
+        (key, cellX, cellY) = cell
+        dt = interpolatedTime(start_dt, lat1, lon1, cellX, cellY, vel)
+        finalDate = bucketer.label(dt)
+        out = key + [finalDate,str(vel),str(direction),track_id]
+        if tagged:
+          out.append(str(level))
+        yield out
 
-      intersectY = round(intersectY + resolutionLon*0.5, roundfactorLon)
-      intersectX = round((intersectX) - (intersectX % resolutionLat) + (resolutionLat*0.5), roundfactorLat)
-      
-      #Re-adjust for the international date line 
-      if intersectY < -180:
-        intersectY = intersectY + 360.0
-    
-      dt = interpolatedTime(start_dt, lat1, lon1, intersectX, intersectY, vel)
-      finalDate = temporalSplit(dt, configuration.temporal_split)
-      out = [intersectX,intersectY,finalDate,vel,direction,track_id]
-      out = map(lambda x: str(x),out)
-      print "\t".join(out)
+#
+# batched engine, reads the segments in chunks and finds all of their
+# crossings with array operations (see tripline_vector.py)
+#
+def vectorTriplineBins(configuration, rows, chunk_size, kernel=None):
+  timestamps = TimestampParser()
+  bucketer = TemporalBucketer(configuration.temporal_split)
+  index = blanketIndex(configuration)
+  levels = pyramidLevels(configuration)
+  rows = iter(rows)
+  chunk = list(itertools.islice(rows, chunk_size))
+  while chunk:
+    # numpy is only loaded once there are rows, tasks without any start faster
+    import tripline_vector
+    for out in vectorChunkCrossings(configuration, chunk, tripline_vector, timestamps, bucketer, index, levels, kernel):
+      yield out
+    chunk = list(itertools.islice(rows, chunk_size))
+
+def vectorChunkCrossings(configuration, chunk, tripline_vector, timestamps, bucketer, index, levels=None, kernel=None):
+  lat1 = [float(row[0]) for row in chunk]
+  lon1 = [float(row[1]) for row in chunk]
+  lat2 = [float(row[2]) for row in chunk]
+  lon2 = [float(row[3]) for row in chunk]
+  vel = [float(row[6]) for row in chunk]
+  track_ids = [row[7].strip() for row in chunk]
+
+  direction = tripline_vector.bearingArrays(lat1, lon1, lat2, lon2).tolist()
+  candidates = None
+  if index is not None:
+    candidates = index.candidateSegments(lat1, lon1, lat2, lon2)
+  if levels is None:
+    levels = [(0, configuration.triplineBlankets)]
+
+  start_dts = tripline_vector.numpy.array([timestamps.parse(row[4]) for row in chunk], dtype=tripline_vector.numpy.int64)
+  out = []
+  for (level, blankets) in levels:
+    (seg, blanket, key, offset, off_grid) = tripline_vector.computeCrossings(lat1, lon1, lat2, lon2, vel, blankets, candidates, kernel,
+                                                                            configuration.cell_key)
+    if off_grid and kernel is not None:
+      kernel.counters.increment('cells_off_grid', off_grid)
+    dts = (start_dts[seg] + offset).tolist()
+    for (s, k, cell, dt) in zip(seg.tolist(), blanket.tolist(), key.tolist(), dts):
+      finalDate = bucketer.label(dt)
+      out.append([str(k), str(cell), finalDate, str(vel[s]), str(direction[s]), track_ids[s]])
+      if len(levels) > 1:
+        out[-1].append(str(level))
+  return out
+
+#
+# tripline crossings of (alat, alon, blat, blon, adt, bdt, velocity, id) rows
+# as lists of output fields (blanket, cell key, dt, velocity, direction, id,
+# see cell_keys.py), followed by the pyramid level when pyramid_levels is
+# above 1.  The geometry_kernel counts and the crossings dropped for a cell
+# off the blanket grid go to counters.
+#
+def triplineCrossings(configuration, rows, counters=None):
+  kernel = GeometryKernel(configuration.geometry_kernel, counters)
+  if configuration.tripline_engine == "reference":
+    return referenceTriplineBins(configuration, rows, kernel)
+  return vectorTriplineBins(configuration, rows, configuration.tripline_chunk_size, kernel)
+
+#
+# In-mapper combiner.  Keeps at most max_entries (blanket, cell, dt) cells holding
+# the crossing count, velocity sum, direction sum and direction sin/cos sums,
+# and flushes the least recently used cell when it runs full.  Flushed rows
+# carry the sums in the velocity/direction columns plus the crossing count
+# and sin/cos sums as extra columns, so the GROUP BY of the aggregation stage
+# merges them with each other and with uncombined rows.
+#
+class CrossingCombiner():
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+
+  def add(self, blanket, cell, dt, velocity, direction, level=None):
+    key = (blanket, cell, dt, level)
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      entry = [0, 0.0, 0.0, 0.0, 0.0]
+    entry[0] += 1
+    entry[1] += velocity
+    entry[2] += direction
+    entry[3] += math.sin(math.radians(direction))
+    entry[4] += math.cos(math.radians(direction))
+    self.entries[key] = entry
+    if len(self.entries) > self.max_entries:
+      return self.row(*self.entries.popitem(last=False))
+    return None
+
+  def flush(self):
+    while self.entries:
+      yield self.row(*self.entries.popitem(last=False))
+
+  def row(self, key, entry):
+    (crossings, velocity, direction, direction_sin, direction_cos) = entry
+    # track ids do not survive combining, \N reads as NULL in hive
+    out = [key[0], key[1], key[2], repr(velocity), repr(direction), "\\N", str(crossings), repr(direction_sin), repr(direction_cos)]
+    if key[3] is not None:
+      out.append(key[3])
+    return out
+
+def combineCrossings(crossings, max_entries):
+  combiner = CrossingCombiner(max_entries)
+  for crossing in crossings:
+    (blanket, cell, dt, vel, direction) = crossing[:5]
+    out = combiner.add(blanket, cell, dt, float(vel), float(direction), crossing[6] if len(crossing) > 6 else None)
+    if out is not None:
+      yield out
+  for out in combiner.flush():
+    yield out
+
+
+#
+# Rows of a pyramid or rollup run: every row gets the combiner columns (\N
+# when it wasn't combined), its pyramid level and the comma separated labels
+# of the rollup_splits buckets holding its time bucket
+#
+def levelRows(configuration, rows):
+  tagged = configuration.pyramid_levels > 1
+  labeler = RollupLabeler(configuration.temporal_split, configuration.rollup_splits)
+  for out in rows:
+    level = "0"
+    if tagged:
+      level = out.pop()
+    if len(out) == 6:
+      out += ["\\N", "\\N", "\\N"]
+    out.append(level)
+    out.append(",".join(labeler.labels(out[2])) if configuration.rollup_splits else "\\N")
+    yield out
+
+
+if __name__ == "__main__":
+  configuration = loadConfig(sys.argv.pop())
+  counters = Counters("micro_path_tripline", sys.stderr)
+  rows = (line.split("\t") for line in timedRows(sys.stdin, counters))
+  crossings = countedRows(triplineCrossings(configuration, rows, counters), counters, 'crossings')
+  if configuration.tripline_combine_size > 0:
+    crossings = combineCrossings(crossings, configuration.tripline_combine_size)
+  if len(configuration.outputLevels()) > 1:
+    crossings = levelRows(configuration, crossings)
+  sys.stdout.writelines("\t".join(out) + "\n" for out in countedRows(crossings, counters, 'rows_out'))
+  counters.flush()
 #stoptime = time()-starttime
 #print(stoptime)
@@ -0,0 +1,316 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Batched tripline crossing engine.
+#
+# The triplines of a blanket are axis aligned, so the candidate lines a
+# segment can cross are known in closed form from its bounding box.  Every
+# (segment, tripline) candidate of a chunk is laid out in flat arrays and
+# tested at once.  The arithmetic mirrors geometry.floatIntersect operation
+# for operation, and the candidates it can't decide go to the same
+# geometry_kernel as in the reference loop, so both paths produce the same
+# cells.
+#
+
+import math
+import numpy
+
+BETWEEN_THRESHOLD = 0.0000001
+
+
+def ccwArrays(ax, ay, bx, by, cx, cy):
+  return - ((cy - ay) * (bx - ax)) + ((by - ay) * (cx - ax))
+
+
+#
+# True where q lies in the bounding box of p1,p2 (plus a small threshold)
+#
+def betweenArrays(p1x, p1y, p2x, p2y, qx, qy, threshold=BETWEEN_THRESHOLD):
+  return (numpy.minimum(p1x, p2x) - threshold <= qx) & (qx <= numpy.maximum(p1x, p2x) + threshold) &\
+    (numpy.minimum(p1y, p2y) - threshold <= qy) & (qy <= numpy.maximum(p1y, p2y) + threshold)
+
+
+#
+# error bound of ccwArrays, see geometry.boundedDifference
+#
+def ccwErrorArrays(ax, ay, bx, by, cx, cy, bound):
+  return bound * (numpy.abs((cy - ay) * (bx - ax)) + numpy.abs((by - ay) * (cx - ax)))
+
+
+#
+# array version of geometry.floatIntersect, returns (hit, x, y).  With a
+# kernel other than float the candidates the float arithmetic can't decide
+# are redone by it (see resolveArrays).
+#
+def intersectArrays(ax, ay, bx, by, cx, cy, dx, dy, kernel=None):
+  acd = ccwArrays(ax, ay, cx, cy, dx, dy)
+  bcd = ccwArrays(bx, by, cx, cy, dx, dy)
+  abc = ccwArrays(ax, ay, bx, by, cx, cy)
+  abd = ccwArrays(ax, ay, bx, by, dx, dy)
+
+  #literal edge cases, when one of our points lies on the opposite line
+  hit = ((acd == 0) & betweenArrays(ax, ay, cx, cy, dx, dy)) |\
+    ((bcd == 0) & betweenArrays(bx, by, cx, cy, dx, dy)) |\
+    ((abc == 0) & betweenArrays(ax, ay, bx, by, cx, cy)) |\
+    ((abd == 0) & betweenArrays(ax, ay, bx, by, dx, dy)) |\
+    (((acd > 0) != (bcd > 0)) & ((abc > 0) != (abd > 0)))
+
+  denom = ((dy - cy) * (bx - ax)) - ((dx - cx) * (by - ay))
+  uanumerator = ((dx - cx) * (ay - cy)) - ((dy - cy) * (ax - cx))
+  # Lines are parallel, so return no
+  hit &= denom != 0
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    ua = uanumerator / denom
+    x = ax + (ua * (bx - ax))
+    y = ay + (ua * (by - ay))
+    hit &= (numpy.minimum(ax, bx) <= x) & (x <= numpy.maximum(ax, bx)) &\
+      (numpy.minimum(ay, by) <= y) & (y <= numpy.maximum(ay, by))
+  #an intersection at exactly 0,0 is indistinguishable from a miss in the reference path
+  hit &= ~((x == 0) & (y == 0))
+  if kernel is None or kernel.name == "float":
+    return (hit, x, y)
+  return resolveArrays(kernel, ax, ay, bx, by, cx, cy, dx, dy, (acd, bcd, abc, abd), denom, ua, hit, x, y)
+
+
+#
+# The float results of intersectArrays checked against the error bounds of
+# geometry.boundedIntersect.  The candidates they can't decide (all of them
+# for the exact kernel) are redone one by one by geometry.exactIntersect; in
+# check mode every candidate is compared with the exact result.
+#
+def resolveArrays(kernel, ax, ay, bx, by, cx, cy, dx, dy, orientations, denom, ua, hit, x, y):
+  import geometry
+
+  bound = geometry.DETERMINANT_BOUND
+  epsilon = geometry.EPSILON
+  (acd, bcd, abc, abd) = orientations
+  uncertain = (numpy.abs(acd) <= ccwErrorArrays(ax, ay, cx, cy, dx, dy, bound)) |\
+    (numpy.abs(bcd) <= ccwErrorArrays(bx, by, cx, cy, dx, dy, bound)) |\
+    (numpy.abs(abc) <= ccwErrorArrays(ax, ay, bx, by, cx, cy, bound)) |\
+    (numpy.abs(abd) <= ccwErrorArrays(ax, ay, bx, by, dx, dy, bound))
+  crossing = ~uncertain & ((acd > 0) != (bcd > 0)) & ((abc > 0) != (abd > 0))
+  denomError = bound * (numpy.abs((dy - cy) * (bx - ax)) + numpy.abs((dx - cx) * (by - ay)))
+  numeratorError = bound * (numpy.abs((dx - cx) * (ay - cy)) + numpy.abs((dy - cy) * (ax - cx)))
+  # nearly parallel
+  uncertain |= crossing & (numpy.abs(denom) <= 2 * denomError)
+  crossing &= ~uncertain
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    uaError = (numeratorError + numpy.abs(ua) * denomError) / (numpy.abs(denom) - denomError) + epsilon * numpy.abs(ua)
+    errors = []
+    for (p, q, value) in ((ax, bx, x), (ay, by, y)):
+      delta = q - p
+      error = numpy.where(delta == 0, 0.0, 2 * (uaError * numpy.abs(delta) + 2 * epsilon * numpy.abs(ua * delta) + epsilon * numpy.abs(value)))
+      # crossing at the very end of the segment
+      uncertain |= crossing & (error > 0) &\
+        ((numpy.abs(value - numpy.minimum(p, q)) <= error) | (numpy.abs(value - numpy.maximum(p, q)) <= error))
+      errors.append(error)
+  error = numpy.where(crossing & ~uncertain, numpy.maximum(errors[0], errors[1]), 0.0)
+
+  if kernel.name == "exact":
+    redo = numpy.arange(len(hit))
+  else:
+    redo = numpy.flatnonzero(uncertain)
+  if not len(redo) and kernel.name != "check":
+    return (hit, x, y)
+  (ax, ay, bx, by, cx, cy, dx, dy) = numpy.broadcast_arrays(ax, ay, bx, by, cx, cy, dx, dy)
+  fast = (hit.copy(), x.copy(), y.copy())
+  points = lambda i: (geometry.Point(ax[i], ay[i]), geometry.Point(bx[i], by[i]), geometry.Point(cx[i], cy[i]), geometry.Point(dx[i], dy[i]))
+  for i in redo.tolist():
+    (intersectX, intersectY, sign) = geometry.exactIntersect(*points(i))
+    hit[i] = not (intersectX == 0 and intersectY == 0)
+    x[i] = intersectX
+    y[i] = intersectY
+  kernel.counters.increment('geometry_exact', len(redo))
+  if kernel.name == "check":
+    for i in range(len(hit)):
+      (A, B, C, D) = points(i)
+      sign = geometry.crossingSign(A, B)
+      result = (x[i], y[i], sign) if hit[i] else geometry.MISS
+      floatResult = (fast[1][i], fast[2][i], sign) if fast[0][i] else geometry.MISS
+      kernel.compare(A, B, C, D, result, error[i], floatResult)
+  return (hit, x, y)
+
+
+def wrapDistanceArrays(d1, d2):
+  first = (d1 < -90) & (d2 > 90)
+  second = ~first & (d2 < -90) & (d1 > 90)
+  return (numpy.where(second, d1 - 360, d1), numpy.where(first, d2 - 360, d2))
+
+
+# haversine distance in kilometers, same operation order as computeDistanceKM
+def computeDistanceKMArrays(lat1, lon1, lat2, lon2):
+  (lat1, lat2) = wrapDistanceArrays(lat1, lat2)
+  (lon1, lon2) = wrapDistanceArrays(lon1, lon2)
+  R = 6371
+  dlat = numpy.radians(lat2 - lat1)
+  dlon = numpy.radians(lon2 - lon1)
+  a = numpy.sin(dlat/2) * numpy.sin(dlat/2) + numpy.cos(numpy.radians(lat1)) * numpy.cos(numpy.radians(lat2)) * numpy.sin(dlon/2) * numpy.sin(dlon/2)
+  c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))
+  return R * c
+
+
+def bearingArrays(lat1, lon1, lat2, lon2):
+  lat1 = numpy.asarray(lat1, dtype=numpy.float64)
+  lon1 = numpy.asarray(lon1, dtype=numpy.float64)
+  lat2 = numpy.asarray(lat2, dtype=numpy.float64)
+  lon2 = numpy.asarray(lon2, dtype=numpy.float64)
+  rlat1 = numpy.radians(lat1)
+  rlat2 = numpy.radians(lat2)
+  dlon = numpy.radians(lon2 - lon1)
+  b = numpy.arctan2(numpy.sin(dlon) * numpy.cos(rlat2), numpy.cos(rlat1) * numpy.sin(rlat2) - numpy.sin(rlat1) * numpy.cos(rlat2) * numpy.cos(dlon))
+  return numpy.mod(numpy.degrees(b) + 360, 360)
+
+
+#
+# seconds from the segment start to the crossing, rounded half away from zero
+# like int(round(seconds)) in interpolatedTime
+#
+def interpolatedOffsetArrays(start_lat, start_lon, end_lat, end_lon, vel):
+  distance = computeDistanceKMArrays(start_lat, start_lon, end_lat, end_lon)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    hours = numpy.where(vel > 0.00001, distance / vel, 0.00001)
+  seconds = hours * 60 * 60
+  whole = numpy.floor(seconds)
+  return (whole + (seconds - whole >= 0.5)).astype(numpy.int64)
+
+
+#
+# python's round() on every element.  numpy.round scales by 10**n first and
+# can land on the other side of a rounding boundary.
+#
+def roundArray(values, ndigits):
+  return numpy.array([round(v, ndigits) for v in values.tolist()], dtype=numpy.float64)
+
+
+#
+# flatten the integer ranges [lo, hi) of every segment into
+# (segment index, interval) candidate pairs
+#
+def expandRanges(lo, hi):
+  counts = numpy.maximum(hi - lo, 0)
+  seg = numpy.repeat(numpy.arange(len(counts)), counts)
+  starts = numpy.cumsum(counts) - counts
+  interval = lo[seg] + (numpy.arange(counts.sum()) - starts[seg])
+  return (seg, interval)
+
+
+#
+# tripline index of the cells holding the crossings at values, the old
+# value - value % resolution taken as a multiple of resolution
+#
+def cellIndexArrays(values, resolution):
+  return numpy.round((values - (values % resolution)) / resolution).astype(numpy.int64)
+
+
+#
+# Find every tripline crossing for a chunk of segments.
+#
+# candidates optionally holds, per blanket, the sorted indexes of the
+# segments that can touch it (see BlanketIndex.candidateSegments), all
+# segments are tested against every blanket otherwise.  kernel is the
+# geometry.GeometryKernel of the crossing test, plain float64 without one.
+# order is the cell_key of the keys (see cell_keys.py).
+#
+# Returns (segment index, blanket index, cell key, seconds after segment
+# start) arrays, ordered the way the reference loop emits them: by segment,
+# then blanket, then horizontal before vertical triplines, and the number of
+# crossings dropped for a cell off the blanket grid.
+#
+def computeCrossings(lat1, lon1, lat2, lon2, vel, blankets, candidates=None, kernel=None, order="rowmajor"):
+  import cell_keys
+  lat1 = numpy.asarray(lat1, dtype=numpy.float64)
+  lon1 = numpy.array(lon1, dtype=numpy.float64)
+  lat2 = numpy.asarray(lat2, dtype=numpy.float64)
+  lon2 = numpy.array(lon2, dtype=numpy.float64)
+  vel = numpy.asarray(vel, dtype=numpy.float64)
+
+  pieces = []
+  for (k, blanket) in enumerate(blankets):
+    if candidates is None:
+      sub = numpy.arange(len(lat1))
+    else:
+      sub = candidates[k]
+      if len(sub) == 0:
+        continue
+    tripLat1 = blanket[0]#0 lower left
+    tripLon1 = blanket[1]#1 lower left
+    tripLat2 = blanket[2]#2 upper right
+    tripLon2 = blanket[3]#3 upper right
+    resolutionLat = blanket[5]
+    resolutionLon = blanket[6]
+
+    # segment end points as they were before the dateline shift below
+    ax = lat1[sub]
+    ay = lon1[sub]
+    bx = lat2[sub]
+    by = lon2[sub]
+
+    #Make sure the blanket covers this segment
+    covered = betweenArrays(tripLat1, tripLon1, tripLat2, tripLon2, ax, ay) |\
+      betweenArrays(tripLat1, tripLon1, tripLat2, tripLon2, bx, by)
+
+    #route the segment over the international dateline, this carries over to later blankets
+    wrap = covered & (numpy.abs(ay - by) > 180)
+    firstEast = ay > by
+    startLon = numpy.where(wrap & firstEast, ay - 360, ay)
+    endLon = numpy.where(wrap & ~firstEast, by - 360, by)
+    lon1[sub] = startLon
+    lon2[sub] = endLon
+
+    #horizontal triplines, the cell above the line
+    lo = numpy.floor((numpy.minimum(ax, bx) - resolutionLat) / resolutionLat).astype(numpy.int64)
+    hi = numpy.ceil((numpy.maximum(ax, bx) + resolutionLat) / resolutionLat).astype(numpy.int64)
+    lo = numpy.maximum(lo, blanket[7])
+    hi = numpy.where(covered, numpy.minimum(hi, blanket[8]), lo)
+    (seg, interval) = expandRanges(lo, hi)
+    currentTripLat = interval.astype(numpy.float64) * resolutionLat
+    (hit, x, y) = intersectArrays(ax[seg], ay[seg], bx[seg], by[seg],
+                                  currentTripLat, tripLon1, currentTripLat, tripLon2, kernel)
+    pieces.append((k, sub[seg[hit]], interval[hit], cellIndexArrays(y[hit], resolutionLon), startLon[seg[hit]]))
+
+    #vertical triplines, the cell right of the line
+    lo = numpy.floor((numpy.minimum(startLon, endLon) - resolutionLon) / resolutionLon).astype(numpy.int64)
+    hi = numpy.ceil((numpy.maximum(startLon, endLon) + resolutionLon) / resolutionLon).astype(numpy.int64)
+    lo = numpy.maximum(lo, blanket[9])
+    hi = numpy.where(covered, numpy.minimum(hi, blanket[10]), lo)
+    (seg, interval) = expandRanges(lo, hi)
+    currentTripLon = interval.astype(numpy.float64) * resolutionLon
+    (hit, x, y) = intersectArrays(ax[seg], ay[seg], bx[seg], by[seg],
+                                  tripLat1, currentTripLon, tripLat2, currentTripLon, kernel)
+    pieces.append((k, sub[seg[hit]], cellIndexArrays(x[hit], resolutionLat), interval[hit], startLon[seg[hit]]))
+
+  segs = [numpy.zeros(0, dtype=numpy.int64)]
+  indexes = [numpy.zeros(0, dtype=numpy.int64)]
+  keys = [numpy.zeros(0, dtype=numpy.int64)]
+  offsets = [numpy.zeros(0, dtype=numpy.int64)]
+  off_grid = 0
+  for (k, seg, i, j, startLon) in pieces:
+    blanket = blankets[k]
+    #Re-adjust for the international date line
+    halfTurn = int(round(180 / blanket[6]))
+    j = numpy.where(j < -halfTurn, j + 2 * halfTurn, j)
+    (key, on) = cell_keys.cellKeyArrays(blanket, i, j, order)
+    off_grid += int(len(on) - on.sum())
+    (seg, i, j, startLon) = (seg[on], i[on], j[on], startLon[on])
+    cellX = roundArray((i + 0.5) * blanket[5], -1*int(round(math.log(blanket[5]))))
+    cellY = roundArray((j + 0.5) * blanket[6], -1*int(round(math.log(blanket[6]))))
+    offsets.append(interpolatedOffsetArrays(lat1[seg], startLon, cellX, cellY, vel[seg]))
+    segs.append(seg)
+    indexes.append(numpy.repeat(k, len(seg)).astype(numpy.int64))
+    keys.append(key)
+
+  seg = numpy.concatenate(segs)
+  order = numpy.argsort(seg, kind='mergesort')
+  return (seg[order], numpy.concatenate(indexes)[order], numpy.concatenate(keys)[order], numpy.concatenate(offsets)[order], off_grid)
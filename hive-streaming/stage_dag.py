@@ -0,0 +1,160 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Stage DAG of a hive run.
+#
+# A stage is a named HQL script and the names of the stages it depends on.
+# Chains of stages (a stage whose only dependency has no other dependents)
+# are batched into one hive session so the CLI starts once for all of them.
+# Sessions whose dependencies are done run concurrently, at most parallel
+# at a time.
+#
+# A stage with a fingerprint (see fingerprint) stores it as the
+# micro_path.fingerprint property of its output tables once it succeeded.
+# The tables are recreated by the stage, so a failed or interrupted stage
+# leaves no fingerprint behind.  cachedStages drops the stages whose outputs
+# still carry their fingerprint from the next run.
+#
+
+import json
+import hashlib
+import threading
+import Queue
+
+FINGERPRINT_PROPERTY = "micro_path.fingerprint"
+
+
+class Stage():
+  def __init__(self, name, hql, depends=(), outputs=(), fingerprint=None):
+    self.name = name
+    self.hql = hql
+    self.depends = list(depends)
+    self.outputs = list(outputs)
+    self.fingerprint = fingerprint
+
+  #
+  # the HQL of the stage followed by the statements recording its fingerprint
+  #
+  def script(self):
+    if self.fingerprint is None:
+      return self.hql
+    return self.hql + "".join("\n    ALTER TABLE " + table + " SET TBLPROPERTIES ('" + FINGERPRINT_PROPERTY + "'='" + self.fingerprint + "');"
+                              for table in self.outputs)
+
+
+#
+# sha1 of JSON serializable parts (config values, input table state, the
+# fingerprints of upstream stages ...)
+#
+def fingerprint(*parts):
+  return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+#
+# sha1 of the content of files, e.g. the scripts a stage ships to hive
+#
+def fileDigest(paths):
+  digest = hashlib.sha1()
+  for path in paths:
+    with open(path, "rb") as infile:
+      digest.update(path + "\0" + infile.read() + "\0")
+  return digest.hexdigest()
+
+
+#
+# Split stages into (stages to run, names of the skipped ones).  A stage is
+# skipped when every output table carries its fingerprint in recorded
+# ({table: fingerprint}) and every stage it depends on is skipped too, so a
+# run restarts from the first stage that is invalid or failed.
+#
+def cachedStages(stages, recorded):
+  skipped = set()
+  run = []
+  for stage in stages:
+    if (stage.fingerprint is not None and stage.outputs and set(stage.depends) <= skipped and
+        all(recorded.get(table) == stage.fingerprint for table in stage.outputs)):
+      skipped.add(stage.name)
+    else:
+      run.append(Stage(stage.name, stage.hql, [name for name in stage.depends if name not in skipped],
+                       stage.outputs, stage.fingerprint))
+  return (run, [stage.name for stage in stages if stage.name in skipped])
+
+
+#
+# group stages (in dependency order) into sessions, lists of stages that
+# run one after the other in a single hive script
+#
+def sessions(stages, batch=True):
+  dependents = {}
+  for stage in stages:
+    for name in stage.depends:
+      dependents.setdefault(name, []).append(stage.name)
+  groups = []
+  group_of = {}
+  for stage in stages:
+    if batch and len(stage.depends) == 1:
+      parent = stage.depends[0]
+      group = groups[group_of[parent]]
+      if dependents[parent] == [stage.name] and group[-1].name == parent:
+        group.append(stage)
+        group_of[stage.name] = group_of[parent]
+        continue
+    group_of[stage.name] = len(groups)
+    groups.append([stage])
+  return (groups, group_of)
+
+
+#
+# Run the stages.  execute(name, hql) runs one session and returns True on
+# success; once a session fails no new ones are started.  Returns the names
+# of the stages that completed.
+#
+def runStages(stages, execute, parallel=4, batch=True):
+  (groups, group_of) = sessions(stages, batch)
+  needs = []
+  for (i, group) in enumerate(groups):
+    needs.append(set(group_of[name] for stage in group for name in stage.depends) - set([i]))
+
+  results = Queue.Queue()
+  def worker(i):
+    group = groups[i]
+    try:
+      ok = execute("+".join(stage.name for stage in group), "\n".join(stage.script() for stage in group))
+    except Exception:
+      ok = False
+    results.put((i, ok))
+
+  done = set()
+  running = set()
+  failed = False
+  while True:
+    if not failed:
+      for i in range(len(groups)):
+        if len(running) >= parallel:
+          break
+        if i not in done and i not in running and needs[i] <= done:
+          running.add(i)
+          thread = threading.Thread(target=worker, args=(i,))
+          thread.daemon = True
+          thread.start()
+    if not running:
+      break
+    (i, ok) = results.get()
+    running.discard(i)
+    if ok:
+      done.add(i)
+    else:
+      failed = True
+  return [stage.name for i in sorted(done) for stage in groups[i]]
@@ -0,0 +1,326 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Long running micro path aggregation over a stream of position reports.
+#
+# Reports (id, dt, lat, lon, tab or comma separated) are read from stdin, a
+# TCP socket or a followed file.  The last fix of every active id is kept
+# like prevline in extract_path_segments.py, the segments are run through the
+# tripline engine in small batches and the crossings are summed per cell in
+# temporal_split buckets.  Buckets that end more than stream_window seconds
+# before the newest report are dropped, as are ids whose last fix is older
+# than time_filter, so memory follows the active ids and the window rather
+# than the history.  Snapshots of the window are written like the tables of
+# a local run, every stream_snapshot_interval seconds and on SIGUSR1.
+#
+
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
+import shutil
+import tempfile
+import collections
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+import local_engine
+from timestamps import TimestampParser, TemporalBucketer
+
+# seconds without input after which pending segments are processed
+IDLE_SECONDS = 1.0
+
+
+#
+# lines read from a file descriptor, None whenever nothing arrived for
+# IDLE_SECONDS or a signal interrupted the wait
+#
+def descriptorLines(fd):
+  pending = ''
+  while True:
+    try:
+      (ready, _, _) = select.select([fd], [], [], IDLE_SECONDS)
+      if not ready:
+        yield None
+        continue
+      data = os.read(fd, 65536)
+    except (select.error, OSError) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      yield None
+      continue
+    if not data:
+      break
+    lines = (pending + data).split('\n')
+    pending = lines.pop()
+    for line in lines:
+      yield line
+  if pending:
+    yield pending
+
+
+def socketLines(address):
+  (host, port) = address.rsplit(':', 1)
+  connection = socket.create_connection((host, int(port)))
+  try:
+    for line in descriptorLines(connection.fileno()):
+      yield line
+  finally:
+    connection.close()
+
+
+#
+# lines appended to a file, like tail -F.  The file is read from the start
+# and reopened when it is replaced or truncated.
+#
+def followLines(path):
+  infile = None
+  inode = None
+  pending = ''
+  while True:
+    if infile is None:
+      try:
+        infile = open(path)
+        inode = os.fstat(infile.fileno()).st_ino
+      except IOError:
+        time.sleep(IDLE_SECONDS)
+        yield None
+        continue
+    data = infile.read(65536)
+    if data:
+      lines = (pending + data).split('\n')
+      pending = lines.pop()
+      for line in lines:
+        yield line
+      continue
+    try:
+      current = os.stat(path)
+    except OSError:
+      current = None
+    if current is None or current.st_ino != inode or current.st_size < infile.tell():
+      infile.close()
+      infile = None
+      if pending:
+        yield pending
+        pending = ''
+      continue
+    time.sleep(IDLE_SECONDS)
+    yield None
+
+
+#
+# '-' is stdin, tcp://host:port a socket to connect to, anything else a file to follow
+#
+def sourceLines(source):
+  if source == '-':
+    return descriptorLines(sys.stdin.fileno())
+  if source.startswith('tcp://'):
+    return socketLines(source[len('tcp://'):])
+  return followLines(source)
+
+
+def reportFields(line):
+  line = line.rstrip('\r').replace('"', '')
+  return [field.strip() for field in (line.split('\t') if '\t' in line else line.split(','))]
+
+
+#
+# (id, dt, lat, lon) of a report line from its columns, None for lines with
+# too few fields
+#
+def parseReport(line, columns=(0, 1, 2, 3)):
+  fields = reportFields(line)
+  if len(fields) <= max(columns):
+    return None
+  return [fields[c] for c in columns]
+
+
+#
+# columns of id, dt, lat and lon when the line is a header naming the
+# table_schema columns (as local_engine.readInputRows reads it), else None
+#
+def headerColumns(configuration, line):
+  names = reportFields(line)
+  schema = [configuration.table_schema_id, configuration.table_schema_dt, configuration.table_schema_lat, configuration.table_schema_lon]
+  if all(name in names for name in schema):
+    return [names.index(name) for name in schema]
+  return None
+
+
+class StreamAggregator():
+  def __init__(self, configuration):
+    from extract_path_segments import nextSegment
+    import tripline_bins
+
+    if len(configuration.outputLevels()) > 1:
+      raise ValueError("pyramid_levels and rollup_splits are not supported by the streaming mode")
+    self.configuration = configuration
+    self.nextSegment = nextSegment
+    self.tripline_bins = tripline_bins
+    self.timestamps = TimestampParser()
+    self.labels = TimestampParser()
+    self.bucketer = TemporalBucketer(configuration.temporal_split)
+    # columns of id, dt, lat and lon, set by a header line
+    self.columns = (0, 1, 2, 3)
+    # id -> last fix, least recently moved first
+    self.tracks = collections.OrderedDict()
+    # segments waiting for the tripline engine
+    self.pending = []
+    # bucket label -> [bucket end, {(blanket, cell, label): cell}]
+    self.buckets = {}
+    self.watermark = None
+    # buckets ending at or before this were dropped already
+    self.expired_before = float('-inf')
+    self.counters = collections.Counter()
+
+  def add(self, line):
+    report = parseReport(line, self.columns)
+    if report is None:
+      self.counters['unparseable'] += 1
+      return
+    (user_id, dt, lat, lon) = report
+    dt_parse = self.timestamps.parse(dt.split('.')[0])
+    if dt_parse is None:
+      # a followed file is read from its start, header included
+      columns = headerColumns(self.configuration, line)
+      if columns is not None:
+        self.columns = columns
+        self.counters['headers'] += 1
+      else:
+        self.counters['unparseable'] += 1
+      return
+    self.counters['reports'] += 1
+    if self.watermark is None or dt_parse > self.watermark:
+      self.watermark = dt_parse
+
+    fix = (user_id, dt_parse, lat, lon)
+    prevline = self.tracks.get(user_id)
+    if prevline is not None and dt_parse < prevline[1]:
+      # the track has already moved past this report
+      self.counters['out_of_order'] += 1
+      return
+    # the batch extractor never gets past a gap longer than time_filter, here
+    # the track starts over like it would after its state expired
+    if prevline is None or dt_parse - prevline[1] > self.configuration.time_filter:
+      self.tracks.pop(user_id, None)
+      self.tracks[user_id] = fix
+      return
+
+    (segment, nextline) = self.nextSegment(self.configuration, prevline, fix)
+    if segment is not None:
+      # (id, alat, blat, alon, blon, adt, bdt, time, distance, velocity) -> (alat, alon, blat, blon, adt, bdt, velocity, id)
+      self.pending.append([segment[1], segment[3], segment[2], segment[4], segment[5], segment[6], segment[9], segment[0]])
+      self.counters['segments'] += 1
+    if nextline is not prevline:
+      del self.tracks[user_id]
+      self.tracks[user_id] = nextline
+
+  #
+  # run the pending segments through the tripline engine and slide the window.
+  # Crossings only count as late when their bucket was dropped by an earlier
+  # flush, the window may have moved on while the segments were pending.
+  #
+  def flush(self):
+    if self.pending:
+      for (blanket, cell, label, velocity, direction, track_id) in self.tripline_bins.triplineCrossings(self.configuration, self.pending):
+        bucket = self.buckets.get(label)
+        if bucket is None:
+          end = self.bucketer.bounds(self.labels.parse(label))[1]
+          bucket = self.buckets[label] = [end, {}]
+        if bucket[0] <= self.expired_before:
+          self.counters['late_crossings'] += 1
+          continue
+        local_engine.addCrossing(bucket[1], (int(blanket), int(cell), label), float(velocity), float(direction))
+        self.counters['crossings'] += 1
+      self.pending = []
+    self.expire()
+
+  def windowStart(self):
+    if self.watermark is None:
+      return float('-inf')
+    return self.watermark - self.configuration.stream_window
+
+  def expire(self):
+    oldest = self.windowStart()
+    self.expired_before = max(self.expired_before, oldest)
+    for (label, bucket) in self.buckets.items():
+      if bucket[0] <= oldest:
+        del self.buckets[label]
+    if self.watermark is None:
+      return
+    stale = self.watermark - self.configuration.time_filter
+    while self.tracks:
+      (user_id, prevline) = next(self.tracks.iteritems())
+      if prevline[1] >= stale:
+        break
+      del self.tracks[user_id]
+      self.counters['expired_tracks'] += 1
+
+  #
+  # write the cells of the window as the local run tables, replacing the
+  # files of the previous snapshot in one rename each
+  #
+  def snapshot(self, output_dir):
+    aggregates = {}
+    for (end, cells) in self.buckets.values():
+      aggregates.update(cells)
+    staging = tempfile.mkdtemp(prefix="micro_path_snapshot_", dir=output_dir)
+    try:
+      paths = local_engine.writeTables(self.configuration, aggregates, staging)
+      for table in paths:
+        os.rename(paths[table], os.path.join(output_dir, os.path.basename(paths[table])))
+    finally:
+      shutil.rmtree(staging, ignore_errors=True)
+    return len(aggregates)
+
+
+#
+# aggregate reports from source until it ends, writing snapshots to output_dir,
+# returns the counts of the run
+#
+def run(configuration, source, output_dir):
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  aggregator = StreamAggregator(configuration)
+
+  requested = [False]
+  def requestSnapshot(signum, frame):
+    requested[0] = True
+  signal.signal(signal.SIGUSR1, requestSnapshot)
+
+  def writeSnapshot():
+    aggregator.flush()
+    cells = aggregator.snapshot(output_dir)
+    status = ["cells=" + str(cells), "buckets=" + str(len(aggregator.buckets)), "tracks=" + str(len(aggregator.tracks))]
+    status += [name + "=" + str(count) for (name, count) in sorted(aggregator.counters.items())]
+    print("snapshot " + " ".join(status))
+    sys.stdout.flush()
+
+  interval = configuration.stream_snapshot_interval
+  last_snapshot = time.time()
+  for line in sourceLines(source):
+    if line is not None:
+      aggregator.add(line)
+    if line is None or len(aggregator.pending) >= configuration.tripline_chunk_size:
+      aggregator.flush()
+    if requested[0] or (interval > 0 and time.time() - last_snapshot >= interval):
+      requested[0] = False
+      writeSnapshot()
+      last_snapshot = time.time()
+  writeSnapshot()
+  return dict(aggregator.counters)
@@ -0,0 +1,140 @@
+# Copyright 2016 Sotera Defense Solutions Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Synthetic AIS style tracks for benchmarks and local experiments.
+#
+# Every track starts at a random position (a share of them just west of the
+# dateline, heading east across it) and moves by dead reckoning.  Report
+# intervals, speeds and course changes are drawn from simple distributions,
+# or replayed from the steps of a real track when a seed file is given
+# (e.g. spark/test_data/single_mmsi_ais.tsv: mmsi, name, dt, -, lat, lon,
+# speed in knots, course, ...).  Rows come out sorted by (id, dt) as
+# (id, dt, lat, lon) with dt as YYYY-MM-DDTHH:MM:SS.
+#
+
+import os
+import sys
+import math
+import random
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from timestamps import TimestampParser, formatEpoch
+
+KM_PER_DEGREE = 111.195
+KM_PER_NAUTICAL_MILE = 1.852
+# 2012-05-01 00:00:00
+START_EPOCH = 1335830400
+
+
+#
+# (seconds, knots, course change) of every step of the track in a seed file
+#
+def seedSteps(path, id_column=0, dt_column=2, speed_column=6, course_column=7):
+  timestamps = TimestampParser()
+  fixes = set()
+  with open(path) as infile:
+    for line in infile:
+      fields = line.rstrip("\r\n").split("\t")
+      try:
+        dt = timestamps.parse(fields[dt_column].split('.')[0])
+        fixes.add((fields[id_column], dt, float(fields[speed_column]), float(fields[course_column])))
+      except (IndexError, ValueError, TypeError):
+        continue
+  fixes = sorted(fix for fix in fixes if fix[1] is not None)
+  steps = []
+  for (previous, fix) in zip(fixes, fixes[1:]):
+    seconds = fix[1] - previous[1]
+    if previous[0] != fix[0] or seconds <= 0 or seconds > 86400:
+      continue
+    steps.append((seconds, fix[2], (fix[3] - previous[3] + 180) % 360 - 180))
+  if not steps:
+    raise ValueError("no usable track steps in " + path)
+  return steps
+
+
+class TrackGenerator():
+  def __init__(self, ids=100, points=200, speed_mean=12.0, speed_sd=4.0, intervals=(10, 60, 600, 1200),
+               dateline=0.05, seed=0, steps=None, start_epoch=START_EPOCH, days=5):
+    self.ids = ids
+    self.points = points
+    self.speed_mean = speed_mean
+    self.speed_sd = speed_sd
+    self.intervals = intervals
+    self.dateline = dateline
+    self.seed = seed
+    self.steps = steps
+    self.start_epoch = start_epoch
+    self.days = days
+
+  def parameters(self):
+    return {"ids": self.ids, "points": self.points, "speed_mean": self.speed_mean, "speed_sd": self.speed_sd,
+            "intervals": list(self.intervals), "dateline": self.dateline, "seed": self.seed,
+            "seed_steps": len(self.steps) if self.steps else 0}
+
+  #
+  # (seconds, knots, course change) of the next report
+  #
+  def step(self, generator, position):
+    if self.steps:
+      return self.steps[position % len(self.steps)]
+    return (generator.choice(self.intervals), max(0.0, generator.gauss(self.speed_mean, self.speed_sd)), generator.gauss(0, 10))
+
+  def rows(self):
+    generator = random.Random(self.seed)
+    for i in range(self.ids):
+      track_id = "id%d" % i
+      dt = self.start_epoch + generator.randint(0, 86400*self.days)
+      if generator.random() < self.dateline:
+        (lat, lon, course) = (generator.uniform(-60, 60), generator.uniform(179, 180), generator.uniform(45, 135))
+      else:
+        (lat, lon, course) = (generator.uniform(-60, 60), generator.uniform(-180, 180), generator.uniform(0, 360))
+      position = generator.randint(0, len(self.steps) - 1) if self.steps else 0
+      for j in range(self.points):
+        yield [track_id, formatEpoch(dt).replace(' ', 'T'), "%.5f" % lat, "%.5f" % lon]
+        (seconds, knots, turn) = self.step(generator, position)
+        position += 1
+        course = (course + turn) % 360
+        km = knots * KM_PER_NAUTICAL_MILE * seconds / 3600.0
+        lat += km * math.cos(math.radians(course)) / KM_PER_DEGREE
+        lon += km * math.sin(math.radians(course)) / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        lat = max(-85.0, min(85.0, lat))
+        lon = (lon + 180) % 360 - 180
+        dt += seconds
+
+
+def generatorFromOptions(options):
+  steps = seedSteps(options.seedTrack) if options.seedTrack else None
+  return TrackGenerator(ids=options.ids, points=options.points, speed_mean=options.speedMean, speed_sd=options.speedSd,
+                        dateline=options.dateline, seed=options.seed, steps=steps)
+
+
+def addGeneratorOptions(parser):
+  parser.add_option("--ids", dest="ids", type="int", default=100, help="number of tracks")
+  parser.add_option("--points", dest="points", type="int", default=200, help="reports per track")
+  parser.add_option("--speed-mean", dest="speedMean", type="float", default=12.0, help="mean speed in knots")
+  parser.add_option("--speed-sd", dest="speedSd", type="float", default=4.0, help="speed standard deviation in knots")
+  parser.add_option("--dateline", dest="dateline", type="float", default=0.05, help="share of tracks crossing the dateline")
+  parser.add_option("--seed", dest="seed", type="int", default=0, help="random seed")
+  parser.add_option("--seed-track", dest="seedTrack",
+                    help="AIS TSV whose report intervals, speeds and course changes are replayed, e.g. ../spark/test_data/single_mmsi_ais.tsv")
+
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  addGeneratorOptions(parser)
+  (options, args) = parser.parse_args()
+  for row in generatorFromOptions(options).rows():
+    sys.stdout.write("\t".join(row) + "\n")